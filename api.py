@@ -13,87 +13,395 @@
 #
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import io
 import os
+import hmac
+import importlib
+import json
+import asyncio
+import threading
 
 import uvicorn
-from typing import Annotated, Literal
-from fastapi import FastAPI, Query, Response, status
+from typing import Annotated, Any, Literal
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from fastapi import FastAPI, Header, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 import pandas as pd
 import numpy as np
-import requests
-import zipfile
 from pathlib import Path
-from zstandard import ZstdDecompressor
 from datetime import datetime, timedelta
-from keras.models import load_model
+from time import perf_counter
+from artifacts import download_zip, download_zst
+from batching import MicroBatcher
+from inference import MODEL_VARIANTS, TFLiteEngine, create_engine, tflite_path
+from executor import BoundedExecutor, ExecutorBusy, Timing, server_timing
+from forecast_cache import ForecastCache
+from dataset_cache import load_dataset, load_series, source_info
+from series_store import SeriesStore, to_ns
+from encoding import (FastJSONResponse, MEDIA_TYPES, arrow_response, available_formats, binary_response,
+                      iso_times, iso_timestamps, negotiate, time_axis)
+from pyramid import Pyramid, lttb
+from registry import ModelLoadError, ModelRegistry, discover_routes
 
 BASE_DATA_DIR = 'data'
 # Environment variable
 WORKER_N = int(os.getenv('WORKER_N', 1))
 USE_HTTPS = int(os.getenv('USE_HTTPS', 0))
-DATA_BASE_URL='https://files.nekoid.cc'
+# Batch concurrent /predict requests per tunnel into one forward pass
+BATCH_INFERENCE = int(os.getenv('BATCH_INFERENCE', 0))
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', 32))
+BATCH_MAX_WAIT_MS = float(os.getenv('BATCH_MAX_WAIT_MS', 5))
+BATCH_MAX_PENDING = int(os.getenv('BATCH_MAX_PENDING', 256))
+# Inference engine: predict (Model.predict), call (eager model call) or function (traced tf.function)
+INFERENCE_ENGINE = os.getenv('INFERENCE_ENGINE', 'predict')
+# Model variant served for each tunnel: float32 (the Keras model) or a TF-Lite variant converted by quantize.py
+# (float16, int8), either one variant for all tunnels or per tunnel, e.g. cht=int8,eht=float16 (others float32)
+MODEL_VARIANT = os.getenv('MODEL_VARIANT', 'float32')
+# Models are loaded on first use and kept in an LRU bounded by memory and number of models
+MODEL_CACHE_MB = float(os.getenv('MODEL_CACHE_MB', 2048))
+MODEL_CACHE_SIZE = int(os.getenv('MODEL_CACHE_SIZE', 8))
+# Routes whose model is loaded at startup (comma-separated, the tunnels by default)
+PRELOAD_MODELS = os.getenv('PRELOAD_MODELS', 'cht,eht,wht')
+# Threads running inference and heavy slicing off the event loop
+INFERENCE_THREADS = int(os.getenv('INFERENCE_THREADS', 4))
+# Tasks allowed to wait for a thread, requests beyond that are answered with 503
+INFERENCE_QUEUE_LIMIT = int(os.getenv('INFERENCE_QUEUE_LIMIT', 64))
+# Number of windows per forward pass in /predict_range
+RANGE_BATCH_SIZE = int(os.getenv('RANGE_BATCH_SIZE', 256))
+# Memory budget of the forecast cache (0 to disable)
+FORECAST_CACHE_MB = float(os.getenv('FORECAST_CACHE_MB', 32))
+# Precompute the forecasts of the last n hours of each dataset at startup
+CACHE_WARMUP_HOURS = float(os.getenv('CACHE_WARMUP_HOURS', 0))
+# Load the datasets from the binary cache built next to each csv
+DATASET_CACHE = int(os.getenv('DATASET_CACHE', 1))
+# Memory-map the binary dataset caches read-only, so all uvicorn workers share the same pages
+SHARED_DATASETS = int(os.getenv('SHARED_DATASETS', 0))
+# /fetch downsamples with LTTB from the finest resolution with at most max_points * LTTB_OVERSAMPLE buckets
+LTTB_OVERSAMPLE = int(os.getenv('LTTB_OVERSAMPLE', 8))
+# Poll the upstream journey time feed and append the new data points to the datasets
+LIVE_INGESTION = int(os.getenv('LIVE_INGESTION', 0))
+# Journeytimev2 feed by default (ingest.JOURNEY_TIME_URL)
+UPSTREAM_URL = os.getenv('UPSTREAM_URL')
+INGEST_INTERVAL = float(os.getenv('INGEST_INTERVAL', 60))
+# Live data further than this after the end of a dataset is not appended (the gap would be interpolated)
+INGEST_MAX_GAP_HOURS = float(os.getenv('INGEST_MAX_GAP_HOURS', 6))
+# Check the datasets and models every n seconds and reload the routes whose files have changed (0 to disable)
+RELOAD_INTERVAL = float(os.getenv('RELOAD_INTERVAL', 0))
+# Niceness of the thread loading the reloaded datasets and models, so the requests keep the CPU
+RELOAD_NICENESS = int(os.getenv('RELOAD_NICENESS', 10))
+# Token of POST /reload, passed in the X-Admin-Token header (the endpoint is disabled without it)
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+# Base URL of the dataset and model artifacts, file:// URLs are also accepted
+DATA_BASE_URL = os.getenv('DATA_BASE_URL', 'https://files.nekoid.cc')
 
 DATESET_FILES = {
+  # K02-CH (Cross-Harbour Tunnel)
   'cht': {'path': f'{BASE_DATA_DIR}/journal_time_data_cht.csv',
           'download_url': f'{DATA_BASE_URL}/pub/journal_time_data_cht.csv.zst'},
+  # K02-EH (Eastern Harbour Crossing)
   'eht': {'path': f'{BASE_DATA_DIR}/journal_time_data_eht.csv',
           'download_url': f'{DATA_BASE_URL}/pub/journal_time_data_eht.csv.zst'},
+  # K03-WH (Western Harbour Crossing)
   'wht': {'path': f'{BASE_DATA_DIR}/journal_time_data_wht.csv',
           'download_url': f'{DATA_BASE_URL}/pub/journal_time_data_wht.csv.zst'}
 }
 
-for tunnel in DATESET_FILES:
-  if not Path(DATESET_FILES[tunnel]['path']).exists():
-    print(f'Downloading {DATESET_FILES[tunnel]["path"]}', flush=True)
-    r = requests.get(DATESET_FILES[tunnel]["download_url"])
-    if not r.ok:
-      print('Unable to download the datasets', flush=True)
-      exit(128)
-
-    with open(DATESET_FILES[tunnel]['path'], 'wb+') as f:
-      print(f'Decompressing {DATESET_FILES[tunnel]["path"]}', flush=True)
-      dctx = ZstdDecompressor()
-      decompressor = dctx.stream_writer(f)
-      decompressor.write(r.content)
-      print(f'Decompression done', flush=True)
-
 MODEL_DIR = f'{BASE_DATA_DIR}/model'
 MODEL_ARCHIEVE = 'fyp_forecasting_best_models.zip'
+
+# Served routes: the tunnels, then the other datasets of the data directory with a model (see registry.py)
+ROUTES = [*DATESET_FILES, *(route for route in discover_routes(BASE_DATA_DIR, MODEL_DIR) if route not in DATESET_FILES)]
+
+# Loading state of each route: pending, loading, ready or failed
+# A route serves requests once its dataset is ready, independently of the others
+tunnel_status = {tunnel: 'pending' for tunnel in ROUTES}
+# Journey time series of each route, the calendar features of the model input are derived from the timestamp
+datasets: dict[str, SeriesStore] = {}
+# Mean/min/max aggregates of each dataset for the downsampled /fetch
+pyramids: dict[str, Pyramid] = {}
+model_versions: dict[str, str] = {}
+data_versions: dict[str, str] = {}
+# Files each route was loaded from (see route_sources), a change triggers a reload
+loaded_sources: dict[str, dict[str, Any]] = {}
+# Files of the last failed reload, not retried by the watcher until they change again
+failed_sources: dict[str, dict[str, Any]] = {}
+# Load and reload history of each route, reported by /get_meta
+reload_info: dict[str, dict[str, Any]] = {}
+reload_locks: dict[str, asyncio.Lock] = {}
+
+
+def dataset_path(tunnel: str) -> str:
+  if tunnel in DATESET_FILES:
+    return DATESET_FILES[tunnel]['path']
+  return f'{BASE_DATA_DIR}/journal_time_data_{tunnel}.csv'
+
+
+def ensure_dataset(tunnel: str):
+  path = dataset_path(tunnel)
+  if not Path(path).exists() and tunnel in DATESET_FILES:
+    print(f'Downloading {path}', flush=True)
+    download_zst(DATESET_FILES[tunnel]['download_url'], path)
+    print(f'Downloaded {path}', flush=True)
+
+
 # Download all model versions if not exist
-if not Path(MODEL_DIR).exists():
-  print(f'Downloading {MODEL_ARCHIEVE}', flush=True)
-  r = requests.get(f'{DATA_BASE_URL}/pub/{MODEL_ARCHIEVE}', stream=True)
-  if not r.ok:
-    print('Unable to download the archieve', flush=True)
-    exit(128)
-
-  with zipfile.ZipFile(io.BytesIO(r.content)) as zipfile:
-    zipfile.extractall(BASE_DATA_DIR)
-
-  print(f'Extracted all models', flush=True)
-
-# K02-CH (Cross-Harbour Tunnel)
-cht = pd.read_csv(DATESET_FILES['cht']['path'])
-cht.index = pd.to_datetime(cht['timestamp'])
-cht.drop('timestamp', axis=1, inplace=True)
-cht_model = load_model(f'{MODEL_DIR}/cht')
-print('Loaded CHT (dataset, model)', flush=True)
-
-# K02-EH (Eastern Harbour Crossing)
-eht = pd.read_csv(DATESET_FILES['eht']['path'])
-eht.index = pd.to_datetime(eht['timestamp'])
-eht.drop('timestamp', axis=1, inplace=True)
-eht_model = load_model(f'{MODEL_DIR}/eht')
-print('Loaded EHT (dataset, model)', flush=True)
-
-# K03-WH (Eastern Harbour Crossing)
-wht = pd.read_csv(DATESET_FILES['wht']['path'])
-wht.index = pd.to_datetime(wht['timestamp'])
-wht.drop('timestamp', axis=1, inplace=True)
-wht_model = load_model(f'{MODEL_DIR}/wht')
-print('Loaded WHT (dataset, model)', flush=True)
+def ensure_models():
+  if not Path(MODEL_DIR).exists():
+    print(f'Downloading {MODEL_ARCHIEVE}', flush=True)
+    download_zip(f'{DATA_BASE_URL}/pub/{MODEL_ARCHIEVE}', BASE_DATA_DIR)
+    print('Extracted all models', flush=True)
+
+
+# Use the VERSION file shipped with the model, or the modification time of the saved model
+def get_model_version(path: str) -> str:
+  version_file = Path(path, 'VERSION')
+  if version_file.exists():
+    return version_file.read_text().strip()
+  saved_model = Path(path, 'saved_model.pb')
+  mtime = (saved_model if saved_model.exists() else Path(path)).stat().st_mtime
+  return datetime.fromtimestamp(mtime).strftime('%Y%m%d%H%M%S')
+
+
+def model_variant(tunnel: str) -> str:
+  if '=' not in MODEL_VARIANT:
+    return MODEL_VARIANT
+  variants = dict(item.split('=', 1) for item in MODEL_VARIANT.split(',') if item)
+  return variants.get(tunnel, 'float32')
+
+
+# The forecasts of each variant are cached separately
+def served_model_version(tunnel: str) -> str:
+  version = get_model_version(f'{MODEL_DIR}/{tunnel}')
+  variant = model_variant(tunnel)
+  return version if variant == 'float32' else f'{version}-{variant}'
+
+
+# Modification time (in nanoseconds) and size of the dataset csv, a rewrite within the same second changes it too
+def get_data_version(tunnel: str) -> str:
+  stat = Path(dataset_path(tunnel)).stat()
+  return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+
+# Size and modification time of the dataset csv, and the latest modification time of the served model
+# (the files of the saved model, the TF-Lite variants written next to it excepted, or the TF-Lite file)
+def route_sources(tunnel: str) -> dict[str, Any]:
+  variant = model_variant(tunnel)
+  try:
+    data = tuple(source_info(dataset_path(tunnel)).values())
+  except OSError:
+    data = None
+  try:
+    if variant == 'float32':
+      model_path = Path(MODEL_DIR, tunnel)
+      model = max(path.stat().st_mtime_ns for path in model_path.iterdir()
+                  if path.suffix != '.tflite' and not path.name.startswith('.'))
+    else:
+      model = tflite_path(MODEL_DIR, tunnel, variant).stat().st_mtime_ns
+  except OSError:
+    model = None
+  return {'data': data, 'model': model}
+
+
+# Engine of the TF-Lite variant, TensorFlow is not loaded for it
+def load_tflite_engine(tunnel: str, variant: str, sample: np.ndarray) -> TFLiteEngine:
+  if variant not in MODEL_VARIANTS:
+    raise ValueError(f'Unknown model variant {variant}, available variants: {", ".join(MODEL_VARIANTS)}')
+  engine = TFLiteEngine(tflite_path(MODEL_DIR, tunnel, variant))
+  engine(sample)
+  print(f'{tunnel.upper()} using the {variant} TF-Lite model', flush=True)
+  return engine
+
+
+def load_tunnel_model(tunnel: str):
+  # TensorFlow is imported on first use, so the server can answer health checks while it is loading
+  from keras.models import load_model
+  return load_model(f'{MODEL_DIR}/{tunnel}')
+
+
+# Import the runtime of the route's model before its memory is measured, it is shared by all the models
+def import_runtime(tunnel: str):
+  if model_variant(tunnel) == 'float32':
+    importlib.import_module('keras.models')
+
+
+# Load the model of the route (called by the registry on first use)
+# Warm up and verify the engine with the latest windows of the dataset
+def load_route_engine(tunnel: str) -> Any:
+  data = datasets[tunnel]
+  sample = data.model_inputs(np.arange(len(data) - 7, len(data) + 1), n_steps)
+  variant = model_variant(tunnel)
+  if variant == 'float32':
+    return create_engine(INFERENCE_ENGINE, load_tunnel_model(tunnel), sample, tunnel.upper())
+  return load_tflite_engine(tunnel, variant, sample)
+
+
+registry = ModelRegistry(load_route_engine, MODEL_DIR, max_bytes=int(MODEL_CACHE_MB * 1024 * 1024),
+                         max_models=MODEL_CACHE_SIZE, prepare=import_runtime)
+
+
+async def load_tunnel(tunnel: str, models_downloaded: asyncio.Task):
+  tunnel_status[tunnel] = 'loading'
+  start = perf_counter()
+  try:
+    await asyncio.to_thread(ensure_dataset, tunnel)
+    data = await asyncio.to_thread(load_series, dataset_path(tunnel),
+                                   use_cache=DATASET_CACHE == 1 or SHARED_DATASETS == 1, mmap=SHARED_DATASETS == 1)
+    pyramid = await asyncio.to_thread(Pyramid.build, data)
+    await models_downloaded
+    datasets[tunnel] = data
+    pyramids[tunnel] = pyramid
+    preload = tunnel in PRELOAD_MODELS.split(',')
+    if preload:
+      await registry.get(tunnel)
+    # Taken before the versions, so a file replaced meanwhile is picked up by the next reload
+    sources = route_sources(tunnel)
+    model_versions[tunnel] = served_model_version(tunnel)
+    data_versions[tunnel] = get_data_version(tunnel)
+  except Exception as err:
+    tunnel_status[tunnel] = 'failed'
+    reload_info[tunnel] = {"error": str(err)}
+    print(f'Unable to load {tunnel.upper()}: {err}', flush=True)
+    return
+
+  loaded_sources[tunnel] = sources
+  reload_info[tunnel] = {"loaded_at": datetime.now().isoformat(), "load_time": perf_counter() - start, "reloads": 0}
+  tunnel_status[tunnel] = 'ready'
+  print(f'Loaded {tunnel.upper()} ({"dataset, model" if preload else "dataset"})', flush=True)
+
+  if forecast_cache is not None and CACHE_WARMUP_HOURS > 0:
+    await asyncio.to_thread(warmup_forecast_cache, tunnel, CACHE_WARMUP_HOURS)
+
+
+# Points appended to the old series by the live ingestion (its tail buffer) after the end of the new dataset
+# Points of the old dataset are never carried, so a shortened or revised file is served as it is, and nothing is
+# carried unless the points continue the new dataset (the ingestion then appends again from its end)
+def carry_live_points(old: SeriesStore, new: SeriesStore):
+  end_ns = new.start_ns + len(new) * new.step_ns
+  first = max((end_ns - old.start_ns) // old.step_ns, len(old.values))
+  if old.step_ns == new.step_ns and old.start_ns + first * old.step_ns == end_ns and first < len(old):
+    new.append(old.get(first, len(old)))
+
+
+def lower_priority():
+  try:
+    os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), RELOAD_NICENESS)
+  except (AttributeError, OSError):
+    pass
+
+
+# Runs the reloads in the background, one at a time, the priority of the thread is never raised back
+reload_executor = ThreadPoolExecutor(1, thread_name_prefix='reload', initializer=lower_priority)
+
+
+def run_reload(func, *args):
+  return asyncio.get_running_loop().run_in_executor(reload_executor, func, *args)
+
+
+# Reload the dataset and the model of a route whose files have changed (all of them with force)
+# The new dataset, pyramid and engine are loaded and warmed up in the background, then swapped in, so the route
+# stays ready and the requests in flight finish with what they started with
+# The model is swapped before the dataset and the versions, a failure keeps the route on the previous ones
+async def reload_tunnel(tunnel: str, force: bool = False) -> dict[str, Any]:
+  lock = reload_locks.setdefault(tunnel, asyncio.Lock())
+  async with lock:
+    if tunnel_status[tunnel] == 'failed':
+      # Retry the whole load, e.g. the model was missing
+      await load_tunnel(tunnel, asyncio.create_task(asyncio.to_thread(ensure_models)))
+      return {"status": tunnel_status[tunnel]}
+    if tunnel_status[tunnel] != 'ready':
+      return {"status": tunnel_status[tunnel]}
+
+    sources = route_sources(tunnel)
+    reload_data = force or sources['data'] != loaded_sources[tunnel]['data']
+    reload_model = force or sources['model'] != loaded_sources[tunnel]['model']
+    if not reload_data and not reload_model:
+      return {"status": "unchanged"}
+
+    info = reload_info[tunnel]
+    start = perf_counter()
+    try:
+      if reload_data:
+        data = await run_reload(partial(load_series, dataset_path(tunnel),
+                                        use_cache=DATASET_CACHE == 1 or SHARED_DATASETS == 1,
+                                        mmap=SHARED_DATASETS == 1))
+        pyramid = await run_reload(Pyramid.build, data)
+      if reload_model:
+        await run_reload(registry.reload, tunnel)
+      model_version = served_model_version(tunnel)
+      data_version = get_data_version(tunnel)
+    except Exception as err:
+      failed_sources[tunnel] = sources
+      info["error"] = str(err)
+      print(f'Unable to reload {tunnel.upper()}, still serving the previous version: {err}', flush=True)
+      return {"status": "failed", "error": str(err)}
+
+    # Swapped without yielding to the event loop, so the ingestion never appends to the replaced series
+    if reload_data:
+      if ingestor is not None:
+        carry_live_points(datasets[tunnel], data)
+      pyramid.update()
+      datasets[tunnel] = data
+      pyramids[tunnel] = pyramid
+    model_versions[tunnel] = model_version
+    data_versions[tunnel] = data_version
+    loaded_sources[tunnel] = sources
+    elapsed = perf_counter() - start
+    info.update({"reloaded_at": datetime.now().isoformat(), "reload_time": elapsed, "reloads": info["reloads"] + 1,
+                 "error": None})
+    reloaded = [name for name, changed in (('dataset', reload_data), ('model', reload_model)) if changed]
+    print(f'Reloaded {tunnel.upper()} ({", ".join(reloaded)}) in {elapsed:.2f}s', flush=True)
+
+  if forecast_cache is not None and CACHE_WARMUP_HOURS > 0:
+    await run_reload(warmup_forecast_cache, tunnel, CACHE_WARMUP_HOURS)
+  return {"status": "reloaded", "reloaded": reloaded, "time": elapsed}
+
+
+# Reload the changed routes one at a time, so a reload takes at most one core from the requests
+async def watch_sources():
+  await app.state.loader
+  while True:
+    await asyncio.sleep(RELOAD_INTERVAL)
+    for tunnel in ROUTES:
+      if tunnel_status[tunnel] != 'ready':
+        continue
+      sources = route_sources(tunnel)
+      if sources != loaded_sources[tunnel] and sources != failed_sources.get(tunnel):
+        await reload_tunnel(tunnel)
+
+
+# Download the artifacts and build the binary caches in the parent process before the workers are spawned
+def prepare_artifacts():
+  for tunnel in ROUTES:
+    ensure_dataset(tunnel)
+    if DATASET_CACHE == 1 or SHARED_DATASETS == 1:
+      load_dataset(dataset_path(tunnel))
+  ensure_models()
+
+
+# Download and load all tunnels concurrently
+async def load_all():
+  models_downloaded = asyncio.create_task(asyncio.to_thread(ensure_models))
+  await asyncio.gather(*(load_tunnel(tunnel, models_downloaded) for tunnel in ROUTES))
+
+
+executor = BoundedExecutor(ThreadPoolExecutor(INFERENCE_THREADS, thread_name_prefix='inference'),
+                           INFERENCE_THREADS, INFERENCE_QUEUE_LIMIT)
+batcher = MicroBatcher(lambda tunnel, x: registry.engine(tunnel)(x), executor,
+                       max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS, max_pending=BATCH_MAX_PENDING) \
+  if BATCH_INFERENCE == 1 else None
+# Forecast results keyed by (tunnel, prediction start, model version, data version)
+forecast_cache = ForecastCache(int(FORECAST_CACHE_MB * 1024 * 1024)) if FORECAST_CACHE_MB > 0 else None
+
+
+# The ingestion is imported only when enabled, it needs the crawler dependencies (download.py, pyarrow, aiofile)
+def create_ingestor() -> Any:
+  from ingest import JOURNEY_TIME_URL, LiveIngestor
+  return LiveIngestor(UPSTREAM_URL or JOURNEY_TIME_URL, datasets, interval=INGEST_INTERVAL,
+                      max_gap_hours=INGEST_MAX_GAP_HOURS, on_append=lambda tunnel, n: pyramids[tunnel].update())
+
+
+ingestor = create_ingestor() if LIVE_INGESTION == 1 else None
 
 # Prediction horizon
 # Use the past n_steps  data points to predict the next n_horizon data points
@@ -108,6 +416,77 @@ def round_dt(dt, delta=timedelta(minutes=5)) -> datetime:
   return dt1 if dt1 <= dt else dt1 - delta
 
 
+# Every stride-th prediction start in [start_time, end_time]
+# Return the prediction start times and their offsets in the series (the exclusive end of the model input)
+def range_windows(tunnel: str, start_time: datetime, end_time: datetime, stride: int = 1):
+  data = datasets[tunnel]
+  ends = np.arange(data.offset(start_time), data.offset(end_time) + 1, stride)
+  times = pd.date_range(start=start_time, periods=len(ends), freq=f'{stride * 5}min')
+  return times, ends
+
+
+# Forecast the n_windows windows of data ending before first_end, first_end + stride, ...
+def predict_windows(data: SeriesStore, engine: Any, first_end: int, n_windows: int, stride: int = 1) -> np.ndarray:
+  return engine(data.strided_inputs(first_end, n_windows, n_steps, stride))
+
+
+def warmup_forecast_cache(tunnel: str, hours: float):
+  data = datasets[tunnel]
+  end_time = data.end + timedelta(minutes=5)
+  start_time = max(end_time - timedelta(hours=hours), data.start + timedelta(minutes=n_steps * 5))
+  times, ends = range_windows(tunnel, start_time, end_time)
+  # Versions taken before the engine, a reload meanwhile only makes the forecasts unreachable
+  versions = model_versions[tunnel], data_versions[tunnel]
+  engine = registry.engine(tunnel)
+  result = np.concatenate([predict_windows(data, engine, ends[idx], len(ends[idx:idx + RANGE_BATCH_SIZE]))
+                           for idx in range(0, len(ends), RANGE_BATCH_SIZE)])
+  for time, forecast in zip(times, result):
+    forecast_cache.put((tunnel, time.to_pydatetime(), *versions), forecast)
+  print(f'Precomputed {len(times)} forecasts of {tunnel.upper()}', flush=True)
+
+
+# Return the error response if none of the requested formats is supported
+def format_unacceptable(fmt: str | None, response: Response) -> dict[str, str] | None:
+  if fmt is not None:
+    return None
+  response.status_code = status.HTTP_406_NOT_ACCEPTABLE
+  return {
+    "error": f"Supported formats are {', '.join(MEDIA_TYPES[f] for f in available_formats())}"
+  }
+
+
+# Resident and proportional (shared pages divided among the processes mapping them) memory of this worker
+def process_memory() -> dict[str, Any]:
+  mem: dict[str, Any] = {"pid": os.getpid()}
+  for path, keys in (('/proc/self/status', ('VmRSS',)),
+                     ('/proc/self/smaps_rollup', ('Pss', 'Shared_Clean', 'Private_Clean', 'Private_Dirty'))):
+    try:
+      with open(path) as f:
+        for line in f:
+          key, _, value = line.partition(':')
+          if key in keys:
+            mem[f'{key.lower()}_kb'] = int(value.split()[0])
+    except OSError:
+      pass
+  return mem
+
+
+# Return the error response if the route does not exist or has not been loaded yet
+def tunnel_unavailable(tunnel: str, response: Response) -> dict[str, str] | None:
+  if tunnel not in tunnel_status:
+    response.status_code = status.HTTP_404_NOT_FOUND
+    return {
+      "error": f"Unknown route {tunnel}, available routes are {', '.join(tunnel_status)}"
+    }
+  if tunnel_status[tunnel] == 'ready':
+    return None
+  response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+  response.headers['Retry-After'] = '5'
+  return {
+    "error": f"{tunnel.upper()} is not ready ({tunnel_status[tunnel]})"
+  }
+
+
 app = FastAPI(
   title="FYP Road Forecasting System API",
   description="Provide the journey time forecasting and historical data retrieval",
@@ -124,17 +503,63 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(ExecutorBusy)
+async def executor_busy_handler(request: Request, err: ExecutorBusy):
+  return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                      content={"error": "Server is busy, please retry later"},
+                      headers={"Retry-After": "1"})
+
+
+@app.exception_handler(ModelLoadError)
+async def model_load_error_handler(request: Request, err: ModelLoadError):
+  return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"error": str(err)},
+                      headers={"Retry-After": "5"})
+
+
+@app.on_event("startup")
+async def startup():
+  # Load in background, so the server accepts connections (and health checks) immediately
+  app.state.loader = asyncio.create_task(load_all())
+  if ingestor is not None:
+    app.state.ingestor = asyncio.create_task(ingestor.run())
+  if RELOAD_INTERVAL > 0:
+    app.state.watcher = asyncio.create_task(watch_sources())
+
+
 @app.get("/")
 async def root():
   return {"status": "online"}
 
 
+@app.get("/healthz")
+async def healthz():
+  return {"status": "alive"}
+
+
+@app.get("/readyz")
+async def readyz(response: Response,
+                 tunnel: Annotated[str | None, Query()] = None):
+  tunnels = [tunnel] if tunnel is not None else list(tunnel_status)
+  if tunnel is not None and tunnel not in tunnel_status:
+    return tunnel_unavailable(tunnel, response)
+  ready = all(tunnel_status[t] == 'ready' for t in tunnels)
+  if not ready:
+    response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+  return {"ready": ready, "tunnels": {t: tunnel_status[t] for t in tunnels}}
+
+
 @app.get("/predict")
-async def predict(tunnel: Literal["cht", "eht", "wht"],
+async def predict(tunnel: str,
                   time: Annotated[datetime | None, Query()],
                   response: Response,
                   include_timestamp: Annotated[bool | None, Query()] = True,
-                  include_input: Annotated[bool | None, Query()] = True):
+                  include_input: Annotated[bool | None, Query()] = True,
+                  format: Annotated[Literal["json", "compact", "binary", "arrow"] | None, Query()] = None,
+                  accept: Annotated[str | None, Header()] = None):
+  fmt = negotiate(format, accept)
+  if (error := format_unacceptable(fmt, response)) is not None:
+    return error
+
   if time is None:
     time = datetime.now() - timedelta(minutes=5)
 
@@ -142,118 +567,363 @@ async def predict(tunnel: Literal["cht", "eht", "wht"],
   time = round_dt(time) - timedelta(minutes=5)
   time1 = time - timedelta(minutes=(n_steps - 1) * 5)
 
-  # Select dataset
-  data = cht if tunnel == "cht" \
-    else eht if tunnel == "eht" \
-    else wht if tunnel == "wht" \
-    else None
+  if (error := tunnel_unavailable(tunnel, response)) is not None:
+    return error
 
-  # Select model
-  model = cht_model if tunnel == "cht" \
-    else eht_model if tunnel == "eht" \
-    else wht_model if tunnel == "wht" \
-    else None
+  data = datasets[tunnel]
 
-  if time1 < data.index[0]:
+  if time1 < data.start:
     response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
-    eariler_time = data.index[0].to_pydatetime() + timedelta(minutes=n_steps * 5)
+    eariler_time = data.start + timedelta(minutes=n_steps * 5)
     return {
       "error": f"Index out of range, the earlist available time is {eariler_time}"
     }
 
   # Use existing dataset
   model_input = None
-  if time <= data.index[-1]:
-    model_input = data.loc[time1:time]
-  else:
-    # TODO Fetch from upstream
-    # When time is None, attempt to fetch the previous n_steps journey data from upstream API
-    pass
+  if time <= data.end:
+    model_input = data.model_input(data.offset(time) + 1, n_steps)
+  # Otherwise, the data has not been ingested from upstream yet (or LIVE_INGESTION is disabled)
 
   if model_input is None:
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
     return {
-      "error": "Unable to fetch data from upstream or the dataset"
+      "error": f"Unable to fetch data from upstream or the dataset, the latest data is at {data.end}"
     }
 
   # Predict the next n_horizon data point
-  result = model.predict(np.expand_dims(model_input.to_numpy(), axis=0))
-  result = result.flatten()
   predict_start = time + timedelta(minutes=5)
+  cache_key = (tunnel, predict_start, model_versions[tunnel], data_versions[tunnel])
+  result = forecast_cache.get(cache_key) if forecast_cache is not None else None
+  headers = {'Vary': 'Accept'}
+  if result is None:
+    # Load the model on first use
+    start = perf_counter()
+    engine = await registry.get(tunnel)
+    model_time = perf_counter() - start
+    if batcher is not None:
+      result, timing = await batcher.predict(tunnel, model_input)
+    else:
+      result, timing = await executor.run(engine, np.expand_dims(model_input, axis=0))
+    headers['Server-Timing'] = server_timing(model=model_time, infer=timing)
+    result = result.flatten()
+    if forecast_cache is not None:
+      forecast_cache.put(cache_key, result)
   predict_end = time + timedelta(minutes=n_horizon * 5)
   next_iter = predict_end + timedelta(minutes=5)
-  if next_iter > data.index[-1]:
+  if next_iter > data.end:
     next_iter = None
 
-  res = {"time": predict_start, "predict": result.tolist(), "next": next_iter}
+  predict_start_ns = to_ns(predict_start)
+  input_start_ns = to_ns(time1)
+  input_values = model_input[:, 0]
+
+  if fmt == 'binary':
+    # Body is the model input (if included) followed by the prediction
+    headers.update({'X-Time': predict_start.isoformat(), 'X-Step-Seconds': str(data.step_ns // 10 ** 9),
+                    'X-Count': str(len(result))})
+    if next_iter is not None:
+      headers['X-Next'] = next_iter.isoformat()
+    if include_input:
+      headers.update({'X-Input-Start-Time': time1.isoformat(), 'X-Input-Count': str(len(input_values))})
+    return binary_response([input_values, result] if include_input else [result], headers)
+
+  if fmt == 'arrow':
+    series = [('input', time_axis(input_start_ns, data.step_ns, len(input_values)), input_values)] \
+      if include_input else []
+    series.append(('predict', time_axis(predict_start_ns, data.step_ns, len(result)), result))
+    return arrow_response(series, headers)
+
+  res = {
+    "time": predict_start.isoformat(),
+    "predict": result.tolist(),
+    "next": next_iter.isoformat() if next_iter is not None else None,
+  }
+
+  if fmt == 'compact':
+    res["step"] = data.step_ns // 10 ** 9
+    if include_input:
+      res["input_data"] = {"start_time": time1.isoformat(), "data": input_values.tolist()}
+    return FastJSONResponse(res, media_type=MEDIA_TYPES[fmt], headers=headers)
 
   if include_timestamp:
-    timestamp = pd.date_range(start=predict_start, end=predict_end, freq='5min')
-    res["timestamp"] = timestamp.tolist()
+    res["timestamp"] = iso_timestamps(predict_start_ns, data.step_ns, len(result))
 
   if include_input:
     input_data = {
-      "timestamp": model_input.index.tolist(),
-      "data": model_input.iloc[:, 0].tolist(),
+      "timestamp": iso_timestamps(input_start_ns, data.step_ns, len(input_values)),
+      "data": input_values.tolist(),
     }
     res["input_data"] = input_data
 
-  return res
+  return FastJSONResponse(res, headers=headers)
+
+
+# Answer /fetch from the aggregate pyramid
+# aggregate: mean/min/max buckets at the requested resolution, or the finest one with at most max_points buckets
+# lttb: shape-preserving max_points samples of the bucket means, the timestamps are irregular
+def downsample_range(tunnel: str, start_time: datetime, end_time: datetime, resolution: str | None,
+                     max_points: int | None, method: str, fmt: str, include_timestamp: bool) -> Response:
+  pyramid = pyramids[tunnel]
+  if resolution is not None:
+    level = pyramid.levels[resolution]
+  else:
+    level = pyramid.select(start_time, end_time, max_points * (LTTB_OVERSAMPLE if method == 'lttb' else 1))
+  first, last = level.bounds(start_time, end_time)
+  start_ns = level.start_ns + first * level.step_ns
+  step = level.step_ns // 10 ** 9
+
+  if method == 'lttb' and max_points is not None:
+    values = level.range(first, last)[0]
+    idx = lttb(values, max_points)
+    values = values[idx]
+    if fmt == 'binary':
+      # Offsets are the index of each sample in steps from X-Start-Time
+      return binary_response([values, idx], {
+        'X-Start-Time': pd.Timestamp(start_ns).isoformat(), 'X-Step-Seconds': str(step),
+        'X-Resolution': level.name, 'X-Count': str(len(values)), 'X-Series': 'value,offset'})
+    if fmt == 'arrow':
+      return arrow_response([(tunnel, start_ns + idx * level.step_ns, values)], {'X-Resolution': level.name})
+    res = {
+      "start_time": start_time.isoformat(),
+      "end_time": end_time.isoformat(),
+      "resolution": level.name,
+      "results": values.tolist(),
+    }
+    if fmt == 'compact':
+      res.update({"first_time": pd.Timestamp(start_ns).isoformat(), "step": step, "offset": idx.tolist()})
+    else:
+      res["timestamp"] = iso_times(start_ns + idx * level.step_ns)
+    return FastJSONResponse(res, media_type=MEDIA_TYPES[fmt])
+
+  mean, lower, upper = level.range(first, last)
+  if fmt == 'binary':
+    return binary_response([mean, lower, upper], {
+      'X-Start-Time': pd.Timestamp(start_ns).isoformat(), 'X-Step-Seconds': str(step),
+      'X-Resolution': level.name, 'X-Count': str(len(mean)), 'X-Series': 'mean,min,max'})
+  if fmt == 'arrow':
+    times = time_axis(start_ns, level.step_ns, len(mean))
+    return arrow_response([('mean', times, mean), ('min', times, lower), ('max', times, upper)],
+                          {'X-Resolution': level.name})
+  res = {
+    "start_time": start_time.isoformat(),
+    "end_time": end_time.isoformat(),
+    "resolution": level.name,
+    "results": mean.tolist(),
+    "min": lower.tolist(),
+    "max": upper.tolist(),
+  }
+  if fmt == 'compact':
+    res.update({"first_time": pd.Timestamp(start_ns).isoformat(), "step": step})
+  elif include_timestamp:
+    res["timestamp"] = iso_timestamps(start_ns, level.step_ns, len(mean))
+  return FastJSONResponse(res, media_type=MEDIA_TYPES[fmt])
 
 
 @app.get("/fetch")
-async def fetch(tunnel: Literal["cht", "eht", "wht"],
+async def fetch(tunnel: str,
                 start_time: Annotated[datetime, Query()],
                 end_time: Annotated[datetime, Query()],
                 response: Response,
-                include_timestamp: Annotated[bool | None, Query()] = True):
+                include_timestamp: Annotated[bool | None, Query()] = True,
+                resolution: Annotated[Literal["5m", "15m", "1h", "1d"] | None, Query()] = None,
+                max_points: Annotated[int | None, Query(ge=3)] = None,
+                downsample: Annotated[Literal["aggregate", "lttb"], Query()] = "aggregate",
+                format: Annotated[Literal["json", "compact", "binary", "arrow"] | None, Query()] = None,
+                accept: Annotated[str | None, Header()] = None):
+  fmt = negotiate(format, accept)
+  if (error := format_unacceptable(fmt, response)) is not None:
+    return error
+
   start_time = round_dt(start_time)
   end_time = round_dt(end_time)
 
-  data = cht if tunnel == "cht" \
-    else eht if tunnel == "eht" \
-    else wht if tunnel == "wht" \
-    else None
+  if (error := tunnel_unavailable(tunnel, response)) is not None:
+    return error
 
-  if data is None:
-    return {}
+  data = datasets[tunnel]
 
-  if start_time < data.index[0] or end_time > data.index[-1]:
+  if start_time < data.start or end_time > data.end:
     response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
     return {
-      "error": "Index out of range, the available time range is " +
-               data.index[0].to_pydatetime() + " to " +
-               data.index[-1].to_pydatetime()
+      "error": f"Index out of range, the available time range is {data.start} to {data.end}"
     }
 
-  result = data.loc[start_time:end_time, data.columns[0]]
-  res = {
-    "start_time": start_time,
-    "end_time": end_time,
-    "results": result.to_list()
-  }
+  def slice_range() -> Response:
+    result = data.slice(start_time, end_time)
+    # Time of the first returned point, start_time clamped to the dataset
+    start_ns = data.start_ns + max(data.offset(start_time), 0) * data.step_ns
+    first_time = pd.Timestamp(start_ns).isoformat()
+    if fmt == 'binary':
+      return binary_response([result], {'X-Start-Time': first_time,
+                                        'X-Step-Seconds': str(data.step_ns // 10 ** 9),
+                                        'X-Count': str(len(result))})
+    if fmt == 'arrow':
+      return arrow_response([(tunnel, time_axis(start_ns, data.step_ns, len(result)), result)], {})
+
+    res = {
+      "start_time": start_time.isoformat(),
+      "end_time": end_time.isoformat(),
+      "results": result.tolist()
+    }
 
-  if include_timestamp:
-    timestamp = result.index
-    res["timestamp"] = timestamp.tolist()
+    if fmt == 'compact':
+      res["first_time"] = first_time
+      res["step"] = data.step_ns // 10 ** 9
+    elif include_timestamp:
+      res["timestamp"] = iso_timestamps(start_ns, data.step_ns, len(result))
+
+    return FastJSONResponse(res, media_type=MEDIA_TYPES[fmt])
 
+  if resolution is not None or max_points is not None:
+    res, timing = await executor.run(downsample_range, tunnel, start_time, end_time, resolution, max_points,
+                                     downsample, fmt, include_timestamp)
+  else:
+    res, timing = await executor.run(slice_range)
+  res.headers['Vary'] = 'Accept'
+  res.headers['Server-Timing'] = server_timing(slice=timing)
   return res
 
 
+@app.get("/predict_range")
+async def predict_range(tunnel: str,
+                        start_time: Annotated[datetime, Query()],
+                        end_time: Annotated[datetime, Query()],
+                        response: Response,
+                        stride: Annotated[int | None, Query(ge=1)] = n_horizon,
+                        stream: Annotated[bool | None, Query()] = False):
+  # Forecast every stride-th prediction start in [start_time, end_time], same as following the next pointer of /predict
+  start_time = round_dt(start_time)
+  end_time = round_dt(end_time)
+  if (error := tunnel_unavailable(tunnel, response)) is not None:
+    return error
+
+  data = datasets[tunnel]
+
+  earliest = data.start + timedelta(minutes=n_steps * 5)
+  latest = data.end + timedelta(minutes=5)
+  end_time = min(end_time, latest)
+  if start_time < earliest or start_time > end_time:
+    response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    return {
+      "error": f"Index out of range, the available prediction range is {earliest} to {latest}"
+    }
+
+  start = perf_counter()
+  engine = await registry.get(tunnel)
+  model_time = perf_counter() - start
+
+  times, ends = range_windows(tunnel, start_time, end_time, stride)
+  next_iter = times[-1] + timedelta(minutes=stride * 5)
+  next_iter = next_iter if next_iter <= latest else None
+
+  queue_wait = exec_time = 0.0
+
+  async def predict_batches():
+    nonlocal queue_wait, exec_time
+    for idx in range(0, len(ends), RANGE_BATCH_SIZE):
+      result, timing = await executor.run(predict_windows, data, engine, ends[idx],
+                                          len(ends[idx:idx + RANGE_BATCH_SIZE]), stride)
+      queue_wait += timing.queue_wait
+      exec_time += timing.exec_time
+      yield times[idx:idx + RANGE_BATCH_SIZE], result
+
+  if stream:
+    # One JSON object per batch (NDJSON), so the response is never buffered as a whole
+    # The status is already sent when a later batch fails, the stream then ends with an error line giving the first
+    # prediction start not returned
+    async def stream_batches():
+      sent = 0
+      try:
+        async for batch_times, result in predict_batches():
+          yield json.dumps({
+            "time": [t.isoformat() for t in batch_times],
+            "predict": result.tolist(),
+          }) + '\n'
+          sent += len(batch_times)
+      except ExecutorBusy:
+        yield json.dumps({"error": "Server is busy, please retry later", "retry_after": 1,
+                          "next": times[sent].isoformat()}) + '\n'
+      except Exception as err:
+        print(f'Unable to forecast {tunnel.upper()} from {times[sent]}: {err}', flush=True)
+        yield json.dumps({"error": f"Unable to forecast from {times[sent]}", "retry_after": None,
+                          "next": times[sent].isoformat()}) + '\n'
+
+    return StreamingResponse(stream_batches(), media_type='application/x-ndjson')
+
+  predict_result = []
+  async for _, result in predict_batches():
+    predict_result.extend(result.tolist())
+  response.headers['Server-Timing'] = server_timing(model=model_time, infer=Timing(queue_wait, exec_time))
+
+  return {
+    "start_time": start_time,
+    "end_time": end_time,
+    "stride": stride,
+    "time": times.tolist(),
+    "predict": predict_result,
+    "next": next_iter,
+  }
+
+
 @app.get("/get_meta")
-def fetch_meta():
+def fetch_meta(response: Response):
+  if (error := tunnel_unavailable('cht', response)) is not None:
+    return error
+
+  data = datasets['cht']
   return {
     "n_steps": n_steps,
     "n_horizon": n_horizon,
-    "earliest_predict_start": cht.index[0].to_pydatetime() + timedelta(minutes=n_steps * 5),
-    "timestamp_start": cht.index[0].to_pydatetime(),
-    "timestamp_end": cht.index[-1].to_pydatetime(),
+    "earliest_predict_start": data.start + timedelta(minutes=n_steps * 5),
+    "timestamp_start": data.start,
+    "timestamp_end": data.end,
+    "routes": {tunnel: {
+      "status": tunnel_status[tunnel],
+      "data_version": data_versions.get(tunnel),
+      "model_version": model_versions.get(tunnel),
+      **reload_info.get(tunnel, {}),
+    } for tunnel in ROUTES},
+  }
+
+
+# Reload the routes whose dataset or model has changed (all routes unless tunnel is given)
+# Each uvicorn worker reloads its own routes, with several workers use RELOAD_INTERVAL instead
+@app.post("/reload")
+async def reload(response: Response,
+                 tunnel: Annotated[str | None, Query()] = None,
+                 force: Annotated[bool, Query()] = False,
+                 x_admin_token: Annotated[str | None, Header()] = None):
+  if not ADMIN_TOKEN or not hmac.compare_digest((x_admin_token or '').encode(), ADMIN_TOKEN.encode()):
+    response.status_code = status.HTTP_403_FORBIDDEN
+    return {"error": "Reload requires the admin token"}
+  if tunnel is not None and tunnel not in tunnel_status:
+    return tunnel_unavailable(tunnel, response)
+  results = {}
+  for name in [tunnel] if tunnel is not None else ROUTES:
+    results[name] = await reload_tunnel(name, force)
+  return {"routes": results}
+
+
+@app.get("/stats")
+def fetch_stats():
+  return {
+    "executor": executor.stats(),
+    "batching": batcher.stats() if batcher is not None else None,
+    "forecast_cache": forecast_cache.stats() if forecast_cache is not None else None,
+    "models": registry.stats(),
+    "ingestion": ingestor.stats() if ingestor is not None else None,
+    "memory": process_memory(),
   }
 
 
 if __name__ == "__main__":
+  # Multiple workers need the application as import string, each worker then loads the tunnels itself
+  if WORKER_N > 1:
+    prepare_artifacts()
+  application = "api:app" if WORKER_N > 1 else app
   if USE_HTTPS == 1:
-    uvicorn.run(app, host="0.0.0.0", port=8881, workers=WORKER_N,
+    uvicorn.run(application, host="0.0.0.0", port=8881, workers=WORKER_N,
                 ssl_keyfile=f"{BASE_DATA_DIR}/privkey.pem", ssl_certfile=f"{BASE_DATA_DIR}/fullchain.pem")
   else:
-    uvicorn.run(app, host="0.0.0.0", port=8881, workers=WORKER_N)
+    uvicorn.run(application, host="0.0.0.0", port=8881, workers=WORKER_N)
@@ -0,0 +1,94 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import shutil
+import zipfile
+from pathlib import Path
+from typing import BinaryIO, Callable
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+import requests
+from zstandard import ZstdDecompressor
+
+CHUNK_SIZE = 1 << 20
+
+
+class DownloadError(Exception):
+  pass
+
+
+def open_file_url(url: str) -> BinaryIO:
+  path = Path(url2pathname(urlparse(url).path))
+  if not path.exists():
+    raise DownloadError(f'{path} does not exist')
+  return open(path, 'rb')
+
+
+def open_http_url(url: str) -> BinaryIO:
+  r = requests.get(url, stream=True, timeout=30)
+  if not r.ok:
+    r.close()
+    raise DownloadError(f'{url} returned HTTP {r.status_code}')
+  r.raw.decode_content = True
+  return r.raw
+
+
+# URL scheme -> function returning a readable binary stream
+# Register another opener to fetch the artifacts from elsewhere (e.g. object storage)
+OPENERS: dict[str, Callable[[str], BinaryIO]] = {
+  'file': open_file_url,
+  'http': open_http_url,
+  'https': open_http_url,
+}
+
+
+def register_opener(scheme: str, opener: Callable[[str], BinaryIO]):
+  OPENERS[scheme] = opener
+
+
+def open_url(url: str) -> BinaryIO:
+  scheme = urlparse(url).scheme or 'file'
+  if scheme not in OPENERS:
+    raise DownloadError(f'Unsupported URL scheme {scheme}')
+  return OPENERS[scheme](url)
+
+
+# Stream the zstd compressed file at url through the decompressor to output_path
+def download_zst(url: str, output_path: str | Path):
+  output_path = Path(output_path)
+  tmp_path = output_path.with_name(f'{output_path.name}.part-{os.getpid()}')
+  try:
+    with open_url(url) as src, open(tmp_path, 'wb') as dst:
+      ZstdDecompressor().copy_stream(src, dst, read_size=CHUNK_SIZE, write_size=CHUNK_SIZE)
+    os.replace(tmp_path, output_path)
+  finally:
+    tmp_path.unlink(missing_ok=True)
+
+
+# Stream the zip archive at url to a temporary file then extract it to output_dir
+# zipfile needs a seekable file, the archive is spooled to disk instead of memory
+def download_zip(url: str, output_dir: str | Path):
+  output_dir = Path(output_dir)
+  output_dir.mkdir(parents=True, exist_ok=True)
+  tmp_path = Path(output_dir, f'.download-{os.getpid()}.zip')
+  try:
+    with open_url(url) as src, open(tmp_path, 'wb') as dst:
+      shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    with zipfile.ZipFile(tmp_path) as archive:
+      archive.extractall(output_dir)
+  finally:
+    tmp_path.unlink(missing_ok=True)
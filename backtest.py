@@ -0,0 +1,173 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from dataset_cache import load_series
+from inference import create_engine
+from series_store import SeriesStore
+
+# Rolling-origin backtest of the tunnel models: every stride-th prediction start (origin) in the range is
+# forecast from the n_steps points before it and compared with the n_horizon points after it
+N_STEPS = 12 * 6
+N_HORIZON = 12 * 3
+BATCH_SIZE = 512
+# Origins per task, the tasks of all tunnels are spread across the worker processes
+ORIGINS_PER_TASK = 8192
+# Horizons (in steps) printed in the report, the json report has all of them
+REPORT_STEPS = [1, 3, 6, 12, 24, 36]
+
+
+# Error of each horizon accumulated batch by batch, only the sums are kept
+# MAPE skips the actual values of 0
+class HorizonMetrics:
+  def __init__(self, n_horizon: int = N_HORIZON):
+    self.n = 0
+    self.abs_error = np.zeros(n_horizon)
+    self.sq_error = np.zeros(n_horizon)
+    self.pct_error = np.zeros(n_horizon)
+    self.pct_count = np.zeros(n_horizon, dtype=np.int64)
+
+  def update(self, forecast: np.ndarray, actual: np.ndarray):
+    error = forecast.astype(np.float64) - actual
+    self.n += len(error)
+    self.abs_error += np.abs(error).sum(axis=0)
+    self.sq_error += np.square(error).sum(axis=0)
+    nonzero = actual != 0
+    self.pct_error += np.abs(np.divide(error, actual, out=np.zeros_like(error), where=nonzero)).sum(axis=0)
+    self.pct_count += nonzero.sum(axis=0)
+
+  def merge(self, other: 'HorizonMetrics'):
+    self.n += other.n
+    self.abs_error += other.abs_error
+    self.sq_error += other.sq_error
+    self.pct_error += other.pct_error
+    self.pct_count += other.pct_count
+
+  def result(self) -> dict[str, Any]:
+    n = max(self.n, 1)
+    return {
+      'origins': self.n,
+      'mae': (self.abs_error / n).tolist(),
+      'rmse': np.sqrt(self.sq_error / n).tolist(),
+      'mape': (100 * self.pct_error / np.maximum(self.pct_count, 1)).tolist(),
+      'overall': {
+        'mae': float(self.abs_error.sum() / (n * len(self.abs_error))),
+        'rmse': float(np.sqrt(self.sq_error.sum() / (n * len(self.sq_error)))),
+        'mape': float(100 * self.pct_error.sum() / max(self.pct_count.sum(), 1)),
+      },
+    }
+
+
+# Prediction starts (exclusive ends of the model input) in [start_time, end_time] with a complete input and target
+def origins(data: SeriesStore, start_time: datetime | None, end_time: datetime | None, stride: int = 1) -> np.ndarray:
+  first = N_STEPS if start_time is None else max(data.offset(start_time), N_STEPS)
+  last = len(data) - N_HORIZON if end_time is None else min(data.offset(end_time), len(data) - N_HORIZON)
+  return np.arange(first, last + 1, stride, dtype=np.int64)
+
+
+def backtest_origins(data: SeriesStore, engine: Any, ends: np.ndarray, batch_size: int = BATCH_SIZE) -> HorizonMetrics:
+  metrics = HorizonMetrics()
+  for idx in range(0, len(ends), batch_size):
+    batch = ends[idx:idx + batch_size]
+    metrics.update(engine(data.model_inputs(batch, N_STEPS)), data.windows(batch, N_HORIZON))
+  return metrics
+
+
+# Series and engine of each tunnel, loaded once per worker process
+_loaded: dict[str, tuple[SeriesStore, Any]] = {}
+
+
+def load_tunnel(data_dir: str, tunnel: str, engine_name: str) -> tuple[SeriesStore, Any]:
+  if tunnel not in _loaded:
+    from keras.models import load_model
+    data = load_series(f'{data_dir}/journal_time_data_{tunnel}.csv', mmap=True)
+    model = load_model(f'{data_dir}/model/{tunnel}')
+    sample = data.model_inputs(np.arange(len(data) - 7, len(data) + 1), N_STEPS)
+    _loaded[tunnel] = data, create_engine(engine_name, model, sample, tunnel.upper())
+  return _loaded[tunnel]
+
+
+def backtest_task(data_dir: str, tunnel: str, engine_name: str, ends: np.ndarray, batch_size: int) -> HorizonMetrics:
+  data, engine = load_tunnel(data_dir, tunnel, engine_name)
+  return backtest_origins(data, engine, ends, batch_size)
+
+
+# Backtest the tunnels over [start_time, end_time], return the metrics of each tunnel
+# With workers > 1 the origins are split into tasks run in spawned processes (TensorFlow is not fork-safe)
+def backtest(tunnels: list[str], start_time: datetime | None = None, end_time: datetime | None = None, *,
+             stride: int = 1, data_dir: str = 'data', engine: str = 'function', batch_size: int = BATCH_SIZE,
+             workers: int = 1) -> dict[str, HorizonMetrics]:
+  tasks = []
+  for tunnel in tunnels:
+    # Build the binary cache once before the workers memory-map it
+    data = load_series(f'{data_dir}/journal_time_data_{tunnel}.csv')
+    ends = origins(data, start_time, end_time, stride)
+    tasks.extend((tunnel, ends[idx:idx + ORIGINS_PER_TASK]) for idx in range(0, len(ends), ORIGINS_PER_TASK))
+
+  results = {tunnel: HorizonMetrics() for tunnel in tunnels}
+  if workers <= 1:
+    for tunnel, ends in tasks:
+      results[tunnel].merge(backtest_task(data_dir, tunnel, engine, ends, batch_size))
+    return results
+
+  with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+    futures = [(tunnel, pool.submit(backtest_task, data_dir, tunnel, engine, ends, batch_size))
+               for tunnel, ends in tasks]
+    for tunnel, future in futures:
+      results[tunnel].merge(future.result())
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Rolling-origin backtest of the tunnel models')
+  parser.add_argument('--tunnel', nargs='+', default=['cht', 'eht', 'wht'])
+  parser.add_argument('--start-time', type=datetime.fromisoformat, help='First prediction start (default earliest)')
+  parser.add_argument('--end-time', type=datetime.fromisoformat, help='Last prediction start (default latest)')
+  parser.add_argument('--stride', type=int, default=1, help='Steps (5 minutes) between the prediction starts')
+  parser.add_argument('--data-dir', default='data')
+  parser.add_argument('--engine', default='function', help='Inference engine (see inference.py)')
+  parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+  parser.add_argument('--workers', type=int, default=1, help=f'Processes (up to {os.cpu_count()} cores)')
+  parser.add_argument('--output', type=Path, help='Write the metrics of every horizon to this json file')
+  args = parser.parse_args()
+
+  start = time.perf_counter()
+  results = backtest(args.tunnel, args.start_time, args.end_time, stride=args.stride, data_dir=args.data_dir,
+                     engine=args.engine, batch_size=args.batch_size, workers=args.workers)
+  elapsed = time.perf_counter() - start
+
+  report = {tunnel: metrics.result() for tunnel, metrics in results.items()}
+  for tunnel, result in report.items():
+    overall = result['overall']
+    print(f'{tunnel.upper()} {result["origins"]} origins: MAE={overall["mae"]:.3f} RMSE={overall["rmse"]:.3f} '
+          f'MAPE={overall["mape"]:.2f}%', flush=True)
+    for step in REPORT_STEPS:
+      print(f'  +{step * 5:>3}min MAE={result["mae"][step - 1]:.3f} RMSE={result["rmse"][step - 1]:.3f} '
+            f'MAPE={result["mape"][step - 1]:.2f}%', flush=True)
+  n = sum(result['origins'] for result in report.values())
+  print(f'Backtested {n} origins in {elapsed:.1f}s ({n / elapsed:.0f} origins/s)', flush=True)
+  if args.output is not None:
+    args.output.write_text(json.dumps(report, indent=2))
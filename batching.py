@@ -0,0 +1,124 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import time
+from typing import Any, Callable
+
+import numpy as np
+
+from executor import BoundedExecutor, ExecutorBusy, Timing
+
+
+# Collect concurrent single-window requests per key (tunnel) and run them as one batched forward pass.
+# A batch is dispatched when max_batch_size windows are queued or the oldest one has waited max_wait_ms.
+# Only one batch per key is in flight at a time, requests arriving meanwhile are queued for the next batch.
+# At most max_pending windows are queued per key, further requests raise ExecutorBusy.
+class MicroBatcher:
+  def __init__(self, predict_fn: Callable[[str, np.ndarray], np.ndarray], executor: BoundedExecutor, *,
+               max_batch_size: int = 32, max_wait_ms: float = 5.0, max_pending: int = 256):
+    self.predict_fn = predict_fn
+    self.executor = executor
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000
+    self.max_pending = max_pending
+    # key -> [(window, future, enqueue_time)]
+    self._pending: dict[str, list[tuple[np.ndarray, asyncio.Future, float]]] = {}
+    self._timers: dict[str, asyncio.TimerHandle] = {}
+    self._running: set[str] = set()
+    # Statistics
+    self.n_batches = 0
+    self.n_requests = 0
+    self.max_batch_seen = 0
+    self.total_queue_wait = 0.0
+    self.max_queue_wait = 0.0
+    self.batch_size_hist: dict[int, int] = {}
+
+  # Return the prediction of window with its timing (batching wait is included in the queue wait)
+  async def predict(self, key: str, window: np.ndarray) -> tuple[np.ndarray, Timing]:
+    loop = asyncio.get_running_loop()
+    queue = self._pending.setdefault(key, [])
+    if len(queue) >= self.max_pending:
+      raise ExecutorBusy(f'{len(queue)} windows are queued for {key}')
+    fut = loop.create_future()
+    queue.append((window, fut, time.perf_counter()))
+    if key not in self._running:
+      if len(queue) >= self.max_batch_size:
+        self._flush(key)
+      elif key not in self._timers:
+        self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+    return await fut
+
+  def _flush(self, key: str):
+    timer = self._timers.pop(key, None)
+    if timer is not None:
+      timer.cancel()
+    queue = self._pending.get(key)
+    if key in self._running or not queue:
+      return
+    batch = queue[:self.max_batch_size]
+    del queue[:self.max_batch_size]
+    self._running.add(key)
+    asyncio.get_running_loop().create_task(self._run(key, batch))
+
+  async def _run(self, key: str, batch: list[tuple[np.ndarray, asyncio.Future, float]]):
+    now = time.perf_counter()
+    for _, _, enqueued in batch:
+      wait = now - enqueued
+      self.total_queue_wait += wait
+      self.max_queue_wait = max(self.max_queue_wait, wait)
+    n = len(batch)
+    self.n_batches += 1
+    self.n_requests += n
+    self.max_batch_seen = max(self.max_batch_seen, n)
+    self.batch_size_hist[n] = self.batch_size_hist.get(n, 0) + 1
+
+    try:
+      inputs = np.stack([window for window, _, _ in batch])
+      results, timing = await self.executor.run(self.predict_fn, key, inputs)
+      for idx, (_, fut, enqueued) in enumerate(batch):
+        if not fut.done():
+          fut.set_result((results[idx], Timing(now - enqueued + timing.queue_wait, timing.exec_time)))
+    except Exception as err:
+      for _, fut, _ in batch:
+        if not fut.done():
+          fut.set_exception(err)
+    finally:
+      self._running.discard(key)
+      self._schedule_next(key)
+
+  def _schedule_next(self, key: str):
+    queue = self._pending.get(key)
+    if not queue:
+      return
+    waited = time.perf_counter() - queue[0][2]
+    if len(queue) >= self.max_batch_size or waited >= self.max_wait:
+      self._flush(key)
+    elif key not in self._timers:
+      self._timers[key] = asyncio.get_running_loop().call_later(self.max_wait - waited, self._flush, key)
+
+  def stats(self) -> dict[str, Any]:
+    return {
+      "max_batch_size": self.max_batch_size,
+      "max_wait_ms": self.max_wait * 1000,
+      "batches": self.n_batches,
+      "requests": self.n_requests,
+      "avg_batch_size": self.n_requests / self.n_batches if self.n_batches else 0,
+      "max_batch_seen": self.max_batch_seen,
+      "batch_size_hist": dict(sorted(self.batch_size_hist.items())),
+      "avg_queue_wait_ms": self.total_queue_wait / self.n_requests * 1000 if self.n_requests else 0,
+      "max_queue_wait_ms": self.max_queue_wait * 1000,
+      "pending": sum(len(q) for q in self._pending.values()),
+    }
@@ -0,0 +1,141 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from series_store import SeriesStore
+
+# Bump when the cache layout changes to invalidate the existing caches
+CACHE_FORMAT = 2
+
+
+# Binary cache of a dataset csv, stored in <csv>.cache/
+# values.npy: float64 matrix (timestamp x column), memory-mappable
+# index.npy: int64 timestamp in epoch nanoseconds
+# series.npy: float32 values of the first column, backing the SeriesStore
+# meta.json: column names and the size/mtime of the source csv for invalidation
+def cache_dir_of(csv_path: str | Path) -> Path:
+  return Path(f'{csv_path}.cache')
+
+
+def source_info(csv_path: str | Path) -> dict[str, int]:
+  stat = Path(csv_path).stat()
+  return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+def is_cache_valid(csv_path: str | Path) -> bool:
+  meta_path = cache_dir_of(csv_path) / 'meta.json'
+  if not meta_path.exists():
+    return False
+  try:
+    meta = json.loads(meta_path.read_text())
+  except ValueError:
+    return False
+  return meta.get('format') == CACHE_FORMAT and \
+    all(meta.get(k) == v for k, v in source_info(csv_path).items())
+
+
+def read_csv_dataset(csv_path: str | Path) -> pd.DataFrame:
+  data = pd.read_csv(csv_path)
+  data.index = pd.to_datetime(data['timestamp'])
+  data.drop('timestamp', axis=1, inplace=True)
+  return data
+
+
+def write_cache(csv_path: str | Path, data: pd.DataFrame):
+  cache_dir = cache_dir_of(csv_path)
+  # Build in a private directory then rename, so concurrent workers never read a partial cache
+  tmp_dir = Path(f'{cache_dir}.tmp-{os.getpid()}')
+  tmp_dir.mkdir(parents=True, exist_ok=True)
+  np.save(tmp_dir / 'values.npy', data.to_numpy(dtype=np.float64))
+  np.save(tmp_dir / 'index.npy', data.index.to_numpy(dtype='datetime64[ns]').view(np.int64))
+  np.save(tmp_dir / 'series.npy', data.iloc[:, 0].to_numpy(dtype=np.float32))
+  (tmp_dir / 'meta.json').write_text(json.dumps({
+    'format': CACHE_FORMAT,
+    'columns': data.columns.tolist(),
+    'index_name': data.index.name,
+    **source_info(csv_path),
+  }))
+  if cache_dir.exists():
+    shutil.rmtree(cache_dir, ignore_errors=True)
+  try:
+    os.rename(tmp_dir, cache_dir)
+  except OSError:
+    # Another worker has just published the cache
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+# All columns are restored as float64 in a single block, which is also what the model consumes
+def read_cache(csv_path: str | Path, mmap: bool = False) -> pd.DataFrame:
+  cache_dir = cache_dir_of(csv_path)
+  meta = json.loads((cache_dir / 'meta.json').read_text())
+  values = np.load(cache_dir / 'values.npy', mmap_mode='r' if mmap else None)
+  index = pd.DatetimeIndex(np.load(cache_dir / 'index.npy').view('datetime64[ns]'), name=meta['index_name'])
+  return pd.DataFrame(values, index=index, columns=meta['columns'], copy=False)
+
+
+def load_dataset(csv_path: str | Path, *, use_cache: bool = True, mmap: bool = False) -> pd.DataFrame:
+  name = Path(csv_path).name
+  if use_cache and is_cache_valid(csv_path):
+    start = time.perf_counter()
+    data = read_cache(csv_path, mmap)
+    print(f'Loaded {name} from binary cache in {time.perf_counter() - start:.3f}s', flush=True)
+    return data
+
+  start = time.perf_counter()
+  data = read_csv_dataset(csv_path)
+  csv_elapsed = time.perf_counter() - start
+  if not use_cache:
+    print(f'Loaded {name} from csv in {csv_elapsed:.3f}s', flush=True)
+    return data
+
+  write_cache(csv_path, data)
+  start = time.perf_counter()
+  data = read_cache(csv_path, mmap)
+  cache_elapsed = time.perf_counter() - start
+  print(f'Loaded {name} from csv in {csv_elapsed:.3f}s, built binary cache '
+        f'(loads in {cache_elapsed:.3f}s, {csv_elapsed / max(cache_elapsed, 1e-6):.1f}x faster)', flush=True)
+  return data
+
+
+def read_series_cache(csv_path: str | Path, mmap: bool = False) -> SeriesStore:
+  cache_dir = cache_dir_of(csv_path)
+  meta = json.loads((cache_dir / 'meta.json').read_text())
+  index = np.load(cache_dir / 'index.npy', mmap_mode='r')
+  step = int(index[1] - index[0])
+  if int(index[-1] - index[0]) != step * (len(index) - 1):
+    raise ValueError(f'{meta["columns"][0]} is not sampled at a fixed interval')
+  values = np.load(cache_dir / 'series.npy', mmap_mode='r' if mmap else None)
+  return SeriesStore(meta['columns'][0], int(index[0]), step, values)
+
+
+# Load the first column of the dataset as SeriesStore, from the binary cache unless use_cache is False
+def load_series(csv_path: str | Path, *, use_cache: bool = True, mmap: bool = False) -> SeriesStore:
+  if not use_cache:
+    return SeriesStore.from_frame(load_dataset(csv_path, use_cache=False))
+  if not is_cache_valid(csv_path):
+    # Parse the csv and build the cache
+    load_dataset(csv_path)
+  start = time.perf_counter()
+  store = read_series_cache(csv_path, mmap)
+  print(f'Loaded {Path(csv_path).name} series ({len(store)} points) in {time.perf_counter() - start:.3f}s', flush=True)
+  return store
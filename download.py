@@ -14,22 +14,39 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from io import BytesIO
 from pathlib import Path
 from typing import Any, Callable
 from aiocsv import AsyncWriter
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree.ElementTree import iterparse
 
+import os
+import time
+import random
+import argparse
 import asyncio
 import aiohttp
 import aiofile
 import xmltodict
 import dateutil.parser
 
+from shards import LAYOUTS, PARTITIONS, DEFAULT_BATCH_SIZE, ShardWriter
+
 # Define variable
 # For traffic data, the earliest available START_TIME = '2021-09-07T09:08'
 # For journey data, the earliest available START_TIME = '2021-05-27T08:53'
 REQUEST_LIMIT = 25
 CONCURRENT_LIMIT = 150
+# Historical archive API, can be pointed to a local stand-in server (see stub_server.py)
+ARCHIVE_URL = os.getenv('ARCHIVE_URL', 'https://api.data.gov.hk/v1/historical-archive/get-file')
+# Crawler retry policy
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_STATUS = {429, 500, 502, 503, 504}
+PROGRESS_INTERVAL = 10
 
 current = datetime.now()
 
@@ -47,10 +64,10 @@ OPTIONS: dict[str, Any] = {
   }
 }
 
-# Build data dir for traffic data
-for _, _content in OPTIONS.items():
-  _content['DATA_DIR'].mkdir(parents=True, exist_ok=True)
-
+RESOURCE_URLS = {
+  'traffic-data': 'https://resource.data.one.gov.hk/td/traffic-detectors/rawSpeedVol-all.xml',
+  'journey-data': 'https://resource.data.one.gov.hk/td/jss/Journeytimev2.xml',
+}
 
 # Generate timestamp in YYYYMMDD-HHMM from start_date to end_data (exclusive)
 def make_timestamp(start_date: str, end_data: str):
@@ -114,64 +131,165 @@ def process_journey_time_data(data: dict[str, Any]) -> (str, list[list[str]]):
   return timestamp, results
 
 
+# Map direction to id
+DIRECTION_ID = {
+  'North': 1, 'East': 2, 'South': 3, 'West': 4, 'North East': 1,
+  'South East': 2, 'North West': 3, 'South West': 4}
+TRAFFIC_DATA_HEADER = ['detector_id', 'direction', *[f'{k}_speed'
+                                                     for k in ['fast_lane', 'middle_lane_1', 'middle_lane_2',
+                                                               'slow_lane']]]
+JOURNEY_DATA_HEADER = ['location', 'destination', 'journey_time', 'color']
+
+
+# Streaming versions of process_*_data working on the raw document, same output without building the dict tree
+# Each element is cleared once its fields are read
+def extract_traffic_detectors_data(xml_data: bytes) -> dict[str, list[list[str]]]:
+  header = TRAFFIC_DATA_HEADER
+  lane_keys = header[2:]
+  results: dict[str, list[list[str]]] = {}
+  date = ''
+  period_from = period_to = ''
+  speed_data: list[list[str]] = []
+  lanes: dict[str, Any] = {}
+  lane_id = speed = None
+  for _, elem in iterparse(BytesIO(xml_data)):
+    match elem.tag:
+      case 'lane_id':
+        lane_id = elem.text
+      case 'speed':
+        speed = elem.text
+      case 'lane':
+        lanes[f'{lane_id.replace(" ", "_").lower()}_speed'] = speed
+        elem.clear()
+      case 'detector':
+        speed_data.append([elem.findtext('detector_id'), DIRECTION_ID[elem.findtext('direction')],
+                           *[lanes.get(k, 0) for k in lane_keys]])
+        lanes = {}
+        elem.clear()
+      case 'period_from':
+        period_from = elem.text
+      case 'period_to':
+        period_to = elem.text
+      case 'period':
+        results[f'{date}-{period_from.replace(":", "")}_{period_to.replace(":", "")}'] = [header, *speed_data]
+        speed_data = []
+        elem.clear()
+      case 'date':
+        date = elem.text.replace('-', '')
+  return results
+
+
+def extract_journey_time_data(xml_data: bytes) -> (str, list[list[str]]):
+  results: list[list[str]] = [JOURNEY_DATA_HEADER]
+  captured = ''
+  for _, elem in iterparse(BytesIO(xml_data)):
+    if elem.tag != 'jtis_journey_time':
+      continue
+    captured = elem.findtext('CAPTURE_DATE')
+    results.append([elem.findtext('LOCATION_ID'), elem.findtext('DESTINATION_ID'), elem.findtext('JOURNEY_DATA'),
+                    elem.findtext('COLOUR_ID')])
+    elem.clear()
+  timestamp: str = dateutil.parser.isoparse(captured).strftime('%Y%m%d-%H%M%S')
+  return timestamp, results
+
+
+EXTRACT_DATA = {
+  'traffic-data': extract_traffic_detectors_data,
+  'journey-data': extract_journey_time_data,
+}
+
+# Parsing runs in this process pool (created in __main__), so it never blocks the event loop
+parse_pool: ProcessPoolExecutor | None = None
+
+
+async def parse_data(dataset: str, xml_data: bytes) -> Any:
+  if parse_pool is None:
+    return EXTRACT_DATA[dataset](xml_data)
+  return await asyncio.get_running_loop().run_in_executor(parse_pool, EXTRACT_DATA[dataset], xml_data)
+
+
 sem = asyncio.BoundedSemaphore(REQUEST_LIMIT)
+# The journey data is appended to Parquet shards instead of one csv per minute when set (--output long|wide)
+shard_writer: ShardWriter | None = None
+
+
+async def write_csv(output_file: Path, rows: list[list[Any]]):
+  async with aiofile.async_open(output_file, 'w') as f:
+    writer = AsyncWriter(f)
+    await writer.writerows(rows)
+
+
+# Save the parsed traffic data, return the number of files written
+async def save_traffic_detectors_data(speed_data: dict[str, list[list[str]]], timestamp: str,
+                                      verbose: bool = True) -> int:
+  n = 0
+  for title, content in speed_data.items():
+    output_file = Path(OPTIONS['traffic-data']['DATA_DIR'], title + '.csv')
+    if output_file.exists():
+      if verbose:
+        print(f'Duplicated file {output_file} (#timestamp={timestamp})')
+      continue
+    if verbose:
+      print(f'Download {output_file} (#timestamp={timestamp})')
+    await write_csv(output_file, content)
+    n += 1
+  return n
+
+
+async def save_journey_time_data(content: (str, list[list[str]]), timestamp: str, verbose: bool = True) -> int:
+  title, journey_data = content
+  if shard_writer is not None:
+    if verbose:
+      print(f'Buffer {title} for {shard_writer.root} (#timestamp={timestamp})')
+    shard_writer.add(title, journey_data)
+    return 1
+  output_file = Path(OPTIONS['journey-data']['DATA_DIR'], title + '.csv')
+  if output_file.exists():
+    if verbose:
+      print(f'Duplicated file {output_file} (#timestamp={timestamp})')
+    return 0
+  if verbose:
+    print(f'Download {output_file} (#timestamp={timestamp})')
+  await write_csv(output_file, journey_data)
+  return 1
+
+
+SAVE_DATA = {
+  'traffic-data': save_traffic_detectors_data,
+  'journey-data': save_journey_time_data,
+}
 
 
 # Fetch traffic data
 async def fetch_traffic_detectors_data(timestamp: str):
   async with sem, aiohttp.ClientSession() as client:
-    async with client.get(url='https://api.data.gov.hk/v1/historical-archive/get-file',
-                          params={'url': 'https://resource.data.one.gov.hk/td/traffic-detectors/rawSpeedVol-all.xml',
-                                  'time': timestamp}) as res:
+    async with client.get(url=ARCHIVE_URL, params={'url': RESOURCE_URLS['traffic-data'], 'time': timestamp}) as res:
       if not res.ok:
         print(f'Unable to fetch traffic detectors data (#timestamp={timestamp})')
         return
 
       try:
-        xml_data = await res.text()
-        data: dict[str, Any] = xmltodict.parse(xml_data, xml_attribs=False)
-        speed_data = process_traffic_detectors_data(data)
+        xml_data = await res.read()
+        await save_traffic_detectors_data(await parse_data('traffic-data', xml_data), timestamp)
       except:
         print(f'Invalid traffic data (#timestamp={timestamp})')
         return
 
-  for title, content in speed_data.items():
-    output_file = Path(OPTIONS['traffic-data']['DATA_DIR'], title + '.csv')
-    if output_file.exists():
-      print(f'Duplicated file {output_file} (#timestamp={timestamp})')
-      continue
-    print(f'Download {output_file} (#timestamp={timestamp})')
-    async with aiofile.async_open(output_file, 'w') as f:
-      writer = AsyncWriter(f)
-      await writer.writerows(content)
-
 
 async def fetch_journey_time_data(timestamp: str):
   async with sem, aiohttp.ClientSession() as client:
-    async with client.get(url='https://api.data.gov.hk/v1/historical-archive/get-file',
-                          params={'url': 'https://resource.data.one.gov.hk/td/jss/Journeytimev2.xml',
-                                  'time': timestamp}) as res:
+    async with client.get(url=ARCHIVE_URL, params={'url': RESOURCE_URLS['journey-data'], 'time': timestamp}) as res:
       if not res.ok:
         print(f'Unable to fetch traffic detectors data (#timestamp={timestamp})')
         return
 
       try:
-        xml_data = await res.text()
-        data: dict[str, Any] = xmltodict.parse(xml_data, xml_attribs=False)
-        title, journey_data = process_journey_time_data(data)
+        xml_data = await res.read()
+        await save_journey_time_data(await parse_data('journey-data', xml_data), timestamp)
       except:
         print(f'Invalid traffic data (#timestamp={timestamp})')
         return
 
-  output_file = Path(OPTIONS['journey-data']['DATA_DIR'], title + '.csv')
-  if output_file.exists():
-    print(f'Duplicated file {output_file} (#timestamp={timestamp})')
-    return
-  print(f'Download {output_file} (#timestamp={timestamp})')
-  async with aiofile.async_open(output_file, 'w') as f:
-    writer = AsyncWriter(f)
-    await writer.writerows(journey_data)
-
 
 def fetch_data(dataset: str, timestamp: str):
   match dataset:
@@ -183,6 +301,216 @@ def fetch_data(dataset: str, timestamp: str):
       raise Exception('Undefined datasets.')
 
 
+# Completion bitmap of a crawl, bit i is set once the i-th minute since start_time is done
+# Stored as <DATA_DIR>/.manifest-<start>-<end> (~64KB for a year), so resuming never stats the output files
+class Manifest:
+  def __init__(self, path: Path, total: int):
+    self.path = path
+    self.total = total
+    self.bits = bytearray((total + 7) // 8)
+    if path.exists():
+      data = path.read_bytes()
+      if len(data) == len(self.bits):
+        self.bits[:] = data
+    self.dirty = False
+
+  @classmethod
+  def of(cls, data_dir: Path, start_time: str, end_time: str, total: int) -> 'Manifest':
+    name = f'.manifest-{start_time}-{end_time}'.replace(':', '')
+    return cls(Path(data_dir, name), total)
+
+  def __contains__(self, idx: int) -> bool:
+    return bool(self.bits[idx >> 3] & (1 << (idx & 7)))
+
+  def add(self, idx: int):
+    self.bits[idx >> 3] |= 1 << (idx & 7)
+    self.dirty = True
+
+  # Write atomically, so an interrupted crawl never leaves a truncated manifest
+  def save(self):
+    if not self.dirty:
+      return
+    tmp = self.path.with_name(self.path.name + '.tmp')
+    tmp.write_bytes(self.bits)
+    os.replace(tmp, self.path)
+    self.dirty = False
+
+
+class RetryableError(Exception):
+  def __init__(self, message: str, retry_after: float | None = None):
+    super().__init__(message)
+    self.retry_after = retry_after
+
+
+# Seconds to wait from a Retry-After header, either delay-seconds or an HTTP-date
+# None if it cannot be parsed, so the crawler falls back to its exponential backoff
+def parse_retry_after(value: str | None) -> float | None:
+  if not value:
+    return None
+  try:
+    return max(float(value), 0.0)
+  except ValueError:
+    pass
+  try:
+    retry_at = parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return None
+  if retry_at.tzinfo is None:
+    retry_at = retry_at.replace(tzinfo=timezone.utc)
+  return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+# Crawl one dataset with a single pooled session and REQUEST_LIMIT workers pulling from a queue,
+# so a slow request only holds its own worker
+# Transient failures (connection errors, timeouts, 429 and 5xx) are retried with exponential backoff,
+# the timestamps still failing after MAX_RETRIES are left out of the manifest and retried on the next run
+class Crawler:
+  def __init__(self, dataset: str, start_time: str, end_time: str, *, workers: int = REQUEST_LIMIT,
+               archive_url: str = ARCHIVE_URL, verbose: bool = False):
+    self.dataset = dataset
+    self.start = dateutil.parser.isoparse(start_time)
+    self.total = int((dateutil.parser.isoparse(end_time) - self.start) / timedelta(minutes=1))
+    self.workers = workers
+    self.archive_url = archive_url
+    self.verbose = verbose
+    data_dir = OPTIONS[dataset]['DATA_DIR']
+    data_dir.mkdir(parents=True, exist_ok=True)
+    self.manifest = Manifest.of(data_dir, start_time, end_time, self.total)
+    self.counts = {'saved': 0, 'duplicated': 0, 'missing': 0, 'invalid': 0, 'failed': 0, 'retries': 0}
+
+  async def run(self):
+    pending = [idx for idx in range(self.total) if idx not in self.manifest]
+    print(f'Crawling {self.dataset}: {len(pending)} of {self.total} timestamps remaining', flush=True)
+    queue: asyncio.Queue[int] = asyncio.Queue(maxsize=self.workers * 4)
+    connector = aiohttp.TCPConnector(limit=self.workers)
+    timeout = aiohttp.ClientTimeout(total=60)
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as client:
+      workers = [asyncio.create_task(self.worker(client, queue)) for _ in range(self.workers)]
+      progress = asyncio.create_task(self.report(started, len(pending)))
+      try:
+        for idx in pending:
+          await queue.put(idx)
+        await queue.join()
+      finally:
+        for task in (*workers, progress):
+          task.cancel()
+        await asyncio.gather(*workers, progress, return_exceptions=True)
+        self.checkpoint()
+    self.print_progress(started, len(pending))
+
+  async def worker(self, client: aiohttp.ClientSession, queue: asyncio.Queue):
+    while True:
+      idx = await queue.get()
+      try:
+        await self.fetch(client, idx)
+      finally:
+        queue.task_done()
+
+  async def fetch(self, client: aiohttp.ClientSession, idx: int):
+    timestamp = (self.start + timedelta(minutes=idx)).strftime('%Y%m%d-%H%M')
+    params = {'url': RESOURCE_URLS[self.dataset], 'time': timestamp}
+    for attempt in range(MAX_RETRIES + 1):
+      try:
+        async with client.get(self.archive_url, params=params) as res:
+          if res.status in RETRY_STATUS:
+            raise RetryableError(f'HTTP {res.status}', parse_retry_after(res.headers.get('Retry-After')))
+          if not res.ok:
+            # No archive for this minute
+            self.counts['missing'] += 1
+            break
+          xml_data = await res.read()
+      except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError) as err:
+        if attempt == MAX_RETRIES:
+          self.counts['failed'] += 1
+          print(f'Unable to fetch {self.dataset} after {MAX_RETRIES} retries: {err} (#timestamp={timestamp})',
+                flush=True)
+          return
+        self.counts['retries'] += 1
+        delay = getattr(err, 'retry_after', None) or RETRY_BASE_DELAY * 2 ** attempt
+        await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        continue
+
+      try:
+        saved = await SAVE_DATA[self.dataset](await parse_data(self.dataset, xml_data), timestamp, self.verbose)
+        self.counts['saved' if saved else 'duplicated'] += 1
+      except Exception:
+        print(f'Invalid {self.dataset} (#timestamp={timestamp})', flush=True)
+        self.counts['invalid'] += 1
+      break
+    self.manifest.add(idx)
+
+  async def report(self, started: float, n: int):
+    while True:
+      await asyncio.sleep(PROGRESS_INTERVAL)
+      self.checkpoint()
+      self.print_progress(started, n)
+
+  # Flush the buffered shards before saving the manifest, so every timestamp marked done is on disk
+  def checkpoint(self):
+    if shard_writer is not None:
+      shard_writer.flush()
+    self.manifest.save()
+
+  def print_progress(self, started: float, n: int):
+    done = sum(v for k, v in self.counts.items() if k != 'retries')
+    elapsed = time.perf_counter() - started
+    rate = done / elapsed if elapsed > 0 else 0
+    eta = timedelta(seconds=int((n - done) / rate)) if rate > 0 else '-'
+    counts = ', '.join(f'{k}={v}' for k, v in self.counts.items())
+    print(f'[{self.dataset}] {done}/{n} ({done / max(n, 1):.1%}) {rate:.1f} req/s, ETA {eta} ({counts})', flush=True)
+
+
+# Compare the records/sec of xmltodict + process_*_data with the streaming extractors, inline and in a process pool
+def benchmark_parse(n: int, workers: int):
+  from stub_server import journey_time_xml, traffic_detectors_xml
+
+  process_data = {
+    'traffic-data': process_traffic_detectors_data,
+    'journey-data': process_journey_time_data,
+  }
+  count_records = {
+    'traffic-data': lambda result: sum(len(rows) - 1 for rows in result.values()),
+    'journey-data': lambda result: len(result[1]) - 1,
+  }
+  generate = {
+    'traffic-data': traffic_detectors_xml,
+    'journey-data': journey_time_xml,
+  }
+  start_time = datetime(2022, 1, 1)
+  for dataset in RESOURCE_URLS:
+    docs = [generate[dataset](start_time + timedelta(minutes=i)).encode() for i in range(n)]
+    reference = [process_data[dataset](xmltodict.parse(doc, xml_attribs=False)) for doc in docs[:5]]
+    assert reference == [EXTRACT_DATA[dataset](doc) for doc in docs[:5]], f'{dataset} extractor output differs'
+    n_records = sum(count_records[dataset](EXTRACT_DATA[dataset](doc)) for doc in docs)
+
+    start = time.perf_counter()
+    for doc in docs:
+      process_data[dataset](xmltodict.parse(doc, xml_attribs=False))
+    baseline = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for doc in docs:
+      EXTRACT_DATA[dataset](doc)
+    streaming = time.perf_counter() - start
+
+    with ProcessPoolExecutor(workers) as pool:
+      list(pool.map(EXTRACT_DATA[dataset], docs[:workers]))
+      start = time.perf_counter()
+      list(pool.map(EXTRACT_DATA[dataset], docs, chunksize=max(1, n // (workers * 4))))
+      pooled = time.perf_counter() - start
+
+    size = sum(len(doc) for doc in docs) / n / 1024
+    print(f'{dataset} ({n} documents, {size:.0f}KiB, {n_records // n} records each):', flush=True)
+    for name, elapsed in [('xmltodict', baseline), ('iterparse', streaming), (f'iterparse x{workers}', pooled)]:
+      print(f'  {name:<14} {n_records / elapsed:>12,.0f} records/s {n / elapsed:>8,.1f} docs/s', flush=True)
+
+
+async def crawl_all(workers: int, verbose: bool):
+  for dataset, content in OPTIONS.items():
+    await Crawler(dataset, content['START_TIME'], content['END_TIME'], workers=workers, verbose=verbose).run()
+
+
 async def fetch_all():
   tasks = []
   n = 0
@@ -198,9 +526,51 @@ async def fetch_all():
 
 
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Download the historical traffic data archive')
+  parser.add_argument('--legacy', action='store_true', help='Fetch in lock-step batches of CONCURRENT_LIMIT')
+  parser.add_argument('--start-time', help='Override START_TIME of every dataset')
+  parser.add_argument('--end-time', help='Override END_TIME of every dataset')
+  parser.add_argument('--workers', type=int, default=REQUEST_LIMIT, help='Concurrent requests of the crawler')
+  parser.add_argument('-v', '--verbose', action='store_true', help='Print every downloaded file')
+  parser.add_argument('--output', choices=['csv', *LAYOUTS], default='csv',
+                      help='Write the journey data to one csv per minute, or long/wide Parquet shards')
+  parser.add_argument('--partition', choices=PARTITIONS, default='day', help='Time span of each shard')
+  parser.add_argument('--shard-dir', type=Path, default=Path('data/journey-shards'))
+  parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Records buffered before a flush')
+  parser.add_argument('--parse-workers', type=int, default=os.cpu_count(), help='Processes parsing the XML')
+  parser.add_argument('--benchmark-parse', type=int, metavar='N', help='Benchmark the XML parsing on N documents')
+  args = parser.parse_args()
+
+  if args.benchmark_parse:
+    benchmark_parse(args.benchmark_parse, args.parse_workers)
+    exit(0)
+
+  # Build data dir for traffic data
+  for _, _content in OPTIONS.items():
+    _content['DATA_DIR'].mkdir(parents=True, exist_ok=True)
+    if args.start_time:
+      _content['START_TIME'] = args.start_time
+    if args.end_time:
+      _content['END_TIME'] = args.end_time
+
+  parse_pool = ProcessPoolExecutor(args.parse_workers) if args.parse_workers > 0 else None
+  if args.output != 'csv':
+    shard_writer = ShardWriter(args.shard_dir, layout=args.output, partition=args.partition,
+                               batch_size=args.batch_size)
   loop = asyncio.new_event_loop()
   asyncio.set_event_loop(loop)
+  main = loop.create_task(fetch_all() if args.legacy else crawl_all(args.workers, args.verbose))
   try:
-    loop.run_until_complete(fetch_all())
+    loop.run_until_complete(main)
   except KeyboardInterrupt:
+    # Let the crawler save its manifest
+    main.cancel()
+    loop.run_until_complete(asyncio.gather(main, return_exceptions=True))
     print('Interrupted by keyboard')
+  finally:
+    if parse_pool is not None:
+      parse_pool.shutdown(cancel_futures=True)
+    if shard_writer is not None:
+      shard_writer.close()
+      print(f'Wrote {shard_writer.n_records} rows to {shard_writer.root} in {shard_writer.n_parts} parts '
+            f'(flush {shard_writer.flush_time:.2f}s)', flush=True)
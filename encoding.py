@@ -0,0 +1,108 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import io
+import json
+from typing import Any
+
+import numpy as np
+from fastapi import Response
+
+# Optional faster serializers
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  import pyarrow as pa
+except ImportError:
+  pa = None
+
+# Response formats of /fetch and /predict
+# json: the default schema with one ISO timestamp per point
+# compact: start time and step instead of the timestamp array
+# binary: little-endian float32 values, the time axis is described by the X-* headers
+# arrow: Arrow IPC stream with timestamp and value columns (requires pyarrow)
+MEDIA_TYPES = {
+  'json': 'application/json',
+  'compact': 'application/vnd.fyp.compact+json',
+  'binary': 'application/octet-stream',
+  'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+
+def available_formats() -> list[str]:
+  return [fmt for fmt in MEDIA_TYPES if fmt != 'arrow' or pa is not None]
+
+
+# Select the response format from the format query parameter, then the Accept header
+def negotiate(fmt: str | None, accept: str | None) -> str | None:
+  formats = available_formats()
+  if fmt is not None:
+    return fmt if fmt in formats else None
+  if not accept:
+    return 'json'
+  for media_range in accept.split(','):
+    media_type = media_range.split(';')[0].strip()
+    if media_type in ('*/*', 'application/*'):
+      return 'json'
+    for name in formats:
+      if MEDIA_TYPES[name] == media_type:
+        return name
+  return None
+
+
+# JSON response serialized by orjson when installed, skipping FastAPI's jsonable_encoder
+# The content must only contain JSON native types
+class FastJSONResponse(Response):
+  media_type = 'application/json'
+
+  def render(self, content: Any) -> bytes:
+    if orjson is not None:
+      return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+def time_axis(start_ns: int, step_ns: int, n: int) -> np.ndarray:
+  return start_ns + np.arange(n, dtype=np.int64) * step_ns
+
+
+def iso_times(times_ns: np.ndarray) -> list[str]:
+  return np.datetime_as_string(np.asarray(times_ns, dtype=np.int64).view('datetime64[ns]'), unit='s').tolist()
+
+
+def iso_timestamps(start_ns: int, step_ns: int, n: int) -> list[str]:
+  return iso_times(time_axis(start_ns, step_ns, n))
+
+
+def binary_response(values: list[np.ndarray], headers: dict[str, str]) -> Response:
+  content = b''.join(np.ascontiguousarray(v, dtype='<f4').tobytes() for v in values)
+  return Response(content=content, media_type=MEDIA_TYPES['binary'], headers=headers)
+
+
+# Arrow IPC stream of one record batch per (name, times_ns, values) series
+def arrow_response(series: list[tuple[str, np.ndarray, np.ndarray]], headers: dict[str, str]) -> Response:
+  sink = io.BytesIO()
+  schema = pa.schema([('series', pa.string()), ('timestamp', pa.timestamp('ns')), ('value', pa.float32())])
+  with pa.ipc.new_stream(sink, schema) as writer:
+    for name, times, values in series:
+      times = np.asarray(times, dtype=np.int64)
+      writer.write_batch(pa.record_batch([
+        pa.array([name] * len(values), pa.string()),
+        pa.array(times.view('datetime64[ns]')),
+        pa.array(np.asarray(values, dtype=np.float32)),
+      ], schema=schema))
+  return Response(content=sink.getvalue(), media_type=MEDIA_TYPES['arrow'], headers=headers)
@@ -0,0 +1,111 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import threading
+import time
+from concurrent.futures import Executor, Future
+from typing import Any, Callable, NamedTuple
+
+
+class ExecutorBusy(Exception):
+  pass
+
+
+class Timing(NamedTuple):
+  # Seconds between submission and start of execution
+  queue_wait: float
+  # Seconds spent executing
+  exec_time: float
+
+
+# Executor with a bounded number of queued and running tasks
+# Submitting when max_workers + max_queue tasks are pending raises ExecutorBusy instead of growing the queue
+# The underlying pool (thread or process pool) must have max_workers workers
+class BoundedExecutor(Executor):
+  def __init__(self, pool: Executor, max_workers: int, max_queue: int):
+    self.pool = pool
+    self.max_workers = max_workers
+    self.max_queue = max_queue
+    self._lock = threading.Lock()
+    self._pending = 0
+    # Statistics
+    self.n_submitted = 0
+    self.n_rejected = 0
+    self.total_queue_wait = 0.0
+    self.max_queue_wait = 0.0
+    self.total_exec_time = 0.0
+
+  @property
+  def pending(self) -> int:
+    return self._pending
+
+  def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+    with self._lock:
+      if self._pending >= self.max_workers + self.max_queue:
+        self.n_rejected += 1
+        raise ExecutorBusy(f'{self._pending} tasks are pending')
+      self._pending += 1
+      self.n_submitted += 1
+    fut = self.pool.submit(_timed_call, time.perf_counter(), fn, args, kwargs)
+    fut.add_done_callback(self._on_done)
+    return fut
+
+  def _on_done(self, fut: Future):
+    with self._lock:
+      self._pending -= 1
+      if not fut.cancelled() and fut.exception() is None:
+        _, timing = fut.result()
+        self.total_queue_wait += timing.queue_wait
+        self.max_queue_wait = max(self.max_queue_wait, timing.queue_wait)
+        self.total_exec_time += timing.exec_time
+
+  # Run fn in the pool from a coroutine, return the result with its timing
+  async def run(self, fn: Callable, /, *args, **kwargs) -> tuple[Any, Timing]:
+    return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+  def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+    self.pool.shutdown(wait, cancel_futures=cancel_futures)
+
+  def stats(self) -> dict[str, Any]:
+    completed = self.n_submitted - self._pending
+    return {
+      "max_workers": self.max_workers,
+      "max_queue": self.max_queue,
+      "pending": self._pending,
+      "submitted": self.n_submitted,
+      "rejected": self.n_rejected,
+      "avg_queue_wait_ms": self.total_queue_wait / completed * 1000 if completed else 0,
+      "max_queue_wait_ms": self.max_queue_wait * 1000,
+      "avg_exec_ms": self.total_exec_time / completed * 1000 if completed else 0,
+    }
+
+
+def _timed_call(submitted: float, fn: Callable, args: tuple, kwargs: dict) -> tuple[Any, Timing]:
+  start = time.perf_counter()
+  result = fn(*args, **kwargs)
+  return result, Timing(start - submitted, time.perf_counter() - start)
+
+
+def server_timing(**timings: Timing | float) -> str:
+  # Format the Server-Timing response header
+  parts = []
+  for name, value in timings.items():
+    if isinstance(value, Timing):
+      parts.append(f'{name}-queue;dur={value.queue_wait * 1000:.2f}')
+      parts.append(f'{name}-exec;dur={value.exec_time * 1000:.2f}')
+    else:
+      parts.append(f'{name};dur={value * 1000:.2f}')
+  return ', '.join(parts)
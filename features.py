@@ -0,0 +1,158 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import math
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from series_store import MINUTE_NS
+
+STEP_NS = 5 * MINUTE_NS
+# Rolling mean window and its shift (the smoothed point i is the mean of the points [i - 3, i + 2])
+WINDOW = 6
+SHIFT = 2
+
+
+# Journey time feature of one road, as built by merge_dataset.py
+def batch_features(raw: pd.Series) -> pd.Series:
+  data = raw.resample('5Min').interpolate(method='time').iloc[1:]
+  mean = data.mean()
+  data = data.replace(-1, mean)
+  return data.rolling(WINDOW).mean().shift(periods=-SHIFT).fillna(mean)
+
+
+# Incremental version of batch_features, consuming the raw observations of one road in time order
+# 1. resample('5Min').interpolate(method='time'): only the observations exactly on the 5-minute grid are used,
+#    the grid points in between are interpolated in time, the ones after the last observation hold its value
+# 2. the first grid point is dropped (iloc[1:])
+# 3. -1 (unavailable) is replaced with the mean
+# 4. rolling(6).mean().shift(-2).fillna(mean): the mean of the points [i - 3, i + 2], or the mean if incomplete
+# A point is emitted once the grid point two steps after it is known, so the output lags the input by
+# two steps (plus the wait for the next observation on the grid)
+# mean is the mean of the whole history in the batch script, which is not known while streaming,
+# pass it to reproduce batch_features exactly, otherwise the running mean of the points so far is used
+class StreamingFeatures:
+  def __init__(self, mean: float | None = None, *, emit_warmup: bool = True):
+    self.fixed_mean = mean
+    # Emit the points smoothed over an incomplete window (filled with the mean by the batch script)
+    self.emit_warmup = emit_warmup
+    # Time of the last observation and the last one on the grid (time, value)
+    self._last_time: int | None = None
+    self._last_grid: tuple[int, float] | None = None
+    # Next grid point to resolve and the number of grid points resolved
+    self._next: int | None = None
+    self._n = 0
+    # Last WINDOW points (time, value), -1 replaced
+    self._window: deque[tuple[int, float]] = deque(maxlen=WINDOW)
+    # Running mean of the resampled points
+    self._sum = 0.0
+    self._count = 0
+
+  @property
+  def mean(self) -> float:
+    if self.fixed_mean is not None:
+      return self.fixed_mean
+    return self._sum / self._count if self._count else math.nan
+
+  # Consume the observation at time_ns (epoch nanoseconds), return the points (time_ns, value) finalized by it
+  def push(self, time_ns: int, value: float) -> list[tuple[int, float]]:
+    if self._last_time is not None and time_ns <= self._last_time:
+      return []
+    self._last_time = time_ns
+    if self._next is None:
+      self._next = time_ns // STEP_NS * STEP_NS
+    if time_ns % STEP_NS != 0:
+      return []
+
+    out: list[tuple[int, float]] = []
+    last = self._last_grid
+    if last is not None:
+      # Same arithmetic as np.interp on the float64 nanoseconds used by pandas
+      t0, v0 = float(last[0]), last[1]
+      slope = (value - v0) / (float(time_ns) - t0)
+    for t in range(self._next, time_ns, STEP_NS):
+      self._resolve(t, math.nan if last is None else slope * (float(t) - t0) + v0, out)
+    self._resolve(time_ns, float(value), out)
+    self._last_grid = (time_ns, float(value))
+    self._next = time_ns + STEP_NS
+    return out
+
+  # End of the input, return the remaining points as the batch script does at the end of the data
+  def flush(self) -> list[tuple[int, float]]:
+    out: list[tuple[int, float]] = []
+    if self._next is None:
+      return out
+    hold = self._last_grid[1] if self._last_grid is not None else math.nan
+    for t in range(self._next, self._last_time // STEP_NS * STEP_NS + STEP_NS, STEP_NS):
+      self._resolve(t, hold, out)
+    self._next = self._last_time // STEP_NS * STEP_NS + STEP_NS
+    # The last SHIFT points have no complete window
+    for t, _ in list(self._window)[-SHIFT:]:
+      if self.emit_warmup:
+        out.append((t, self.mean))
+    return out
+
+  def _resolve(self, t: int, value: float, out: list[tuple[int, float]]):
+    self._n += 1
+    if self._n == 1:
+      # The first grid point is dropped
+      return
+    if not math.isnan(value):
+      self._sum += value
+      self._count += 1
+    self._window.append((t, self.mean if value == -1 else value))
+    if self._n - 1 <= SHIFT:
+      return
+    time_ns = t - SHIFT * STEP_NS
+    values = [v for _, v in self._window]
+    if len(values) == WINDOW and not any(math.isnan(v) for v in values):
+      out.append((time_ns, sum(values) / WINDOW))
+    elif self.emit_warmup:
+      out.append((time_ns, self.mean))
+
+
+# Compare the streaming features with the batch script on the raw merged dataset
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Check the streaming features against merge_dataset.py')
+  parser.add_argument('--raw', default='data/journal_time_data_hk.csv', help='Raw journey time written by merge_dataset.py')
+  parser.add_argument('--column', nargs='+', default=['K02-CH', 'K02-EH', 'K03-WH'])
+  args = parser.parse_args()
+
+  raw = pd.read_csv(args.raw, index_col='timestamp', parse_dates=['timestamp'])
+  for column in args.column:
+    series = raw[column].astype(np.float64)
+    start = time.perf_counter()
+    expected = batch_features(series)
+    batch_elapsed = time.perf_counter() - start
+
+    engine = StreamingFeatures(mean=series.resample('5Min').interpolate(method='time').iloc[1:].mean())
+    times = series.index.to_numpy(dtype='datetime64[ns]').view(np.int64).tolist()
+    values = series.to_numpy().tolist()
+    start = time.perf_counter()
+    result = [p for t, v in zip(times, values) for p in engine.push(t, v)]
+    result += engine.flush()
+    stream_elapsed = time.perf_counter() - start
+
+    result_index = pd.DatetimeIndex(np.array([t for t, _ in result], dtype='datetime64[ns]'))
+    result_values = np.array([v for _, v in result])
+    same_index = result_index.equals(expected.index.as_unit('ns'))
+    diff = np.max(np.abs(result_values - expected.to_numpy())) if same_index else math.nan
+    print(f'{column}: {len(result)} points, same index={same_index}, max diff={diff:.3g}, '
+          f'batch={batch_elapsed:.3f}s, streaming={stream_elapsed / len(series) * 1e6:.2f}us per observation',
+          flush=True)
@@ -0,0 +1,76 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
+
+import numpy as np
+
+# Approximate bookkeeping cost of one entry (key tuple, timestamp, ndarray header and dict node)
+ENTRY_OVERHEAD = 256
+
+
+# Bounded LRU cache of forecast results
+# The memory budget counts the result arrays plus a fixed per-entry overhead
+class ForecastCache:
+  def __init__(self, max_bytes: int):
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries: OrderedDict[Hashable, np.ndarray] = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key: Hashable) -> np.ndarray | None:
+    with self._lock:
+      value = self._entries.get(key)
+      if value is None:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def put(self, key: Hashable, value: np.ndarray):
+    size = value.nbytes + ENTRY_OVERHEAD
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self.nbytes -= old.nbytes + ENTRY_OVERHEAD
+      self._entries[key] = value
+      self.nbytes += size
+      while self.nbytes > self.max_bytes:
+        _, evicted = self._entries.popitem(last=False)
+        self.nbytes -= evicted.nbytes + ENTRY_OVERHEAD
+        self.evictions += 1
+
+  def __len__(self):
+    return len(self._entries)
+
+  def stats(self) -> dict[str, Any]:
+    lookups = self.hits + self.misses
+    return {
+      "entries": len(self._entries),
+      "bytes": self.nbytes,
+      "max_bytes": self.max_bytes,
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_ratio": self.hits / lookups if lookups else 0,
+      "evictions": self.evictions,
+    }
@@ -0,0 +1,186 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+# Tolerance of the engine outputs against Model.predict
+ATOL = 1e-4
+RTOL = 1e-4
+
+
+# Engines take a batch of model inputs (batch, n_steps, n_features) and return the (batch, n_horizon) forecasts
+# TensorFlow is imported lazily, so importing this module does not load the runtime
+
+# Model.predict, builds a data adapter and runs the predict loop on each call
+class PredictEngine:
+  name = 'predict'
+
+  def __init__(self, model: Any):
+    self.model = model
+
+  def __call__(self, x: np.ndarray) -> np.ndarray:
+    return self.model.predict(x, verbose=0)
+
+
+# Call the model directly in eager mode
+class CallEngine:
+  name = 'call'
+
+  def __init__(self, model: Any):
+    self.model = model
+
+  def __call__(self, x: np.ndarray) -> np.ndarray:
+    return self.model(np.asarray(x, dtype=np.float32), training=False).numpy()
+
+
+# Call the model through a tf.function traced once for any batch size
+class FunctionEngine:
+  name = 'function'
+
+  def __init__(self, model: Any):
+    import tensorflow as tf
+    self.model = model
+    spec = tf.TensorSpec([None, *model.input_shape[1:]], tf.float32)
+    self._fn = tf.function(lambda x: model(x, training=False), input_signature=[spec])
+
+  def __call__(self, x: np.ndarray) -> np.ndarray:
+    return self._fn(np.asarray(x, dtype=np.float32)).numpy()
+
+
+ENGINES = {
+  'predict': PredictEngine,
+  'call': CallEngine,
+  'function': FunctionEngine,
+}
+
+# Reduced-precision variants converted by quantize.py, float32 is the Keras model itself
+# float16: float16 weights, int8: dynamic-range int8 weights (activations stay float32)
+MODEL_VARIANTS = ('float32', 'float16', 'int8')
+
+
+def tflite_path(model_dir: str | Path, tunnel: str, variant: str) -> Path:
+  return Path(model_dir, tunnel, f'model-{variant}.tflite')
+
+
+# Standalone TF-Lite interpreter (LiteRT, then tflite_runtime), so serving the variants never imports TensorFlow
+def tflite_interpreter() -> Any:
+  try:
+    from ai_edge_litert.interpreter import Interpreter
+  except ImportError:
+    try:
+      from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+      from tensorflow.lite.python.interpreter import Interpreter
+  return Interpreter
+
+
+# Run a TF-Lite model converted by quantize.py
+# An interpreter is not thread-safe, each inference thread gets its own, resized to the batch size of the call
+class TFLiteEngine:
+  name = 'tflite'
+
+  def __init__(self, path: str | Path):
+    self._interpreter_type = tflite_interpreter()
+    self.model_content = Path(path).read_bytes()
+    self._local = threading.local()
+
+  def __call__(self, x: np.ndarray) -> np.ndarray:
+    local = self._local
+    if not hasattr(local, 'interpreter'):
+      local.interpreter = self._interpreter_type(model_content=self.model_content)
+      local.input = local.interpreter.get_input_details()[0]['index']
+      local.output = local.interpreter.get_output_details()[0]['index']
+      local.shape = None
+    interpreter = local.interpreter
+    if local.shape != x.shape:
+      interpreter.resize_tensor_input(local.input, x.shape)
+      interpreter.allocate_tensors()
+      local.shape = x.shape
+    interpreter.set_tensor(local.input, np.asarray(x, dtype=np.float32))
+    interpreter.invoke()
+    return interpreter.get_tensor(local.output).copy()
+
+
+# Run every engine on sample and return the maximum absolute difference against Model.predict
+def verify_engines(model: Any, sample: np.ndarray, engines: list[str] | None = None) -> dict[str, float]:
+  reference = PredictEngine(model)(sample)
+  return {
+    name: float(np.max(np.abs(ENGINES[name](model)(sample) - reference)))
+    for name in (engines or ENGINES)
+  }
+
+
+# Create the engine, warm it up with sample (traces the tf.function) and check it against Model.predict
+# Fall back to Model.predict if its output is not numerically equivalent
+def create_engine(name: str, model: Any, sample: np.ndarray, label: str = ''):
+  if name not in ENGINES:
+    raise ValueError(f'Unknown inference engine {name}, available engines: {", ".join(ENGINES)}')
+  engine = ENGINES[name](model)
+  engine(sample[:1])
+  result = engine(sample)
+  reference = result if name == 'predict' else PredictEngine(model)(sample)
+  diff = float(np.max(np.abs(result - reference)))
+  if not np.allclose(result, reference, rtol=RTOL, atol=ATOL):
+    print(f'{label} inference engine {name} differs from predict (max diff={diff}), using predict', flush=True)
+    return PredictEngine(model)
+  print(f'{label} using inference engine {name} (max diff={diff:.2e})', flush=True)
+  return engine
+
+
+def benchmark(engine, sample: np.ndarray, n: int = 200) -> dict[str, float]:
+  for _ in range(5):
+    engine(sample)
+  latency = np.empty(n)
+  for i in range(n):
+    start = time.perf_counter()
+    engine(sample)
+    latency[i] = time.perf_counter() - start
+  latency *= 1000
+  return {
+    'mean_ms': float(latency.mean()),
+    'p50_ms': float(np.percentile(latency, 50)),
+    'p99_ms': float(np.percentile(latency, 99)),
+  }
+
+
+# Micro-benchmark of the engines on windows of the served datasets
+if __name__ == '__main__':
+  from keras.models import load_model
+  from dataset_cache import load_dataset
+
+  parser = argparse.ArgumentParser(description='Benchmark the per-call latency of each inference engine')
+  parser.add_argument('--tunnel', nargs='+', default=['cht', 'eht', 'wht'])
+  parser.add_argument('--batch-size', type=int, nargs='+', default=[1, 32])
+  parser.add_argument('-n', type=int, default=200, help='Calls per engine')
+  parser.add_argument('--n-steps', type=int, default=12 * 6)
+  args = parser.parse_args()
+
+  for tunnel in args.tunnel:
+    model = load_model(f'data/model/{tunnel}')
+    values = load_dataset(f'data/journal_time_data_{tunnel}.csv').to_numpy()
+    print(f'{tunnel.upper()} max diff against predict: {verify_engines(model, values[None, :args.n_steps])}')
+    for batch_size in args.batch_size:
+      starts = np.linspace(0, len(values) - args.n_steps, batch_size, dtype=int)
+      sample = np.stack([values[i:i + args.n_steps] for i in starts])
+      for name, engine_type in ENGINES.items():
+        result = benchmark(engine_type(model), sample, args.n)
+        print(f'{tunnel.upper()} batch={batch_size:<4} {name:<9} '
+              f'mean={result["mean_ms"]:.3f}ms p50={result["p50_ms"]:.3f}ms p99={result["p99_ms"]:.3f}ms', flush=True)
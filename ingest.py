@@ -0,0 +1,141 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+from datetime import datetime
+from typing import Any, Callable
+
+import aiohttp
+import numpy as np
+import pandas as pd
+import xmltodict
+
+from download import process_journey_time_data
+from features import StreamingFeatures
+from series_store import SeriesStore, to_ns
+
+JOURNEY_TIME_URL = 'https://resource.data.one.gov.hk/td/jss/Journeytimev2.xml'
+
+
+class IngestError(Exception):
+  pass
+
+
+# Parse one Journeytimev2 document into the capture time and the journey time of each road (e.g. K02-CH)
+def parse_journey_time(xml_data: str) -> tuple[datetime, dict[str, float]]:
+  data: dict[str, Any] = xmltodict.parse(xml_data, xml_attribs=False)
+  timestamp, rows = process_journey_time_data(data)
+  journey_time: dict[str, float] = {}
+  for location, destination, value, _ in rows[1:]:
+    try:
+      journey_time[f'{location}-{destination}'] = float(value)
+    except (TypeError, ValueError):
+      continue
+  return datetime.strptime(timestamp, '%Y%m%d-%H%M%S'), journey_time
+
+
+# Append the points of the store sampled up to time_ns, interpolated in time between the last point and value,
+# return the number of points appended
+def append_observation(store: SeriesStore, time_ns: int, value: float, max_gap_ns: int) -> int:
+  last = len(store) - 1
+  last_ns = store.start_ns + last * store.step_ns
+  n = (time_ns - last_ns) // store.step_ns
+  if n <= 0:
+    return 0
+  if time_ns - last_ns > max_gap_ns:
+    raise IngestError(f'{store.name} ends at {pd.Timestamp(last_ns)}, '
+                      f'{pd.Timedelta(time_ns - last_ns)} before the upstream data')
+  last_value = float(store.get(last, last + 1)[0])
+  elapsed = np.arange(1, n + 1, dtype=np.int64) * store.step_ns
+  store.append((last_value + (value - last_value) * elapsed / (time_ns - last_ns)).astype(np.float32))
+  return n
+
+
+# Poll the Journeytimev2 feed and append the new 5-minute points to the series of each tunnel
+# The observations go through the same feature pipeline as merge_dataset.py (StreamingFeatures), points are
+# appended once they are final, so they never change afterwards
+# stores is shared with the server, so tunnels loaded after the ingestion has started are picked up
+# The feed is fetched with aiohttp and parsed in a thread, so polling never blocks request handling
+class LiveIngestor:
+  def __init__(self, url: str, stores: dict[str, SeriesStore], *, interval: float = 60, max_gap_hours: float = 6,
+               timeout: float = 30, on_append: Callable[[str, int], None] | None = None):
+    self.url = url
+    self.stores = stores
+    self.interval = interval
+    self.max_gap_ns = int(max_gap_hours * 3600 * 10 ** 9)
+    self.timeout = timeout
+    self.on_append = on_append
+    self.features: dict[str, StreamingFeatures] = {}
+    # Statistics
+    self.n_polls = 0
+    self.n_failures = 0
+    self.last_error: str | None = None
+    self.last_capture: datetime | None = None
+    self.appended: dict[str, int] = {}
+
+  async def run(self):
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as client:
+      while True:
+        await self.poll(client)
+        await asyncio.sleep(self.interval)
+
+  async def poll(self, client: aiohttp.ClientSession):
+    self.n_polls += 1
+    try:
+      async with client.get(self.url) as res:
+        if not res.ok:
+          raise IngestError(f'HTTP {res.status}')
+        xml_data = await res.text()
+      captured, journey_time = await asyncio.to_thread(parse_journey_time, xml_data)
+    except Exception as err:
+      self.n_failures += 1
+      self.last_error = f'{type(err).__name__}: {err}'
+      print(f'Unable to poll {self.url}: {self.last_error}', flush=True)
+      return
+
+    self.last_capture = captured
+    # The historical dataset is timestamped to the minute (see process_datasets.py)
+    time_ns = to_ns(captured.replace(second=0, microsecond=0))
+    for tunnel, store in list(self.stores.items()):
+      value = journey_time.get(store.name)
+      if value is None:
+        continue
+      if tunnel not in self.features:
+        # The batch script replaces -1 with the mean of the whole raw series, which is not available here,
+        # the mean of the smoothed dataset is the closest estimate
+        self.features[tunnel] = StreamingFeatures(float(np.mean(store.get(0, len(store)))), emit_warmup=False)
+      n = 0
+      try:
+        for point_ns, point in self.features[tunnel].push(time_ns, value):
+          n += append_observation(store, point_ns, point, self.max_gap_ns)
+      except IngestError as err:
+        self.last_error = str(err)
+        print(f'Skipped {tunnel.upper()} live data: {err}', flush=True)
+      if n > 0:
+        self.appended[tunnel] = self.appended.get(tunnel, 0) + n
+        if self.on_append is not None:
+          self.on_append(tunnel, n)
+
+  def stats(self) -> dict[str, Any]:
+    return {
+      "url": self.url,
+      "interval": self.interval,
+      "polls": self.n_polls,
+      "failures": self.n_failures,
+      "last_error": self.last_error,
+      "last_capture": self.last_capture.isoformat() if self.last_capture is not None else None,
+      "appended": dict(self.appended),
+      "latest": {tunnel: store.end.isoformat() for tunnel, store in list(self.stores.items())},
+    }
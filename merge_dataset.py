@@ -14,57 +14,179 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 BASE_DIR = Path('data')
-
-df_1 = pd.read_csv(Path(BASE_DIR, 'journal_time_data-1.csv'))
-df_2 = pd.read_csv(Path(BASE_DIR, 'journal_time_data-2.csv'))
-df = pd.concat([df_1, df_2], axis=0)
-df: pd.DataFrame = df.filter(regex=r'(-(CH|WH|EH)$)|timestamp')
-df.index = pd.to_datetime(df['timestamp'])
-df.drop('timestamp', axis=1, inplace=True)
+# Wide tables of process_datasets.py, in time order
+INPUTS = ['journal_time_data-1.csv', 'journal_time_data-2.csv']
+MERGED = 'journal_time_data_hk.csv'
+# Roads crossing the harbour
+ROAD_PATTERN = r'(-(CH|WH|EH)$)|timestamp'
 # Filter invalid time
-skip_date = pd.to_datetime("2022-03-11")
-df = df[df.index > skip_date]
-df.to_csv(Path(BASE_DIR, 'journal_time_data_hk.csv'))
+SKIP_DATE = pd.to_datetime("2022-03-11")
+# Time range of the tunnel datasets
+TUNNEL_SKIP_DATE = pd.to_datetime("2022-07-11")
+TUNNEL_UNTIL_DATE = pd.to_datetime("2023-11-10")
+TUNNELS = {
+  # K02-CH (Cross-Harbour Tunnel)
+  'cht': 'K02-CH',
+  # K02-EH (Eastern Harbour Crossing)
+  'eht': 'K02-EH',
+  # K03-WH (Western Harbour Crossing)
+  'wht': 'K03-WH',
+}
+# Every route of the merged dataset (see plot_data.py)
+ALL_ROUTES = [
+  'H1-CH', 'H1-EH', 'H11-CH', 'H11-EH', 'H2-CH', 'H2-EH', 'H2-WH', 'H3-CH', 'H3-WH', 'H4-CH', 'H4-EH', 'H4-WH',
+  'H5-CH', 'H5-EH', 'H5-WH', 'K01-CH', 'K01-WH', 'K02-CH', 'K02-EH', 'K03-CH', 'K03-EH', 'K03-WH', 'K04-CH', 'K04-WH',
+  'K05-CH', 'K05-EH', 'K06-CH', 'K06-WH'
+]
+# Route sets of --routes, dataset name -> route
+ROUTE_SETS = {
+  'tunnels': TUNNELS,
+  'all': {route.lower(): route for route in ALL_ROUTES},
+}
+BINARY_FORMAT = 1
 
-# Splint dataset related to individual tunnel
-# Filter invalid time
-skip_date = pd.to_datetime("2022-07-11")
-util_date = pd.to_datetime("2023-11-10")
-df = df[(df.index > skip_date) & (df.index <= util_date)]
-
-df = df.resample('5Min').interpolate(method='time').iloc[1:]
-df['week_day'] = df.index.dayofweek.values
-df['hour'] = df.index.hour.values
-df['minute'] = df.index.minute.values
-
-# K02-CH (Cross-Harbour Tunnel)
-cht = df[['K02-CH', 'week_day', 'hour', 'minute']]
-cht_mean = cht.loc[:, 'K02-CH'].mean()
-cht['K02-CH'].replace(-1, cht_mean, inplace=True)
-# Smooth traffic data by move average
-cht['K02-CH'] = cht['K02-CH'].rolling(6).mean().shift(periods=-2).fillna(cht_mean)
-cht.to_csv(f'{BASE_DIR}/journal_time_data_cht.csv', encoding='utf-8')
-
-# K02-EH (Eastern Harbour Crossing)
-eht = df[['K02-EH', 'week_day', 'hour', 'minute']]
-# Replace the invalid data with the average value instead of removing it
-eht_mean = eht.loc[:, 'K02-EH'].mean()
-eht['K02-EH'].replace(-1, eht_mean, inplace=True)
-# Smooth traffic data by move average
-eht['K02-EH'] = eht['K02-EH'].rolling(6).mean().shift(periods=-2).fillna(eht_mean)
-eht.to_csv(f'{BASE_DIR}/journal_time_data_eht.csv', encoding='utf-8')
-
-# K03-WH (Western Harbour Crossing)
-wht = df[['K03-WH', 'week_day', 'hour', 'minute']]
-# cht = cht[cht['K02-CH'] != -1]
-# Replace the invalid data with the average value instead of removing it
-wht_mean = wht.loc[:, 'K03-WH'].mean()
-wht['K03-WH'].replace(-1, wht_mean, inplace=True)
-
-# Smooth traffic data by move average
-wht['K03-WH'] = wht['K03-WH'].rolling(6).mean().shift(periods=-2).fillna(wht_mean)
-wht.to_csv(f'{BASE_DIR}/journal_time_data_wht.csv', encoding='utf-8')
+
+# Rows of the wide tables kept in the merged dataset
+def filter_merged(df: pd.DataFrame) -> pd.DataFrame:
+  df: pd.DataFrame = df.filter(regex=ROAD_PATTERN)
+  df.index = pd.to_datetime(df['timestamp'])
+  df.drop('timestamp', axis=1, inplace=True)
+  # Filter invalid time
+  return df[df.index > SKIP_DATE]
+
+
+def merge_datasets(inputs: list[Path]) -> pd.DataFrame:
+  return filter_merged(pd.concat([pd.read_csv(path) for path in inputs], axis=0))
+
+
+# 5-minute series of the tunnel time range with the calendar features
+def resample_tunnels(df: pd.DataFrame) -> pd.DataFrame:
+  df = df[(df.index > TUNNEL_SKIP_DATE) & (df.index <= TUNNEL_UNTIL_DATE)]
+  df = df.resample('5Min').interpolate(method='time').iloc[1:]
+  df['week_day'] = df.index.dayofweek.values
+  df['hour'] = df.index.hour.values
+  df['minute'] = df.index.minute.values
+  return df
+
+
+# Clean and smooth the journey time of every route at once, each column gets the same values as it would alone
+def route_features(df: pd.DataFrame, routes: list[str]) -> pd.DataFrame:
+  data = df[routes]
+  # Replace the invalid data with the average value instead of removing it
+  mean = data.mean()
+  data = data.mask(data == -1, mean, axis=1)
+  # Smooth traffic data by move average
+  return data.rolling(6).mean().shift(periods=-2).fillna(mean)
+
+
+def tunnel_dataset(df: pd.DataFrame, column: str) -> pd.DataFrame:
+  data = df[[column, 'week_day', 'hour', 'minute']].copy()
+  data[column] = route_features(df, [column])[column]
+  return data
+
+
+# Route set name, comma-separated routes, or a json file of dataset name -> route (or a list of routes)
+def load_routes(spec: str) -> dict[str, str]:
+  if spec in ROUTE_SETS:
+    return ROUTE_SETS[spec]
+  if spec.endswith('.json'):
+    routes = json.loads(Path(spec).read_text())
+  else:
+    routes = spec.split(',')
+  return routes if isinstance(routes, dict) else {route.lower(): route for route in routes}
+
+
+# Resample and build the features of a group of routes, the csv of each route is written here so groups
+# spread across processes also format their csv in parallel
+def build_group(df: pd.DataFrame, routes: dict[str, str], write_csv: bool) -> pd.DataFrame:
+  df = resample_tunnels(df)
+  features = route_features(df, list(df.columns[:-3]))
+  if write_csv:
+    calendar = df[['week_day', 'hour', 'minute']]
+    for name, route in routes.items():
+      pd.concat([features[[route]], calendar], axis=1).to_csv(f'{BASE_DIR}/journal_time_data_{name}.csv',
+                                                              encoding='utf-8')
+  return features
+
+
+def build_features(df: pd.DataFrame, routes: dict[str, str], *, workers: int = 1,
+                   write_csv: bool = True) -> pd.DataFrame:
+  names = list(routes)
+  groups = [{name: routes[name] for name in group} for group in np.array_split(names, min(workers, len(names)))]
+  if workers <= 1:
+    results = [build_group(df[list(dict.fromkeys(group.values()))], group, write_csv) for group in groups]
+  else:
+    with ProcessPoolExecutor(workers) as pool:
+      futures = [pool.submit(build_group, df[list(dict.fromkeys(group.values()))], group, write_csv)
+                 for group in groups]
+      results = [future.result() for future in futures]
+  features = pd.concat(results, axis=1)
+  return features.loc[:, ~features.columns.duplicated()]
+
+
+# Model-ready binary dataset of the routes, memory-mappable
+# values.npy: float32 journey time (timestamp x route), in the order of meta.json names
+# calendar.npy: int8 week_day, hour, minute of each timestamp
+# meta.json: dataset names, routes and the time axis (start_ns + i * step_ns)
+def write_binary(path: Path, routes: dict[str, str], features: pd.DataFrame):
+  index = features.index
+  tmp_dir = Path(f'{path}.tmp-{os.getpid()}')
+  tmp_dir.mkdir(parents=True, exist_ok=True)
+  np.save(tmp_dir / 'values.npy', features[list(routes.values())].to_numpy(dtype=np.float32))
+  np.save(tmp_dir / 'calendar.npy', np.stack([index.dayofweek, index.hour, index.minute], axis=1).astype(np.int8))
+  (tmp_dir / 'meta.json').write_text(json.dumps({
+    'format': BINARY_FORMAT,
+    'names': list(routes),
+    'routes': list(routes.values()),
+    'start': index[0].isoformat(),
+    'start_ns': int(index[0].value),
+    'step_ns': int(index[1].value - index[0].value),
+    'length': len(index),
+  }, indent=2))
+  if path.exists():
+    shutil.rmtree(path)
+  os.rename(tmp_dir, path)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Merge the wide tables and build the dataset of each route')
+  parser.add_argument('inputs', nargs='*', default=INPUTS, help=f'Wide tables in {BASE_DIR}, in time order')
+  parser.add_argument('--routes', default='tunnels',
+                      help=f'Route set ({", ".join(ROUTE_SETS)}), comma-separated routes or a json file')
+  parser.add_argument('--from-merged', action='store_true', help=f'Read {MERGED} instead of merging the inputs')
+  parser.add_argument('--format', choices=['csv', 'npy', 'both'], default='csv',
+                      help='Write one csv per route and/or the binary dataset of all the routes')
+  parser.add_argument('--output', type=Path, help='Directory of the binary dataset (data/features_<routes>)')
+  parser.add_argument('--workers', type=int, default=1, help='Processes building groups of routes')
+  args = parser.parse_args()
+
+  routes = load_routes(args.routes)
+  start = time.perf_counter()
+  if args.from_merged:
+    from dataset_cache import load_dataset
+    df = load_dataset(Path(BASE_DIR, MERGED))
+  else:
+    df = merge_datasets([Path(BASE_DIR, name) for name in args.inputs])
+    df.to_csv(Path(BASE_DIR, MERGED))
+  loaded = time.perf_counter()
+
+  # Splint dataset related to individual route
+  features = build_features(df, routes, workers=args.workers, write_csv=args.format != 'npy')
+  built = time.perf_counter()
+  if args.format != 'csv':
+    name = args.routes if args.routes in ROUTE_SETS else Path(args.routes).stem
+    write_binary(args.output or Path(BASE_DIR, f'features_{name}'), routes, features)
+  print(f'Built {len(routes)} routes ({len(features)} points) in {time.perf_counter() - start:.2f}s '
+        f'(load {loaded - start:.2f}s, features {built - loaded:.2f}s, binary {time.perf_counter() - built:.2f}s)',
+        flush=True)
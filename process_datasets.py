@@ -13,26 +13,37 @@
 #
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
 import csv
 import os
 import re
+import resource
 import tarfile
+import time
 import dateutil.parser
+import numpy as np
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import Process
 from pathlib import Path
+from typing import BinaryIO, Iterator
 from zstandard import ZstdDecompressor
 from datetime import datetime
 
 # Define variables
 BASE_DIR = Path('data')
 JOURNEY_DATA_TIMESTAMP_PAT = re.compile(r'.*(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})\d{2}.csv')
+# Archive files parsed per task of the worker pool
+MEMBERS_PER_TASK = 1024
+# Rows of the wide table written at once
+CHUNK_ROWS = 16384
 
 
 # Extract zstd stream and pipe to fifo
-def do_zstd_extract(output_name: Path):
+def do_zstd_extract(archive: Path, output_name: Path):
   print(f'Started proccess do_zstd_extract() (PID=#{os.getpid()})')
-  ifh = open(Path(BASE_DIR, 'journey-data-2.tar.zstd'), 'rb')
+  ifh = open(archive, 'rb')
   ofh = open(output_name, 'wb')
   dec = ZstdDecompressor()
   dec.copy_stream(ifh, ofh, read_size=8192, write_size=8192)
@@ -45,41 +56,101 @@ def extract_timestamp(file_title: str) -> datetime:
                                   f'T{mat.group(4)}:{mat.group(5)}')
 
 
-def process_journey_data():
-  # [timestamp, road -> journey_time]]
-  journey_time_data: list[list[dict[str, str] | str]] = [['timestamp']]
-  road: set[str] = set()
+# Numeric field of a tar header, octal or base-256 (GNU)
+def tar_int(field: bytes) -> int:
+  if field[0] & 0x80:
+    return int.from_bytes(field[1:], 'big')
+  return int(field.split(b'\0', 1)[0].strip() or b'0', 8)
+
+
+# Records of a pax extended header ("<length> <key>=<value>\n")
+def parse_pax(data: bytes) -> dict[str, str]:
+  records = {}
+  pos = 0
+  while pos < len(data) and data[pos] != 0:
+    sep = data.index(b' ', pos)
+    length = int(data[pos:sep])
+    key, _, value = data[sep + 1:pos + length - 1].partition(b'=')
+    records[key.decode()] = value.decode()
+    pos += length
+  return records
+
+
+# Iterate the (name, content) of the regular files of a ustar/GNU/pax tar stream
+# tarfile decodes and validates every header field, which takes most of the time for the small files of
+# the archive, only the name, size and type are read here (headers are still checksummed)
+def iter_tar(fh: BinaryIO) -> Iterator[tuple[str, bytes]]:
+  extended: dict[str, str] = {}
+  while True:
+    header = fh.read(512)
+    if len(header) < 512 or header.count(0) == 512:
+      return
+    if sum(header) - sum(header[148:156]) + 256 != tar_int(header[148:156]):
+      raise tarfile.ReadError('Invalid tar header checksum')
+    kind = header[156:157]
+    size = int(extended['size']) if 'size' in extended else tar_int(header[124:136])
+    content = fh.read(size)
+    fh.read(-size % 512)
+    if kind == b'x':
+      extended.update(parse_pax(content))
+      continue
+    if kind == b'L':
+      extended['path'] = content.split(b'\0', 1)[0].decode()
+      continue
+    if kind in (b'g', b'K'):
+      continue
+    name = extended.get('path')
+    if name is None:
+      name = header[:100].split(b'\0', 1)[0].decode()
+      if header[257:263] == b'ustar\0' and header[345]:
+        name = header[345:500].split(b'\0', 1)[0].decode() + '/' + name
+    extended = {}
+    if kind in (b'0', b'\0', b'7'):
+      yield name, content
+
+
+# Iterate the (name, content) of the files in the archive, decompressed by another process through a fifo
+def iter_archive(archive: Path, use_tarfile: bool = False):
   fifo_path = Path(BASE_DIR, '.fifo')
   if not fifo_path.exists():
     os.mkfifo(fifo_path)
-  p = Process(target=do_zstd_extract, args=(fifo_path,))
+  p = Process(target=do_zstd_extract, args=(archive, fifo_path))
   p.start()
-  with tarfile.open(fifo_path, mode='r|') as tar:
-    ent = tar.next()
-    while ent is not None:
-      if not ent.isfile():
-        ent = tar.next()
-        continue
-      f = tar.extractfile(ent)
-      timestamp = extract_timestamp(ent.name)
-      content = f.read().decode('utf-8')
-      reader = csv.reader(content.split('\n'))
-      next(reader)
-      journey_time: dict[str, str] = dict()
-      for row in reader:
-        if not row:
-          continue
-        name = f'{row[0]}-{row[1]}'
-        road.add(name)
-        journey_time[name] = row[2]
-
-      journey_time_data.append([timestamp.isoformat(), journey_time])
+  if use_tarfile:
+    with tarfile.open(fifo_path, mode='r|') as tar:
       ent = tar.next()
+      while ent is not None:
+        if ent.isfile():
+          yield ent.name, tar.extractfile(ent).read()
+        ent = tar.next()
+  else:
+    with open(fifo_path, 'rb') as fh:
+      yield from iter_tar(fh)
 
   p.join()
-  print(f'Proccess do_zstd_extract() ended')
+  print('Proccess do_zstd_extract() ended')
   os.remove(fifo_path)
 
+
+# Original single-process pivot, kept for comparison (--legacy)
+def process_journey_data(archive: Path, output: Path) -> int:
+  # [timestamp, road -> journey_time]]
+  journey_time_data: list[list[dict[str, str] | str]] = [['timestamp']]
+  road: set[str] = set()
+  for file_name, content in iter_archive(archive, use_tarfile=True):
+    timestamp = extract_timestamp(file_name)
+    reader = csv.reader(content.decode('utf-8').split('\n'))
+    next(reader)
+    journey_time: dict[str, str] = dict()
+    for row in reader:
+      if not row:
+        continue
+      name = f'{row[0]}-{row[1]}'
+      road.add(name)
+      journey_time[name] = row[2]
+
+    journey_time_data.append([timestamp.isoformat(), journey_time])
+
   journey_time_data[1:] = sorted(journey_time_data[1:], key=lambda e: e[0])
   road_order = sorted(road)
   journey_time_data[0].extend(road_order)
@@ -88,11 +159,164 @@ def process_journey_data():
     journey_time = entry[1]
     journey_time_data[idx+1] = [timestamp, *(journey_time.get(v, -1) for v in road_order)]
 
-  print(f'Writing to journal_time_data.csv')
-  with open(Path(BASE_DIR, 'journal_time_data-2.csv'), mode='w') as f:
+  print(f'Writing to {output.name}')
+  with open(output, mode='w') as f:
     writer = csv.writer(f)
     writer.writerows(journey_time_data)
+  return len(journey_time_data) - 1
+
+
+# Journey times are written as found in the source files (as process_journey_data), -1 where a road is missing
+MISSING_LABEL = '-1'
+
+
+# Parse a batch of archive files into their timestamps (minutes since the epoch), the roads seen, the distinct
+# journey time strings and a file x road matrix of indices into them (0, MISSING_LABEL, where a road is missing)
+def parse_members(members: list[tuple[str, bytes]]) -> tuple[np.ndarray, list[str], list[str], np.ndarray]:
+  roads: dict[str, int] = {}
+  labels: dict[str, int] = {MISSING_LABEL: 0}
+  times = np.empty(len(members), dtype=np.int64)
+  rows: list[int] = []
+  cols: list[int] = []
+  data: list[int] = []
+  for i, (file_name, content) in enumerate(members):
+    year, month, day, hour, minute = JOURNEY_DATA_TIMESTAMP_PAT.match(file_name).groups()
+    times[i] = np.datetime64(f'{year}-{month}-{day}T{hour}:{minute}', 'm').astype(np.int64)
+    reader = csv.reader(content.decode('utf-8').split('\n'))
+    next(reader)
+    for row in reader:
+      if not row:
+        continue
+      rows.append(i)
+      cols.append(roads.setdefault(f'{row[0]}-{row[1]}', len(roads)))
+      data.append(labels.setdefault(row[2], len(labels)))
+  codes = np.zeros((len(members), len(roads)), dtype=np.int32)
+  codes[rows, cols] = data
+  return times, list(roads), list(labels), codes
+
+
+# Field as written by csv.writer (QUOTE_MINIMAL)
+def csv_field(value: str) -> str:
+  if any(c in value for c in ',"\r\n'):
+    return '"' + value.replace('"', '""') + '"'
+  return value
+
+
+# Timestamp x road int32 matrix of indices into the distinct journey time strings, filled in arrival order,
+# in memory or memory-mapped to path
+# Rows and columns are preallocated and grow by doubling, columns are assigned to roads as they are seen
+class PivotMatrix:
+  def __init__(self, path: Path | None = None, rows: int = 65536, cols: int = 32):
+    self.path = path
+    self.n_rows = 0
+    self.roads: dict[str, int] = {}
+    self.labels: dict[str, int] = {MISSING_LABEL: 0}
+    self.times = np.empty(rows, dtype=np.int64)
+    self.values = self._allocate(rows, cols)
+
+  def _allocate(self, rows: int, cols: int) -> np.ndarray:
+    if self.path is None:
+      return np.zeros((rows, cols), dtype=np.int32)
+    # A new file each time, as the rows are laid out contiguously
+    path = self.path.with_name(f'{self.path.name}.{rows}x{cols}')
+    values = np.lib.format.open_memmap(path, mode='w+', dtype=np.int32, shape=(rows, cols))
+    values[:] = 0
+    return values
+
+  def _grow(self, rows: int, cols: int):
+    old = self.values
+    capacity, width = old.shape
+    while capacity < rows:
+      capacity *= 2
+    while width < cols:
+      width *= 2
+    if (capacity, width) == old.shape:
+      return
+    self.values = self._allocate(capacity, width)
+    self.values[:self.n_rows, :old.shape[1]] = old[:self.n_rows]
+    self.times = np.concatenate([self.times[:self.n_rows], np.empty(capacity - self.n_rows, np.int64)])
+    if isinstance(old, np.memmap):
+      path = Path(old.filename)
+      del old
+      path.unlink()
+
+  # Add the rows parsed by parse_members
+  def add(self, times: np.ndarray, roads: list[str], labels: list[str], codes: np.ndarray):
+    cols = np.array([self.roads.setdefault(road, len(self.roads)) for road in roads], dtype=np.int64)
+    # Indices of the batch into the strings of the whole matrix
+    remap = np.array([self.labels.setdefault(label, len(self.labels)) for label in labels], dtype=np.int32)
+    self._grow(self.n_rows + len(times), len(self.roads))
+    first, last = self.n_rows, self.n_rows + len(times)
+    self.times[first:last] = times
+    self.values[first:last, cols] = remap[codes]
+    self.n_rows = last
+
+  # Write the wide table sorted by timestamp (the order of arrival for the same minute), roads in name order
+  def write_csv(self, output: Path, chunk_rows: int = CHUNK_ROWS):
+    order = np.argsort(self.times[:self.n_rows], kind='stable')
+    road_order = sorted(self.roads)
+    cols = [self.roads[road] for road in road_order]
+    # Journey times take a few distinct strings, each is quoted once
+    labels = np.array([csv_field(label) for label in self.labels], dtype=object)
+    with open(output, mode='w') as f:
+      csv.writer(f).writerow(['timestamp', *road_order])
+      for start in range(0, self.n_rows, chunk_rows):
+        idx = order[start:start + chunk_rows]
+        timestamps = np.datetime_as_string(self.times[idx].astype('datetime64[m]'), unit='s').astype(object)
+        rows = np.column_stack([timestamps, labels[self.values[idx][:, cols]]])
+        f.write(''.join(','.join(row) + '\r\n' for row in rows.tolist()))
+
+  def close(self):
+    if isinstance(self.values, np.memmap):
+      path = Path(self.values.filename)
+      self.values = None
+      path.unlink()
+
+
+# Parallel pivot, the archive is read by this process and the files are parsed by a pool of workers
+# At most 2 batches per worker are in flight, so the memory is bounded by the int32 matrix
+def process_journey_data_parallel(archive: Path, output: Path, workers: int, mmap: bool) -> int:
+  matrix = PivotMatrix(Path(output.parent, f'.{output.name}.pivot') if mmap else None)
+  pending = deque()
+  with ProcessPoolExecutor(workers) as pool:
+    batch: list[tuple[str, bytes]] = []
+    for file_name, content in iter_archive(archive):
+      batch.append((file_name, content))
+      if len(batch) < MEMBERS_PER_TASK:
+        continue
+      pending.append(pool.submit(parse_members, batch))
+      batch = []
+      if len(pending) >= 2 * workers:
+        matrix.add(*pending.popleft().result())
+    if batch:
+      pending.append(pool.submit(parse_members, batch))
+    while pending:
+      matrix.add(*pending.popleft().result())
+
+  print(f'Writing to {output.name}')
+  matrix.write_csv(output)
+  matrix.close()
+  return matrix.n_rows
 
 
 if __name__ == '__main__':
-  process_journey_data()
+  parser = argparse.ArgumentParser(description='Pivot the archived journey data into a timestamp x road table')
+  parser.add_argument('--archive', type=Path, default=Path(BASE_DIR, 'journey-data-2.tar.zstd'))
+  parser.add_argument('--output', type=Path, default=Path(BASE_DIR, 'journal_time_data-2.csv'))
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes parsing the archive files')
+  parser.add_argument('--mmap', action='store_true', help='Keep the pivot matrix in a memory-mapped file')
+  parser.add_argument('--legacy', action='store_true', help='Use the original single-process pivot')
+  args = parser.parse_args()
+
+  start = time.perf_counter()
+  if args.legacy:
+    n = process_journey_data(args.archive, args.output)
+  else:
+    n = process_journey_data_parallel(args.archive, args.output, args.workers, args.mmap)
+  elapsed = time.perf_counter() - start
+  # Peak resident set of this process and of the largest child (decompression or worker), in KiB on Linux
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+  size = args.archive.stat().st_size / 1024 ** 2
+  print(f'Processed {n} files ({size:.1f}MiB archive) in {elapsed:.1f}s, {n / elapsed:.0f} files/s, '
+        f'peak RSS {rss:.0f}MiB (largest child {child_rss:.0f}MiB)', flush=True)
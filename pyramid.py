@@ -0,0 +1,201 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import time
+import warnings
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from series_store import MINUTE_NS, HOUR_NS, DAY_NS, SeriesStore, to_ns
+
+# Resolutions of the pyramid, from the finest to the coarsest
+RESOLUTIONS = {
+  '5m': 5 * MINUTE_NS,
+  '15m': 15 * MINUTE_NS,
+  '1h': HOUR_NS,
+  '1d': DAY_NS,
+}
+
+
+# One resolution of the pyramid, bucket i covers [start + i * step, start + (i + 1) * step)
+# Buckets are aligned to multiples of step since the epoch (e.g. 1h buckets start on the hour, 1d at 00:00)
+class Level:
+  def __init__(self, name: str, store: SeriesStore, step_ns: int):
+    if step_ns % store.step_ns != 0:
+      raise ValueError(f'Resolution {name} is not a multiple of the {store.step} sampling interval')
+    self.name = name
+    self.store = store
+    self.step_ns = step_ns
+    self.factor = step_ns // store.step_ns
+    self.start_ns = store.start_ns // step_ns * step_ns
+    # Points of the store before its first sample in the first bucket
+    self.head = (store.start_ns - self.start_ns) // store.step_ns
+    self._mean = self._min = self._max = np.empty(0, dtype=np.float32)
+    self._n = 0
+    # Points of the store aggregated so far
+    self._points = 0
+    self.update()
+
+  def __len__(self):
+    return len(self.store) if self.factor == 1 else self._n
+
+  @property
+  def nbytes(self) -> int:
+    return self._mean.nbytes + self._min.nbytes + self._max.nbytes
+
+  # Aggregate the points appended to the store since the last update
+  # Only the last (partial) bucket and the new ones are recomputed
+  def update(self):
+    n_points = len(self.store)
+    if self.factor == 1 or n_points == self._points:
+      return
+    factor, head = self.factor, self.head
+    first = max(head + self._points - 1, 0) // factor
+    last = -(-(head + n_points) // factor)
+    # Pad the partial first and last buckets with NaN, so they are aggregated over the available points only
+    padded = np.full((last - first) * factor, np.nan, dtype=np.float32)
+    offset = first * factor - head
+    padded[max(-offset, 0):n_points - offset] = self.store.get(max(offset, 0), n_points)
+    padded = padded.reshape(last - first, factor)
+
+    if last > len(self._mean):
+      capacity = last if self._n == 0 else max(last, 2 * len(self._mean))
+      self._mean, self._min, self._max = (np.concatenate([a[:self._n], np.empty(capacity - self._n, np.float32)])
+                                          for a in (self._mean, self._min, self._max))
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore', RuntimeWarning)
+      self._mean[first:last] = np.nanmean(padded, axis=1)
+      self._min[first:last] = np.nanmin(padded, axis=1)
+      self._max[first:last] = np.nanmax(padded, axis=1)
+    self._n = last
+    self._points = n_points
+
+  # Mean, min and max of the buckets [first, last)
+  def range(self, first: int, last: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if self.factor == 1:
+      # Same resolution as the store, share its values
+      values = self.store.get(first, last)
+      return values, values, values
+    return self._mean[first:last], self._min[first:last], self._max[first:last]
+
+  # Index of the bucket containing time
+  def offset(self, time: datetime) -> int:
+    return (to_ns(time) - self.start_ns) // self.step_ns
+
+  # Index range [first, last) of the buckets overlapping [start_time, end_time]
+  def bounds(self, start_time: datetime, end_time: datetime) -> tuple[int, int]:
+    first = max(self.offset(start_time), 0)
+    return first, min(max(self.offset(end_time) + 1, first), len(self))
+
+  def count(self, start_time: datetime, end_time: datetime) -> int:
+    first, last = self.bounds(start_time, end_time)
+    return last - first
+
+
+# Mean/min/max aggregates of a SeriesStore at each resolution, built once when the tunnel is loaded
+class Pyramid:
+  def __init__(self, levels: dict[str, Level]):
+    self.levels = levels
+
+  @classmethod
+  def build(cls, store: SeriesStore, resolutions: dict[str, int] = None) -> 'Pyramid':
+    resolutions = resolutions or RESOLUTIONS
+    return cls({name: Level(name, store, step_ns) for name, step_ns in resolutions.items()})
+
+  # Aggregate the points appended to the store
+  def update(self):
+    for level in self.levels.values():
+      level.update()
+
+  @property
+  def nbytes(self) -> int:
+    return sum(level.nbytes for level in self.levels.values())
+
+  # The finest level returning at most max_points buckets in the range, or the coarsest one
+  def select(self, start_time: datetime, end_time: datetime, max_points: int) -> Level:
+    for level in self.levels.values():
+      if level.count(start_time, end_time) <= max_points:
+        return level
+    return level
+
+
+# Largest-Triangle-Three-Buckets downsampling, return the indices of the n_out points kept
+# The first and last points are always kept, the other ones are the point of each bucket forming
+# the largest triangle with the previous kept point and the average of the next bucket
+def lttb(values: np.ndarray, n_out: int) -> np.ndarray:
+  n = len(values)
+  if n_out >= n or n_out < 3:
+    return np.arange(n)
+  y = np.asarray(values, dtype=np.float64)
+  edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+  # Average point of each bucket, the last point is the bucket following the last one
+  next_x = np.append((edges[:-1] + edges[1:] - 1) / 2, n - 1)
+  next_y = np.append(np.add.reduceat(y[:-1], edges[:-1]) / np.diff(edges), y[-1])
+  # Buckets hold a few points each, so the sequential scan runs on Python floats rather than tiny arrays
+  y, edges, next_x, next_y = y.tolist(), edges.tolist(), next_x.tolist(), next_y.tolist()
+  selected = [0]
+  a = 0
+  for i in range(n_out - 2):
+    ay, nx, ny = y[a], next_x[i + 1], next_y[i + 1]
+    # Twice the triangle area is linear in the candidate point: |cy * y + cx * x + c|
+    cy, cx, c = a - nx, ny - ay, ay * nx - a * ny
+    best = -1.0
+    for j in range(edges[i], edges[i + 1]):
+      area = abs(cy * y[j] + cx * j + c)
+      if area > best:
+        best, a = area, j
+    selected.append(a)
+  selected.append(n - 1)
+  return np.array(selected, dtype=np.int64)
+
+
+# Compare the latency and payload of the raw and the pyramid ranges
+if __name__ == '__main__':
+  from dataset_cache import load_series
+
+  parser = argparse.ArgumentParser(description='Build the aggregate pyramid and compare range query latency')
+  parser.add_argument('--tunnel', nargs='+', default=['cht', 'eht', 'wht'])
+  parser.add_argument('--max-points', type=int, default=1000)
+  parser.add_argument('-n', type=int, default=200, help='Queries per range')
+  args = parser.parse_args()
+
+  for tunnel in args.tunnel:
+    store = load_series(f'data/journal_time_data_{tunnel}.csv')
+    start = time.perf_counter()
+    pyramid = Pyramid.build(store)
+    print(f'{tunnel.upper()} pyramid built in {(time.perf_counter() - start) * 1000:.1f}ms '
+          f'({pyramid.nbytes / 1024:.0f}KiB, ' +
+          ', '.join(f'{name}={len(level)}' for name, level in pyramid.levels.items()) + ')', flush=True)
+
+    end_time = store.end
+    for days in (1, 7, 30, 365):
+      start_time = max(end_time - timedelta(days=days), store.start)
+      raw = store.slice(start_time, end_time)
+      start = time.perf_counter()
+      for _ in range(args.n):
+        level = pyramid.select(start_time, end_time, args.max_points)
+        first, last = level.bounds(start_time, end_time)
+      aggregate = (time.perf_counter() - start) / args.n * 1e6
+      fine = pyramid.select(start_time, end_time, args.max_points * 8)
+      first, last = fine.bounds(start_time, end_time)
+      start = time.perf_counter()
+      for _ in range(args.n):
+        lttb(fine.range(first, last)[0], args.max_points)
+      downsample = (time.perf_counter() - start) / args.n * 1e3
+      print(f'{tunnel.upper()} {days}d: raw={len(raw)} points, {level.name}={level.count(start_time, end_time)} '
+            f'buckets in {aggregate:.1f}us, lttb {fine.name}->{min(args.max_points, last - first)} '
+            f'points in {downsample:.2f}ms', flush=True)
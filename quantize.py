@@ -0,0 +1,149 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from inference import MODEL_VARIANTS, TFLiteEngine, benchmark, tflite_path
+
+# Convert the tunnel models to TF-Lite variants (model-<variant>.tflite next to the saved model) and compare them
+# with the Keras model on the held-out end of the dataset (the test split of window_store.py)
+N_STEPS = 12 * 6
+N_HORIZON = 12 * 3
+TEST_RATIO = 0.1
+BATCH_SIZES = [1, 32]
+
+
+# Copy of the model with the recurrent layers unrolled, TF-Lite only keeps the batch dimension dynamic for the
+# unrolled graph (the fused LSTM kernel has a fixed batch size)
+def unrolled(model: Any) -> Any:
+  import keras
+
+  def clone(layer):
+    if isinstance(layer, keras.Model):
+      return keras.models.clone_model(layer, clone_function=clone)
+    config = layer.get_config()
+    if isinstance(layer, keras.layers.RNN):
+      config['unroll'] = True
+    return layer.__class__.from_config(config)
+
+  result = keras.models.clone_model(model, clone_function=clone)
+  result.set_weights(model.get_weights())
+  return result
+
+
+def convert(model: Any, variant: str) -> bytes:
+  import tensorflow as tf
+  converter = tf.lite.TFLiteConverter.from_keras_model(unrolled(model))
+  if variant == 'float16':
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]
+  elif variant == 'int8':
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  elif variant != 'float32':
+    raise ValueError(f'Unknown model variant {variant}')
+  return converter.convert()
+
+
+# Peak RSS of this process in MiB, ru_maxrss is inherited through fork and exec, so it would include the parent
+def peak_rss_mb() -> float:
+  try:
+    with open('/proc/self/status') as f:
+      return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:')) / 1024
+  except (OSError, StopIteration):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Load one variant, as api.py would serve it, forecast the held-out windows and measure the latency
+# Run in a fresh process, so the peak RSS is the one of this variant alone
+def evaluate_variant(data_dir: str, tunnel: str, variant: str) -> dict[str, Any]:
+  from dataset_cache import load_series
+  from inference import create_engine
+  start = time.perf_counter()
+  data = load_series(f'{data_dir}/journal_time_data_{tunnel}.csv', mmap=True)
+  sample = data.model_inputs(np.arange(len(data) - 7, len(data) + 1), N_STEPS)
+  if variant == 'float32':
+    from keras.models import load_model
+    engine = create_engine('function', load_model(f'{data_dir}/model/{tunnel}'), sample, tunnel.upper())
+  else:
+    engine = TFLiteEngine(tflite_path(f'{data_dir}/model', tunnel, variant))
+    engine(sample)
+  load_time = time.perf_counter() - start
+
+  ends = np.arange(max(int(len(data) * (1 - TEST_RATIO)), N_STEPS) + N_STEPS, len(data) - N_HORIZON + 1)
+  forecast = np.concatenate([engine(data.model_inputs(ends[idx:idx + 256], N_STEPS))
+                             for idx in range(0, len(ends), 256)])
+  actual = data.windows(ends, N_HORIZON)
+  latency = {batch_size: benchmark(engine, data.model_inputs(ends[:batch_size], N_STEPS))['p50_ms']
+             for batch_size in BATCH_SIZES}
+  return {
+    'load_time': load_time,
+    'latency_ms': latency,
+    'rss_mb': peak_rss_mb(),
+    'mae': float(np.mean(np.abs(forecast - actual))),
+    'forecast': forecast,
+  }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Convert the tunnel models to reduced-precision TF-Lite variants')
+  parser.add_argument('--tunnel', nargs='+', default=['cht', 'eht', 'wht'])
+  parser.add_argument('--variant', nargs='+', choices=MODEL_VARIANTS[1:], default=['float16', 'int8'])
+  parser.add_argument('--data-dir', default='data')
+  parser.add_argument('--no-report', action='store_true', help='Only convert the models')
+  parser.add_argument('--output', type=Path, help='Write the report to this json file')
+  args = parser.parse_args()
+
+  from keras.models import load_model
+
+  for tunnel in args.tunnel:
+    model = load_model(f'{args.data_dir}/model/{tunnel}')
+    for variant in args.variant:
+      start = time.perf_counter()
+      path = tflite_path(f'{args.data_dir}/model', tunnel, variant)
+      tmp = path.with_name(f'.{path.name}.tmp')
+      tmp.write_bytes(convert(model, variant))
+      tmp.replace(path)
+      print(f'Converted {tunnel.upper()} to {variant} ({path.stat().st_size / 1024:.0f}KiB) '
+            f'in {time.perf_counter() - start:.1f}s', flush=True)
+  if args.no_report:
+    exit(0)
+
+  report = {}
+  for tunnel in args.tunnel:
+    results = {}
+    for variant in ['float32', *args.variant]:
+      # One process per variant, TensorFlow is not fork-safe
+      with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        results[variant] = pool.submit(evaluate_variant, args.data_dir, tunnel, variant).result()
+    reference = results['float32']['forecast']
+    report[tunnel] = {}
+    for variant, result in results.items():
+      forecast = result.pop('forecast')
+      result['max_diff'] = float(np.max(np.abs(forecast - reference)))
+      report[tunnel][variant] = result
+      latency = ' '.join(f'b{batch_size}={ms:.3f}ms' for batch_size, ms in result['latency_ms'].items())
+      print(f'{tunnel.upper()} {variant:<8} load={result["load_time"]:.2f}s {latency} RSS={result["rss_mb"]:.0f}MiB '
+            f'MAE={result["mae"]:.4f} max diff={result["max_diff"]:.2e}', flush=True)
+  if args.output is not None:
+    args.output.write_text(json.dumps(report, indent=2))
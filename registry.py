@@ -0,0 +1,224 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import gc
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable
+
+# Routes served from the data directory: journal_time_data_<route>.csv (merge_dataset.py) with a model in
+# <model_dir>/<route>/ (train.py)
+DATASET_PATTERN = re.compile(r'^journal_time_data_([a-z0-9-]+)\.csv$')
+
+
+class ModelLoadError(Exception):
+  pass
+
+
+def discover_routes(data_dir: str | Path, model_dir: str | Path) -> list[str]:
+  if not Path(data_dir).exists():
+    return []
+  routes = []
+  for path in sorted(Path(data_dir).iterdir()):
+    match = DATASET_PATTERN.match(path.name)
+    if match is not None and Path(model_dir, match[1]).is_dir():
+      routes.append(match[1])
+  return routes
+
+
+def resident_bytes() -> int:
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return 0
+
+
+def disk_bytes(path: Path) -> int:
+  return sum(f.stat().st_size for f in path.rglob('*') if f.is_file()) if path.exists() else 0
+
+
+class RouteStats:
+  def __init__(self):
+    self.hits = 0
+    self.hit_time = 0.0
+    self.loads = 0
+    self.load_time = 0.0
+    self.last_load_time = 0.0
+    self.evictions = 0
+    self.failures = 0
+    self.reloads = 0
+    self.last_reload_time = 0.0
+
+
+# Inference engines of the routes, loaded on first use and kept in a bounded LRU
+# The size of a model is the resident memory it added while loading (at least its size on disk), loads only hold
+# the lock of their route so the first loads of different routes (and reloads) run concurrently, a measure taken
+# during another load may include part of it and overestimate the size, which errs on the side of the budget
+# Concurrent first requests of a route wait for the same load, evicted (or reloaded) engines stay usable by the
+# requests holding them and are freed once released
+class ModelRegistry:
+  def __init__(self, loader: Callable[[str], Any], model_dir: str | Path, *, max_bytes: int, max_models: int,
+               prepare: Callable[[str], None] | None = None):
+    self.loader = loader
+    # Called before measuring a load, e.g. to import the runtime shared by all the models
+    self.prepare = prepare
+    self.model_dir = Path(model_dir)
+    self.max_bytes = max_bytes
+    self.max_models = max_models
+    self.nbytes = 0
+    self.route_stats: dict[str, RouteStats] = {}
+    # route -> (engine, size)
+    self._entries: OrderedDict[str, tuple[Any, int]] = OrderedDict()
+    self._lock = threading.Lock()
+    self._route_locks: dict[str, threading.Lock] = {}
+    self._loading: dict[str, asyncio.Future] = {}
+
+  def _stats(self, route: str) -> RouteStats:
+    stats = self.route_stats.get(route)
+    if stats is None:
+      stats = self.route_stats[route] = RouteStats()
+    return stats
+
+  def _route_lock(self, route: str) -> threading.Lock:
+    with self._lock:
+      return self._route_locks.setdefault(route, threading.Lock())
+
+  def _lookup(self, route: str) -> Any | None:
+    start = time.perf_counter()
+    with self._lock:
+      entry = self._entries.get(route)
+      if entry is None:
+        return None
+      self._entries.move_to_end(route)
+      stats = self._stats(route)
+      stats.hits += 1
+      stats.hit_time += time.perf_counter() - start
+      return entry[0]
+
+  # Load the engine of the route, return it with its size and the load time (called with the route lock held)
+  def _load(self, route: str) -> tuple[Any, int, float]:
+    start = time.perf_counter()
+    try:
+      if self.prepare is not None:
+        self.prepare(route)
+      before = resident_bytes()
+      engine = self.loader(route)
+    except Exception as err:
+      self._stats(route).failures += 1
+      raise ModelLoadError(f'Unable to load the model of {route.upper()}: {err}') from err
+    size = max(resident_bytes() - before, disk_bytes(self.model_dir / route))
+    return engine, size, time.perf_counter() - start
+
+  # Engine of the route, loaded in the calling thread if it is not resident
+  def engine(self, route: str) -> Any:
+    engine = self._lookup(route)
+    if engine is not None:
+      return engine
+    with self._route_lock(route):
+      # Loaded by another thread while waiting
+      engine = self._lookup(route)
+      if engine is not None:
+        return engine
+      engine, size, elapsed = self._load(route)
+      stats = self._stats(route)
+      stats.loads += 1
+      stats.load_time += elapsed
+      stats.last_load_time = elapsed
+      self._insert(route, engine, size)
+      print(f'Loaded the model of {route.upper()} in {elapsed:.2f}s ({size / 2 ** 20:.0f}MiB)', flush=True)
+      return engine
+
+  # Load the model of a resident route again and swap it in, requests keep getting the previous engine until the
+  # new one is loaded and warmed up
+  # Return False if the route is not resident, its next load picks up the new model
+  def reload(self, route: str) -> bool:
+    with self._route_lock(route):
+      with self._lock:
+        if route not in self._entries:
+          return False
+      engine, size, elapsed = self._load(route)
+      stats = self._stats(route)
+      stats.reloads += 1
+      stats.last_reload_time = elapsed
+      self._insert(route, engine, size)
+      print(f'Reloaded the model of {route.upper()} in {elapsed:.2f}s ({size / 2 ** 20:.0f}MiB)', flush=True)
+      return True
+
+  # Engine of the route, concurrent loads of the same route are shared
+  async def get(self, route: str) -> Any:
+    engine = self._lookup(route)
+    if engine is not None:
+      return engine
+    future = self._loading.get(route)
+    if future is None:
+      future = asyncio.ensure_future(asyncio.to_thread(self.engine, route))
+      self._loading[route] = future
+      future.add_done_callback(lambda _: self._loading.pop(route, None))
+    return await asyncio.shield(future)
+
+  def _insert(self, route: str, engine: Any, size: int):
+    evicted = []
+    with self._lock:
+      # Engine replaced by a reload
+      replaced = self._entries.pop(route, None)
+      if replaced is not None:
+        self.nbytes -= replaced[1]
+      self._entries[route] = (engine, size)
+      self.nbytes += size
+      # The model just loaded is kept even if it exceeds the budget alone
+      while len(self._entries) > 1 and (self.nbytes > self.max_bytes or len(self._entries) > self.max_models):
+        name, (_, old_size) = self._entries.popitem(last=False)
+        self.nbytes -= old_size
+        self._stats(name).evictions += 1
+        evicted.append(name)
+    if evicted or replaced is not None:
+      del replaced
+      gc.collect()
+    if evicted:
+      print(f'Evicted the models of {", ".join(name.upper() for name in evicted)}', flush=True)
+
+  def stats(self) -> dict[str, Any]:
+    with self._lock:
+      sizes = {route: size for route, (_, size) in self._entries.items()}
+    routes = {}
+    for route, stats in sorted(self.route_stats.items()):
+      routes[route] = {
+        "resident": route in sizes,
+        "size_mb": sizes[route] / 2 ** 20 if route in sizes else None,
+        "hits": stats.hits,
+        "avg_hit_us": stats.hit_time / stats.hits * 1e6 if stats.hits else None,
+        "loads": stats.loads,
+        "last_load_ms": stats.last_load_time * 1000 if stats.loads else None,
+        "avg_load_ms": stats.load_time / stats.loads * 1000 if stats.loads else None,
+        "evictions": stats.evictions,
+        "failures": stats.failures,
+        "reloads": stats.reloads,
+        "last_reload_ms": stats.last_reload_time * 1000 if stats.reloads else None,
+      }
+    return {
+      "models": len(sizes),
+      "max_models": self.max_models,
+      "bytes": self.nbytes,
+      "max_bytes": self.max_bytes,
+      "routes": routes,
+    }
@@ -0,0 +1,197 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+MINUTE_NS = 60 * 10 ** 9
+HOUR_NS = 60 * MINUTE_NS
+DAY_NS = 24 * HOUR_NS
+# Number of model input features: journey time, week_day, hour, minute
+N_FEATURES = 4
+
+
+def to_ns(time: datetime) -> int:
+  return pd.Timestamp(time).value
+
+
+# Calendar features of the model input, same as merge_dataset.py (DatetimeIndex dayofweek, hour, minute)
+# 1970-01-01 is a Thursday (dayofweek=3)
+def calendar_features(time_ns: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  week_day = (time_ns // DAY_NS + 3) % 7
+  hour = time_ns % DAY_NS // HOUR_NS
+  minute = time_ns % HOUR_NS // MINUTE_NS
+  return week_day, hour, minute
+
+
+# Fixed-interval time series of one road, value i is sampled at start + i * step
+# Lookups are offset arithmetic, range slices are views of the value array
+# values is the loaded dataset (possibly a read-only memory map), points appended later are kept in a private
+# tail buffer, so appending never copies the dataset
+class SeriesStore:
+  def __init__(self, name: str, start_ns: int, step_ns: int, values: np.ndarray):
+    self.name = name
+    self.start_ns = start_ns
+    self.step_ns = step_ns
+    self.values = values
+    self._tail = np.empty(0, dtype=np.float32)
+    self._n_tail = 0
+
+  @classmethod
+  def from_frame(cls, data: pd.DataFrame) -> 'SeriesStore':
+    index = data.index.to_numpy(dtype='datetime64[ns]').view(np.int64)
+    step = int(index[1] - index[0])
+    if np.any(np.diff(index) != step):
+      raise ValueError(f'{data.columns[0]} is not sampled at a fixed interval')
+    return cls(data.columns[0], int(index[0]), step, data.iloc[:, 0].to_numpy(dtype=np.float32))
+
+  def __len__(self):
+    return len(self.values) + self._n_tail
+
+  @property
+  def nbytes(self) -> int:
+    return self.values.nbytes + self._tail.nbytes
+
+  @property
+  def step(self) -> timedelta:
+    return timedelta(microseconds=self.step_ns // 1000)
+
+  @property
+  def start(self) -> datetime:
+    return pd.Timestamp(self.start_ns).to_pydatetime()
+
+  @property
+  def end(self) -> datetime:
+    return pd.Timestamp(self.start_ns + (len(self) - 1) * self.step_ns).to_pydatetime()
+
+  # Index of the point sampled at time (rounded down to the step)
+  def offset(self, time: datetime) -> int:
+    return (to_ns(time) - self.start_ns) // self.step_ns
+
+  # Append consecutive points after the end of the series
+  # Readers on other threads see either the old or the new length, never a partially written point
+  def append(self, values: np.ndarray):
+    n = self._n_tail
+    if n + len(values) > len(self._tail):
+      tail = np.empty(max(2 * len(self._tail), n + len(values), 256), dtype=np.float32)
+      tail[:n] = self._tail[:n]
+      self._tail = tail
+    self._tail[n:n + len(values)] = values
+    self._n_tail = n + len(values)
+
+  # Values of the points [first, last), a view unless the range spans the dataset and the appended points
+  def get(self, first: int, last: int) -> np.ndarray:
+    n_base = len(self.values)
+    if last <= n_base:
+      return self.values[first:last]
+    tail = self._tail
+    if first >= n_base:
+      return tail[first - n_base:last - n_base]
+    return np.concatenate([self.values[first:], tail[:last - n_base]])
+
+  # Values in [start_time, end_time] inclusively
+  def slice(self, start_time: datetime, end_time: datetime) -> np.ndarray:
+    first = max(self.offset(start_time), 0)
+    return self.get(first, min(max(self.offset(end_time) + 1, first), len(self)))
+
+  def _take(self, rows: np.ndarray) -> np.ndarray:
+    n_base = len(self.values)
+    if rows.size == 0 or rows.max() < n_base:
+      return self.values[rows]
+    tail = self._tail
+    return np.where(rows < n_base, self.values[np.minimum(rows, n_base - 1)], tail[np.maximum(rows - n_base, 0)])
+
+  def timestamps(self, first: int, n: int) -> pd.DatetimeIndex:
+    return pd.date_range(start=pd.Timestamp(self.start_ns + first * self.step_ns), periods=n,
+                         freq=pd.Timedelta(self.step_ns))
+
+  # Model inputs (len(ends), n_steps, N_FEATURES) of the windows ending before each offset in ends (exclusive)
+  # Calendar features are derived from the timestamp
+  def model_inputs(self, ends: np.ndarray, n_steps: int) -> np.ndarray:
+    rows = np.asarray(ends, dtype=np.int64)[:, None] + np.arange(-n_steps, 0)
+    result = np.empty((*rows.shape, N_FEATURES), dtype=np.float32)
+    result[..., 0] = self._take(rows)
+    for idx, feature in enumerate(calendar_features(self.start_ns + rows * self.step_ns)):
+      result[..., idx + 1] = feature
+    return result
+
+  # Model inputs (n_windows, n_steps, N_FEATURES) of the windows ending before first_end, first_end + stride, ...
+  # Same as model_inputs, but the features of the covered points are built once and the windows are a strided view
+  # of them, overlapping windows share their rows instead of being gathered
+  def strided_inputs(self, first_end: int, n_windows: int, n_steps: int, stride: int = 1) -> np.ndarray:
+    first = first_end - n_steps
+    last = first_end + (n_windows - 1) * stride
+    features = np.empty((last - first, N_FEATURES), dtype=np.float32)
+    features[:, 0] = self.get(first, last)
+    for idx, feature in enumerate(calendar_features(self.start_ns + np.arange(first, last) * self.step_ns)):
+      features[:, idx + 1] = feature
+    return sliding_window_view(features, (n_steps, N_FEATURES))[::stride, 0]
+
+  def model_input(self, end: int, n_steps: int) -> np.ndarray:
+    return self.model_inputs(np.array([end]), n_steps)[0]
+
+  # Values (len(firsts), n) of the n points starting at each offset in firsts, e.g. the actual values of forecasts
+  def windows(self, firsts: np.ndarray, n: int) -> np.ndarray:
+    return self._take(np.asarray(firsts, dtype=np.int64)[:, None] + np.arange(n))
+
+
+# Compare memory and lookup latency of the DataFrame and the SeriesStore serving paths
+if __name__ == '__main__':
+  from dataset_cache import load_dataset
+
+  parser = argparse.ArgumentParser(description='Compare the DataFrame and SeriesStore serving paths')
+  parser.add_argument('--tunnel', nargs='+', default=['cht', 'eht', 'wht'])
+  parser.add_argument('-n', type=int, default=2000, help='Lookups per path')
+  parser.add_argument('--n-steps', type=int, default=12 * 6)
+  parser.add_argument('--fetch-days', type=int, default=7)
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(0)
+  for tunnel in args.tunnel:
+    data = load_dataset(f'data/journal_time_data_{tunnel}.csv', use_cache=False)
+    store = SeriesStore.from_frame(data)
+    frame_bytes = data.memory_usage(index=True, deep=True).sum()
+    print(f'{tunnel.upper()} memory: DataFrame={frame_bytes / 1024:.0f}KiB SeriesStore={store.nbytes / 1024:.0f}KiB')
+
+    fetch_n = args.fetch_days * DAY_NS // store.step_ns
+    ends = rng.integers(max(args.n_steps, fetch_n), len(store), args.n)
+    times = [pd.Timestamp(store.start_ns + int(end - 1) * store.step_ns).to_pydatetime() for end in ends]
+    step = store.step
+
+    start = time.perf_counter()
+    for t in times:
+      data.loc[t - step * (args.n_steps - 1):t].to_numpy()
+    frame_predict = (time.perf_counter() - start) / args.n * 1e6
+    start = time.perf_counter()
+    for end in ends:
+      store.model_input(end, args.n_steps)
+    store_predict = (time.perf_counter() - start) / args.n * 1e6
+
+    start = time.perf_counter()
+    for t in times:
+      data.loc[t - step * (fetch_n - 1):t, data.columns[0]].to_numpy()
+    frame_fetch = (time.perf_counter() - start) / args.n * 1e6
+    start = time.perf_counter()
+    for t in times:
+      store.slice(t - step * (fetch_n - 1), t)
+    store_fetch = (time.perf_counter() - start) / args.n * 1e6
+
+    print(f'{tunnel.upper()} model input: DataFrame={frame_predict:.1f}us SeriesStore={store_predict:.1f}us')
+    print(f'{tunnel.upper()} {args.fetch_days}-day range: DataFrame={frame_fetch:.1f}us SeriesStore={store_fetch:.1f}us')
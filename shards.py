@@ -0,0 +1,237 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Time-partitioned Parquet shards of the journey time data, written by download.py --output long|wide
+# <root>/<layout>/<partition>/part-<first timestamp>-<seq>.parquet, e.g. data/journey-shards/long/2022-01-01/
+# long: one row per road and capture (timestamp, location, destination, journey_time, color)
+# wide: one row per capture, one journey time column per road (e.g. K02-CH), -1 when the road is missing,
+#       the same table as process_datasets.py
+# Timestamps are truncated to the minute as in process_datasets.py
+LAYOUTS = ('long', 'wide')
+PARTITIONS = {
+  'day': '%Y-%m-%d',
+  'month': '%Y-%m',
+}
+DEFAULT_BATCH_SIZE = 20000
+
+
+# Buffer the parsed captures and append them to the shards every batch_size records
+# Each flush writes one new part per partition touched, close() compacts them into a single sorted part
+class ShardWriter:
+  def __init__(self, root: str | Path, *, layout: str = 'long', partition: str = 'day',
+               batch_size: int = DEFAULT_BATCH_SIZE):
+    if layout not in LAYOUTS:
+      raise ValueError(f'Unknown layout {layout}')
+    if partition not in PARTITIONS:
+      raise ValueError(f'Unknown partition {partition}')
+    self.root = Path(root, layout)
+    self.layout = layout
+    self.partition = partition
+    self.batch_size = batch_size
+    self._timestamps: list[datetime] = []
+    self._rows: list[list[str]] = []
+    # Number of records of each capture (long layout)
+    self._counts: list[int] = []
+    self._touched: set[str] = set()
+    self._seq = 0
+    # Statistics
+    self.n_records = 0
+    self.n_parts = 0
+    self.flush_time = 0.0
+
+  # Add one capture parsed by download.extract_journey_time_data, rows starts with the header
+  def add(self, title: str, rows: list[list[str]]):
+    self._timestamps.append(datetime.strptime(title[:13], '%Y%m%d-%H%M'))
+    self._rows.extend(rows[1:])
+    self._counts.append(len(rows) - 1)
+    if len(self._rows) >= self.batch_size:
+      self.flush()
+
+  def flush(self):
+    if not self._timestamps:
+      return
+    start = time.perf_counter()
+    timestamps = pd.DatetimeIndex(self._timestamps).repeat(self._counts)
+    data = pd.DataFrame(self._rows, columns=['location', 'destination', 'journey_time', 'color'])
+    data.insert(0, 'timestamp', timestamps)
+    self._timestamps, self._rows, self._counts = [], [], []
+    data = self.to_layout(data)
+    for partition, part in data.groupby(data['timestamp'].dt.strftime(PARTITIONS[self.partition]), sort=False):
+      self.write_part(partition, part)
+    self.flush_time += time.perf_counter() - start
+
+  # Convert the raw string records to the column types of the layout
+  def to_layout(self, data: pd.DataFrame) -> pd.DataFrame:
+    # Unavailable journey times stay -1, invalid ones become NaN
+    data['journey_time'] = pd.to_numeric(data['journey_time'], errors='coerce').astype(np.float32)
+    if self.layout == 'wide':
+      data['road'] = data['location'] + '-' + data['destination']
+      data = data.pivot_table(index='timestamp', columns='road', values='journey_time', aggfunc='last',
+                              dropna=False)
+      data = data.fillna(-1).astype(np.float32).reset_index()
+      data.columns.name = None
+      return data
+    data['color'] = pd.to_numeric(data['color'], errors='coerce').astype(np.float32)
+    return data
+
+  def write_part(self, partition: str, data: pd.DataFrame):
+    part_dir = Path(self.root, partition)
+    part_dir.mkdir(parents=True, exist_ok=True)
+    self._seq += 1
+    name = f'part-{data["timestamp"].iloc[0]:%Y%m%d%H%M}-{os.getpid()}-{self._seq}.parquet'
+    write_table(Path(part_dir, name), data)
+    self._touched.add(partition)
+    self.n_records += len(data)
+    self.n_parts += 1
+
+  # Flush the buffer and merge the parts of every partition written by this writer
+  def close(self):
+    self.flush()
+    for partition in sorted(self._touched):
+      compact(Path(self.root, partition), self.layout)
+    self._touched.clear()
+
+
+def write_table(path: Path, data: pd.DataFrame):
+  # Write then rename, so readers never see a partial file
+  tmp = path.with_name(f'.{path.name}.tmp')
+  table = pa.Table.from_pandas(data, preserve_index=False)
+  pq.write_table(table, tmp, compression='zstd')
+  os.replace(tmp, path)
+
+
+def read_parts(files: list[Path], start: datetime | None = None, end: datetime | None = None,
+               columns: list[str] | None = None) -> pd.DataFrame:
+  filters = []
+  if start is not None:
+    filters.append(('timestamp', '>=', pd.Timestamp(start)))
+  if end is not None:
+    filters.append(('timestamp', '<', pd.Timestamp(end)))
+  frames = []
+  for file in files:
+    if columns is not None:
+      # The roads of the wide parts may differ
+      names = pq.read_schema(file).names
+      read_columns = ['timestamp', *[c for c in columns if c in names and c != 'timestamp']]
+    else:
+      read_columns = None
+    frames.append(pq.read_table(file, columns=read_columns, filters=filters or None).to_pandas())
+  if not frames:
+    return pd.DataFrame(columns=['timestamp'])
+  return pd.concat(frames, ignore_index=True)
+
+
+# Wide parts written at different times may hold different roads, missing roads are -1
+def sort_roads(data: pd.DataFrame) -> pd.DataFrame:
+  roads = sorted(c for c in data.columns if c != 'timestamp')
+  return data[['timestamp', *roads]].fillna(-1).astype({road: np.float32 for road in roads})
+
+
+# Merge the parts of one partition into a single part sorted by timestamp, dropping the duplicated records
+def compact(part_dir: Path, layout: str):
+  files = sorted(part_dir.glob('part-*.parquet'))
+  if len(files) <= 1:
+    return
+  data = read_parts(files)
+  keys = ['timestamp'] if layout == 'wide' else ['timestamp', 'location', 'destination']
+  data = data.drop_duplicates(keys, keep='last').sort_values(keys, kind='stable', ignore_index=True)
+  if layout == 'wide':
+    data = sort_roads(data)
+  output = Path(part_dir, f'part-{data["timestamp"].iloc[0]:%Y%m%d%H%M}-compacted.parquet')
+  write_table(output, data)
+  for file in files:
+    if file != output:
+      file.unlink()
+
+
+# Parts of the partitions overlapping [start, end)
+def shard_files(root: str | Path, layout: str = 'long', start: datetime | None = None,
+                end: datetime | None = None) -> list[Path]:
+  files = []
+  if not Path(root, layout).exists():
+    return files
+  for part_dir in sorted(Path(root, layout).iterdir()):
+    if not part_dir.is_dir():
+      continue
+    # Partition names sort in time order and are prefixes of the ISO timestamp
+    first = part_dir.name
+    if start is not None and first < start.isoformat()[:len(first)]:
+      continue
+    if end is not None and first > end.isoformat()[:len(first)]:
+      continue
+    files.extend(sorted(part_dir.glob('part-*.parquet')))
+  return files
+
+
+# Read the records in [start, end), only the partitions in the range are opened
+def read_shards(root: str | Path, start: datetime | None = None, end: datetime | None = None, *,
+                layout: str = 'long', columns: list[str] | None = None) -> pd.DataFrame:
+  data = read_parts(shard_files(root, layout, start, end), start, end, columns)
+  if data.empty:
+    return data
+  if layout == 'wide':
+    data = sort_roads(data)
+    return data.sort_values('timestamp', kind='stable', ignore_index=True)
+  return data.sort_values(['timestamp', 'location', 'destination'], kind='stable', ignore_index=True)
+
+
+# Wide table of process_datasets.py (timestamp x road, -1 when missing) from the long records
+def pivot_long(data: pd.DataFrame) -> pd.DataFrame:
+  data = data.assign(road=data['location'] + '-' + data['destination'])
+  wide = data.pivot_table(index='timestamp', columns='road', values='journey_time', aggfunc='last', dropna=False)
+  wide.columns.name = None
+  return wide.fillna(-1)
+
+
+# Compare reading a period from the per-minute csv files and from the shards
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Range-read the journey time shards')
+  parser.add_argument('--csv-dir', default='data/journey-data', help='Per-minute csv written by download.py')
+  parser.add_argument('--shard-dir', default='data/journey-shards')
+  parser.add_argument('--layout', choices=LAYOUTS, default='long')
+  parser.add_argument('--start-time', required=True)
+  parser.add_argument('--end-time', required=True)
+  args = parser.parse_args()
+
+  start_time, end_time = datetime.fromisoformat(args.start_time), datetime.fromisoformat(args.end_time)
+  start = time.perf_counter()
+  data = read_shards(args.shard_dir, start_time, end_time, layout=args.layout)
+  elapsed = time.perf_counter() - start
+  files = shard_files(args.shard_dir, args.layout, start_time, end_time)
+  size = sum(f.stat().st_size for f in files)
+  print(f'Shards: {len(data)} rows from {len(files)} files ({size / 1024:.0f}KiB) in {elapsed:.3f}s', flush=True)
+
+  if Path(args.csv_dir).exists():
+    start = time.perf_counter()
+    # Same selection as process_datasets.py, every file of the period
+    names = [f for f in os.listdir(args.csv_dir) if f.endswith('.csv') and
+             start_time.strftime('%Y%m%d-%H%M') <= f[:13] < end_time.strftime('%Y%m%d-%H%M')]
+    frames = [pd.read_csv(Path(args.csv_dir, f)).assign(timestamp=datetime.strptime(f[:13], '%Y%m%d-%H%M'))
+              for f in names]
+    elapsed = time.perf_counter() - start
+    size = sum(Path(args.csv_dir, f).stat().st_size for f in names)
+    print(f'CSV: {sum(len(f) for f in frames)} rows from {len(names)} files ({size / 1024:.0f}KiB) '
+          f'in {elapsed:.3f}s', flush=True)
@@ -0,0 +1,133 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import asyncio
+import random
+import zlib
+from datetime import datetime
+
+from aiohttp import web
+
+# Local stand-in of the data.gov.hk historical archive and the live Journeytimev2 feed for offline testing
+# GET /v1/historical-archive/get-file?url=<resource>&time=YYYYMMDD-HHMM  (ARCHIVE_URL of download.py)
+# GET /td/jss/Journeytimev2.xml  (UPSTREAM_URL of api.py)
+# Journey times are synthetic but deterministic for a given capture time
+ROADS = [
+  ('H1', 'CH'), ('H1', 'EH'), ('H11', 'CH'), ('H11', 'EH'), ('H2', 'CH'), ('H2', 'EH'), ('H2', 'WH'), ('H3', 'CH'),
+  ('H3', 'WH'), ('H4', 'CH'), ('H4', 'EH'), ('H4', 'WH'), ('H5', 'CH'), ('H5', 'EH'), ('H5', 'WH'), ('K01', 'CH'),
+  ('K01', 'WH'), ('K02', 'CH'), ('K02', 'EH'), ('K03', 'CH'), ('K03', 'EH'), ('K03', 'WH'), ('K04', 'CH'),
+  ('K04', 'WH'), ('K05', 'CH'), ('K05', 'EH'), ('K06', 'CH'), ('K06', 'WH'),
+]
+JOURNEY_TIME_RESOURCE = 'https://resource.data.one.gov.hk/td/jss/Journeytimev2.xml'
+TRAFFIC_DETECTORS_RESOURCE = 'https://resource.data.one.gov.hk/td/traffic-detectors/rawSpeedVol-all.xml'
+DIRECTIONS = ['North', 'East', 'South', 'West', 'North East', 'South East', 'North West', 'South West']
+LANES = ['Fast Lane', 'Middle Lane 1', 'Middle Lane 2', 'Slow Lane']
+N_DETECTORS = 800
+
+
+def journey_time_xml(captured: datetime) -> str:
+  rng = random.Random(int(captured.timestamp()))
+  items = []
+  for location, destination in ROADS:
+    # -1 when the journey time is unavailable
+    value = -1 if rng.random() < 0.02 else 5 + (zlib.crc32(f'{location}{destination}'.encode()) % 20) + \
+                                           rng.randint(0, 6)
+    items.append(f'<jtis_journey_time><LOCATION_ID>{location}</LOCATION_ID>'
+                 f'<DESTINATION_ID>{destination}</DESTINATION_ID>'
+                 f'<CAPTURE_DATE>{captured.isoformat()}</CAPTURE_DATE><JOURNEY_TYPE>1</JOURNEY_TYPE>'
+                 f'<JOURNEY_DATA>{value}</JOURNEY_DATA><COLOUR_ID>{1 + value // 10 if value > 0 else 0}</COLOUR_ID>'
+                 f'<JOURNEY_DESC></JOURNEY_DESC></jtis_journey_time>')
+  return f'<?xml version="1.0" encoding="UTF-8"?><jtis_journey_list>{"".join(items)}</jtis_journey_list>'
+
+
+# Two 30-second periods of the speed and volume of each detector lane
+def traffic_detectors_xml(captured: datetime) -> str:
+  rng = random.Random(int(captured.timestamp()))
+  periods = []
+  for start in (0, 30):
+    detectors = []
+    for idx in range(N_DETECTORS):
+      n_lanes = 1 + idx % len(LANES)
+      lanes = ''.join(f'<lane><lane_id>{lane}</lane_id><speed>{rng.randint(20, 90)}</speed>'
+                      f'<occupancy>{rng.randint(0, 40)}</occupancy><volume>{rng.randint(0, 20)}</volume>'
+                      f'<s.d.>{rng.uniform(0, 10):.1f}</s.d.><valid>Y</valid></lane>'
+                      for lane in (LANES[:1] + LANES[-(n_lanes - 1):] if n_lanes > 1 else LANES[:1]))
+      detectors.append(f'<detector><detector_id>AID{idx:05d}</detector_id>'
+                       f'<direction>{DIRECTIONS[idx % len(DIRECTIONS)]}</direction><lanes>{lanes}</lanes></detector>')
+    period_from = captured.replace(second=start).strftime('%H:%M:%S')
+    period_to = captured.replace(second=start + 29).strftime('%H:%M:%S')
+    periods.append(f'<period><period_from>{period_from}</period_from><period_to>{period_to}</period_to>'
+                   f'<detectors>{"".join(detectors)}</detectors></period>')
+  return f'<?xml version="1.0" encoding="UTF-8"?><raw_speed_volume_list><date>{captured.date().isoformat()}</date>' \
+         f'<periods>{"".join(periods)}</periods></raw_speed_volume_list>'
+
+
+def create_app(*, latency_ms: float = 0, fail_rate: float = 0, missing_rate: float = 0) -> web.Application:
+  stats = {'requests': 0, 'failed': 0, 'missing': 0}
+
+  async def maybe_fail() -> web.Response | None:
+    stats['requests'] += 1
+    if latency_ms > 0:
+      await asyncio.sleep(random.expovariate(1000 / latency_ms))
+    if random.random() < fail_rate:
+      stats['failed'] += 1
+      return web.Response(status=503, headers={'Retry-After': '0.1'})
+    return None
+
+  async def get_file(request: web.Request) -> web.Response:
+    if (error := await maybe_fail()) is not None:
+      return error
+    try:
+      requested = datetime.strptime(request.query['time'], '%Y%m%d-%H%M')
+    except (KeyError, ValueError):
+      return web.Response(status=400, text='Invalid time')
+    resource = request.query.get('url')
+    if resource not in (JOURNEY_TIME_RESOURCE, TRAFFIC_DETECTORS_RESOURCE) or random.random() < missing_rate:
+      stats['missing'] += 1
+      return web.Response(status=404)
+    if resource == TRAFFIC_DETECTORS_RESOURCE:
+      return web.Response(text=traffic_detectors_xml(requested), content_type='text/xml')
+    # The archive returns the latest capture at or before the requested minute
+    captured = requested.replace(second=random.Random(requested.toordinal() * 1440 + requested.minute).randint(0, 59))
+    return web.Response(text=journey_time_xml(captured), content_type='text/xml')
+
+  async def live(_: web.Request) -> web.Response:
+    if (error := await maybe_fail()) is not None:
+      return error
+    return web.Response(text=journey_time_xml(datetime.now().replace(microsecond=0)), content_type='text/xml')
+
+  async def get_stats(_: web.Request) -> web.Response:
+    return web.json_response(stats)
+
+  app = web.Application()
+  app.router.add_get('/v1/historical-archive/get-file', get_file)
+  app.router.add_get('/td/jss/Journeytimev2.xml', live)
+  app.router.add_get('/stats', get_stats)
+  return app
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Serve a local stand-in of the traffic data APIs')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8882)
+  parser.add_argument('--latency-ms', type=float, default=0, help='Mean response latency')
+  parser.add_argument('--fail-rate', type=float, default=0, help='Fraction of requests answered with 503')
+  parser.add_argument('--missing-rate', type=float, default=0, help='Fraction of archive requests answered with 404')
+  args = parser.parse_args()
+  print(f'ARCHIVE_URL=http://{args.host}:{args.port}/v1/historical-archive/get-file', flush=True)
+  print(f'UPSTREAM_URL=http://{args.host}:{args.port}/td/jss/Journeytimev2.xml', flush=True)
+  web.run_app(create_app(latency_ms=args.latency_ms, fail_rate=args.fail_rate, missing_rate=args.missing_rate),
+              host=args.host, port=args.port, print=None)
@@ -0,0 +1,108 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import importlib
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+from series_store import SeriesStore
+
+STEP_NS = 5 * 60 * 10 ** 9
+START = pd.Timestamp('2023-01-01')
+
+
+def write_dataset(path: Path, values: np.ndarray):
+  index = pd.date_range(START, periods=len(values), freq='5min')
+  pd.DataFrame({'timestamp': index.strftime('%Y-%m-%dT%H:%M:%S'), 'K02-CH': values}).to_csv(path, index=False)
+
+
+def wait_ready(client: TestClient):
+  deadline = time.monotonic() + 30
+  while client.get('/readyz').status_code != 200:
+    assert time.monotonic() < deadline, 'the routes were not loaded'
+    time.sleep(0.05)
+
+
+# api.py with its state (datasets, versions) in a fresh data directory, the models are not loaded
+@pytest.fixture
+def api(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+  for tunnel in ('cht', 'eht', 'wht'):
+    (tmp_path / 'data' / 'model' / tunnel).mkdir(parents=True)
+    (tmp_path / 'data' / 'model' / tunnel / 'VERSION').write_text('1')
+    write_dataset(tmp_path / 'data' / f'journal_time_data_{tunnel}.csv', np.arange(1000) % 50 + 10)
+  monkeypatch.chdir(tmp_path)
+  for name, value in {'PRELOAD_MODELS': '', 'ADMIN_TOKEN': 'secret', 'LIVE_INGESTION': '0',
+                      'FORECAST_CACHE_MB': '0', 'RELOAD_INTERVAL': '0'}.items():
+    monkeypatch.setenv(name, value)
+  sys.modules.pop('api', None)
+  yield importlib.import_module('api')
+  sys.modules.pop('api', None)
+
+
+def store(values: np.ndarray, tail: np.ndarray | None = None) -> SeriesStore:
+  series = SeriesStore('K02-CH', START.value, STEP_NS, values.astype(np.float32))
+  if tail is not None:
+    series.append(tail.astype(np.float32))
+  return series
+
+
+# A shortened and revised csv is served as it is, the points of the previous dataset are not kept
+def test_reload_shortened_dataset(api):
+  path = Path(api.dataset_path('cht'))
+  with TestClient(api.app) as client:
+    wait_ready(client)
+    assert pd.Timestamp(client.get('/get_meta').json()['timestamp_end']) == START + pd.Timedelta(minutes=5 * 999)
+
+    write_dataset(path, np.arange(800) % 50 + 100)
+    response = client.post('/reload', params={'tunnel': 'cht'}, headers={'X-Admin-Token': 'secret'})
+    assert response.json()['routes']['cht']['status'] == 'reloaded'
+
+    end = START + pd.Timedelta(minutes=5 * 799)
+    assert pd.Timestamp(client.get('/get_meta').json()['timestamp_end']) == end
+    response = client.get('/fetch', params={'tunnel': 'cht', 'start_time': (end - pd.Timedelta(hours=1)).isoformat(),
+                                            'end_time': end.isoformat()})
+    assert response.json()['results'] == (np.arange(787, 800) % 50 + 100).tolist()
+    response = client.get('/fetch', params={'tunnel': 'cht', 'start_time': end.isoformat(),
+                                            'end_time': (end + pd.Timedelta(hours=1)).isoformat()})
+    assert response.status_code == 422
+
+
+def test_carry_live_points(api):
+  base = np.arange(100)
+  tail = np.arange(100, 110)
+  # The live points continue the new dataset, whether it ends with the old one or inside the live points
+  new = store(base)
+  api.carry_live_points(store(base, tail), new)
+  np.testing.assert_array_equal(new.get(0, len(new)), np.arange(110))
+  new = store(np.arange(105) + 1000)
+  api.carry_live_points(store(base, tail), new)
+  np.testing.assert_array_equal(new.get(100, len(new)), [1100, 1101, 1102, 1103, 1104, 105, 106, 107, 108, 109])
+  # Points of the old dataset are never carried, the live points would leave a gap after a shortened dataset
+  new = store(np.arange(80))
+  api.carry_live_points(store(base, tail), new)
+  assert len(new) == 80
+  new = store(np.arange(90))
+  api.carry_live_points(store(base), new)
+  assert len(new) == 90
+  # Nothing after a dataset longer than the old series
+  new = store(np.arange(120))
+  api.carry_live_points(store(base, tail), new)
+  assert len(new) == 120
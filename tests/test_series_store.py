@@ -0,0 +1,48 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import numpy as np
+import pytest
+
+from series_store import SeriesStore
+
+STEP_NS = 5 * 60 * 10 ** 9
+N_STEPS = 72
+
+
+# Dataset of 300 points (2023-01-01 00:00) with 100 appended points in the tail buffer
+@pytest.fixture
+def store() -> SeriesStore:
+  values = np.arange(300, dtype=np.float32)
+  store = SeriesStore('cht', 1672531200 * 10 ** 9, STEP_NS, values)
+  store.append(np.arange(300, 400, dtype=np.float32))
+  return store
+
+
+# Windows in the dataset, spanning the dataset and the tail buffer, and in the tail buffer only
+@pytest.mark.parametrize('first_end', [N_STEPS, 250, 300, 372])
+@pytest.mark.parametrize('stride', [1, 3, 12])
+def test_strided_inputs_match_model_inputs(store: SeriesStore, first_end: int, stride: int):
+  ends = np.arange(first_end, len(store) + 1, stride)
+  result = store.strided_inputs(first_end, len(ends), N_STEPS, stride)
+  np.testing.assert_array_equal(result, store.model_inputs(ends, N_STEPS))
+
+
+def test_strided_inputs_share_rows(store: SeriesStore):
+  result = store.strided_inputs(250, 100, N_STEPS)
+  assert result.shape == (100, N_STEPS, 4)
+  # A view of one (n_windows + n_steps - 1, N_FEATURES) buffer, not a copy per window
+  assert np.shares_memory(result[0], result[1])
+  assert result[1, 0, 0] == result[0, 1, 0] == 179
@@ -0,0 +1,208 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from series_store import N_FEATURES
+from window_store import WindowStore, build_window_store
+
+# Train the model of each tunnel on the window store of merge_dataset.py --routes tunnels --format npy
+# The saved model takes the same raw input as the served ones (journey time, week_day, hour, minute) and returns
+# the journey time, the normalization of the window store is part of the model
+BATCH_SIZE = 256
+EPOCHS = 20
+PATIENCE = 3
+LSTM_UNITS = 16
+LEARNING_RATE = 1e-3
+# Largest value of the calendar features (week_day, hour, minute)
+CALENDAR_SCALE = [6, 23, 55]
+
+
+# Input pipeline of the windows of one route, the batches are gathered from the memory-mapped store in parallel
+# and prefetched, so the training step never waits on them unless the gathering is slower than the step
+def window_dataset(store: WindowStore, split: str, route: str, batch_size: int, *, stride: int = 1,
+                   shuffle: bool = False, seed: int = 0):
+  import tensorflow as tf
+  indices = store.indices(split, [route], stride=stride)
+  dataset = tf.data.Dataset.from_tensor_slices(indices)
+  if shuffle:
+    dataset = dataset.shuffle(len(indices), seed=seed, reshuffle_each_iteration=True)
+
+  def gather(batch):
+    inputs, targets = tf.numpy_function(store.batch, [batch], (tf.float32, tf.float32))
+    inputs.set_shape([None, store.n_steps, N_FEATURES])
+    targets.set_shape([None, store.n_horizon])
+    return inputs, targets
+
+  return dataset.batch(batch_size).map(gather, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True) \
+    .prefetch(tf.data.AUTOTUNE)
+
+
+# Model on the normalized journey time, the calendar features are scaled to [0, 1]
+def build_model(n_steps: int, n_horizon: int) -> Any:
+  import keras
+  inputs = keras.Input((n_steps, N_FEATURES))
+  x = keras.layers.Rescaling([1.0, *(1 / v for v in CALENDAR_SCALE)])(inputs)
+  x = keras.layers.LSTM(LSTM_UNITS)(x)
+  return keras.Model(inputs, keras.layers.Dense(n_horizon)(x))
+
+
+# Model served by api.py: normalize the raw journey time, run the trained model and restore the journey time
+def serving_model(model: Any, mean: float, std: float) -> Any:
+  import keras
+  inputs = keras.Input(model.input_shape[1:])
+  x = keras.layers.Rescaling([1 / std, 1.0, 1.0, 1.0], offset=[-mean / std, 0.0, 0.0, 0.0])(inputs)
+  return keras.Model(inputs, keras.layers.Rescaling(std, offset=mean)(model(x)))
+
+
+def train_tunnel(store: WindowStore, tunnel: str, *, epochs: int = EPOCHS, batch_size: int = BATCH_SIZE,
+                 stride: int = 1, seed: int = 0, patience: int = PATIENCE) -> tuple[Any, dict[str, Any]]:
+  import keras
+  import tensorflow as tf
+  keras.utils.set_random_seed(seed)
+  model = build_model(store.n_steps, store.n_horizon)
+  optimizer = keras.optimizers.Adam(LEARNING_RATE)
+  loss_fn = keras.losses.MeanSquaredError()
+  train_data = window_dataset(store, 'train', tunnel, batch_size, stride=stride, shuffle=True, seed=seed)
+  val_data = window_dataset(store, 'val', tunnel, batch_size, stride=stride)
+
+  @tf.function
+  def train_step(x, y):
+    with tf.GradientTape() as tape:
+      loss = loss_fn(y, model(x, training=True))
+    optimizer.apply_gradients(zip(tape.gradient(loss, model.trainable_variables), model.trainable_variables))
+    return loss
+
+  @tf.function
+  def val_step(x, y):
+    return tf.reduce_sum(tf.square(model(x, training=False) - y)), tf.size(y)
+
+  history = []
+  best_loss, best_weights, waited = np.inf, model.get_weights(), 0
+  for epoch in range(1, epochs + 1):
+    start = time.perf_counter()
+    stall = 0.0
+    total, n = 0.0, 0
+    iterator = iter(train_data)
+    while True:
+      # Time waiting for the next batch, near zero while the prefetching keeps up
+      wait = time.perf_counter()
+      batch = next(iterator, None)
+      stall += time.perf_counter() - wait
+      if batch is None:
+        break
+      total += float(train_step(*batch))
+      n += 1
+    train_time = time.perf_counter() - start
+
+    sq_error, count = 0.0, 0
+    for x, y in val_data:
+      batch_error, batch_count = val_step(x, y)
+      sq_error += float(batch_error)
+      count += int(batch_count)
+    val_loss = sq_error / max(count, 1)
+    elapsed = time.perf_counter() - start
+    history.append({'epoch': epoch, 'loss': total / max(n, 1), 'val_loss': val_loss, 'time': elapsed,
+                    'train_time': train_time, 'stall': stall})
+    print(f'{tunnel.upper()} epoch {epoch}/{epochs}: loss={total / max(n, 1):.4f} val_loss={val_loss:.4f} '
+          f'time={elapsed:.1f}s (stall {stall:.2f}s, {100 * stall / train_time:.1f}% of training)', flush=True)
+
+    if val_loss < best_loss:
+      best_loss, best_weights, waited = val_loss, model.get_weights(), 0
+    else:
+      waited += 1
+      if waited >= patience:
+        break
+
+  model.set_weights(best_weights)
+  route = store.route_ids([tunnel])[0]
+  return serving_model(model, float(store.mean[route]), float(store.std[route])), {
+    'best_val_loss': best_loss,
+    'history': history,
+  }
+
+
+# Save the model where api.py loads it (<model_dir>/<tunnel>), with the VERSION file read by get_model_version
+# The model is written aside and renamed, so a loader never sees a partially written model
+def save_model(model: Any, model_dir: str | Path, tunnel: str, version: str, info: dict[str, Any]):
+  path = Path(model_dir, tunnel)
+  tmp_dir = Path(f'{path}.tmp-{os.getpid()}')
+  if tmp_dir.exists():
+    shutil.rmtree(tmp_dir)
+  model.save(tmp_dir)
+  Path(tmp_dir, 'VERSION').write_text(version + '\n')
+  Path(tmp_dir, 'train.json').write_text(json.dumps(info, indent=2))
+  if path.exists():
+    shutil.rmtree(path)
+  os.rename(tmp_dir, path)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Train the forecasting model of each tunnel')
+  parser.add_argument('--tunnel', nargs='+', default=['cht', 'eht', 'wht'])
+  parser.add_argument('--features', type=Path, default=Path('data/features_tunnels'),
+                      help='Binary dataset of merge_dataset.py --routes tunnels --format npy')
+  parser.add_argument('--store', type=Path, default=Path('data/windows_tunnels'), help='Window store (built if stale)')
+  parser.add_argument('--model-dir', type=Path, default=Path('data/model'))
+  parser.add_argument('--epochs', type=int, default=EPOCHS)
+  parser.add_argument('--patience', type=int, default=PATIENCE, help='Epochs without improvement before stopping')
+  parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+  parser.add_argument('--stride', type=int, default=1, help='Steps (5 minutes) between the training windows')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--threads', type=int, default=0, help='TensorFlow intra/inter-op threads (0: all cores)')
+  parser.add_argument('--deterministic', action='store_true', help='Use deterministic ops (bit-reproducible, slower)')
+  args = parser.parse_args()
+
+  import tensorflow as tf
+
+  if args.threads > 0:
+    tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+    tf.config.threading.set_inter_op_parallelism_threads(args.threads)
+  if args.deterministic:
+    tf.config.experimental.enable_op_determinism()
+
+  features_meta = Path(args.features, 'meta.json')
+  store_meta = Path(args.store, 'meta.json')
+  if not store_meta.exists() or store_meta.stat().st_mtime < features_meta.stat().st_mtime:
+    build_window_store(args.features, args.store)
+    print(f'Built the window store {args.store}', flush=True)
+  store = WindowStore(args.store)
+
+  version = datetime.now().strftime('%Y%m%d%H%M%S')
+  for tunnel in args.tunnel:
+    start = time.perf_counter()
+    model, result = train_tunnel(store, tunnel, epochs=args.epochs, batch_size=args.batch_size, stride=args.stride,
+                                 seed=args.seed, patience=args.patience)
+    info = {
+      'version': version,
+      'tunnel': tunnel,
+      'dataset': {key: json.loads(features_meta.read_text())[key] for key in ('start', 'step_ns', 'length')},
+      'splits': store.splits,
+      'config': {key: value for key, value in vars(args).items() if not isinstance(value, Path)},
+      **result,
+    }
+    save_model(model, args.model_dir, tunnel, version, info)
+    stall = sum(epoch['stall'] for epoch in result['history'])
+    print(f'Saved {tunnel.upper()} model {version} (val_loss={result["best_val_loss"]:.4f}) in '
+          f'{time.perf_counter() - start:.1f}s, input stall {stall:.2f}s', flush=True)
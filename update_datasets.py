@@ -0,0 +1,283 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+import merge_dataset
+from merge_dataset import BASE_DIR, MERGED, TUNNELS
+from process_datasets import process_journey_data_parallel
+
+# Incremental version of process_datasets.py + merge_dataset.py
+# data/.datasets-manifest.json records the archives pivoted (size, mtime, files and time range), the wide tables
+# merged in order and the columns of the merged dataset
+# data/.datasets-state.npz holds the interpolated 5-minute series of each tunnel and its last observation
+# A new archive is pivoted alone, its rows are appended to the merged dataset and the tunnel series are
+# interpolated again from their last observation, the result is the same as merge_dataset.py on all tables
+MANIFEST = '.datasets-manifest.json'
+STATE = '.datasets-state.npz'
+MANIFEST_FORMAT = 1
+STEP_NS = 5 * 60 * 10 ** 9
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class RebuildRequired(Exception):
+  pass
+
+
+# The settings of merge_dataset.py the outputs depend on, a full rebuild is done when they change
+def build_config() -> dict[str, Any]:
+  return {
+    'format': MANIFEST_FORMAT,
+    'road_pattern': merge_dataset.ROAD_PATTERN,
+    'skip_date': merge_dataset.SKIP_DATE.isoformat(),
+    'tunnel_skip_date': merge_dataset.TUNNEL_SKIP_DATE.isoformat(),
+    'tunnel_until_date': merge_dataset.TUNNEL_UNTIL_DATE.isoformat(),
+    'tunnels': TUNNELS,
+  }
+
+
+def file_info(path: Path) -> dict[str, Any]:
+  stat = path.stat()
+  return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+# Wide table written by process_datasets.py for an archive, e.g. journey-data-3.tar.zstd -> journal_time_data-3.csv
+def table_of(archive: Path) -> Path:
+  name = archive.name.split('.')[0]
+  return Path(BASE_DIR, name.replace('journey-data', 'journal_time_data') + '.csv')
+
+
+# Interpolated 5-minute series of the tunnels, column k of values is TUNNELS[k], the first grid point is
+# dropped in the datasets (iloc[1:] of merge_dataset.py)
+class TunnelState:
+  def __init__(self, grid_start: int, values: np.ndarray, last_valid: np.ndarray):
+    self.grid_start = grid_start
+    self.values = values
+    # Index of the last grid point with an observation in each column, -1 if none
+    self.last_valid = last_valid
+
+  @classmethod
+  def empty(cls) -> 'TunnelState':
+    return cls(0, np.empty((len(TUNNELS), 0)), np.full(len(TUNNELS), -1, dtype=np.int64))
+
+  @classmethod
+  def load(cls, path: Path) -> 'TunnelState':
+    with np.load(path) as state:
+      return cls(int(state['grid_start']), state['values'], state['last_valid'])
+
+  def save(self, path: Path):
+    tmp = path.with_name(f'.{path.name}.tmp.npz')
+    np.savez(tmp, grid_start=self.grid_start, values=self.values, last_valid=self.last_valid)
+    os.replace(tmp, path)
+
+  @property
+  def n(self) -> int:
+    return self.values.shape[1]
+
+  def grid(self, first: int, last: int) -> pd.DatetimeIndex:
+    return pd.DatetimeIndex((self.grid_start + np.arange(first, last, dtype=np.int64) * STEP_NS)
+                            .view('datetime64[ns]'), name='timestamp')
+
+  # Add the rows of the tunnel time range following the current ones (the asfreq grid of resample('5Min'))
+  # Only the grid points after the last observation of each column are interpolated again, the ones before
+  # do not depend on the new rows (np.interp only uses the observations around each point)
+  def extend(self, rows: pd.DataFrame):
+    if rows.empty:
+      return
+    times = rows.index.to_numpy(dtype='datetime64[ns]').view(np.int64)
+    if self.n == 0:
+      self.grid_start = int(times.min()) // STEP_NS * STEP_NS
+    elif times.min() <= self.grid_start + (self.n - 1) * STEP_NS:
+      raise RebuildRequired('the new rows are not after the tunnel series')
+    n = (int(times.max()) - self.grid_start) // STEP_NS + 1
+    on_grid = (times - self.grid_start) % STEP_NS == 0
+    pos = (times[on_grid] - self.grid_start) // STEP_NS
+    values = np.full((len(TUNNELS), n), np.nan)
+    values[:, :self.n] = self.values
+    for k, column in enumerate(TUNNELS.values()):
+      observed = rows[column].to_numpy(dtype=np.float64)[on_grid]
+      first = max(self.last_valid[k], 0)
+      raw = np.full(n - first, np.nan)
+      if self.last_valid[k] >= 0:
+        raw[0] = values[k, first]
+      raw[pos - first] = observed
+      values[k, first:] = pd.Series(raw, index=self.grid(first, n)).interpolate(method='time').to_numpy()
+      valid = pos[~np.isnan(observed)]
+      if len(valid) > 0:
+        self.last_valid[k] = valid.max()
+    self.values = values
+
+  # Same frame as merge_dataset.resample_tunnels for the tunnel columns
+  def frame(self) -> pd.DataFrame:
+    df = pd.DataFrame(dict(zip(TUNNELS.values(), self.values[:, 1:])), index=self.grid(1, self.n))
+    df['week_day'] = df.index.dayofweek.values
+    df['hour'] = df.index.hour.values
+    df['minute'] = df.index.minute.values
+    return df
+
+
+def tunnel_rows(df: pd.DataFrame) -> pd.DataFrame:
+  return df[(df.index > merge_dataset.TUNNEL_SKIP_DATE) & (df.index <= merge_dataset.TUNNEL_UNTIL_DATE)]
+
+
+def write_tunnels(state: TunnelState):
+  df = state.frame()
+  for tunnel, column in TUNNELS.items():
+    merge_dataset.tunnel_dataset(df, column).to_csv(f'{BASE_DIR}/journal_time_data_{tunnel}.csv',
+                                                    encoding='utf-8')
+
+
+class DatasetBuilder:
+  def __init__(self, workers: int):
+    self.workers = workers
+    self.manifest_path = Path(BASE_DIR, MANIFEST)
+    self.state_path = Path(BASE_DIR, STATE)
+    self.manifest: dict[str, Any] = {}
+    self.state = TunnelState.empty()
+
+  def load(self) -> bool:
+    if not self.manifest_path.exists() or not self.state_path.exists():
+      return False
+    # Kept for the tables and archives processed, even if the outputs have to be rebuilt
+    self.manifest = json.loads(self.manifest_path.read_text())
+    if self.manifest.get('config') != build_config():
+      print('The settings of merge_dataset.py have changed', flush=True)
+      return False
+    merged = self.manifest['merged']
+    if not Path(BASE_DIR, MERGED).exists() or file_info(Path(BASE_DIR, MERGED)) != merged['file']:
+      print(f'{MERGED} has been modified', flush=True)
+      return False
+    self.state = TunnelState.load(self.state_path)
+    return True
+
+  def save(self):
+    self.state.save(self.state_path)
+    self.manifest['config'] = build_config()
+    self.manifest['merged']['file'] = file_info(Path(BASE_DIR, MERGED))
+    tmp = self.manifest_path.with_name(f'{self.manifest_path.name}.tmp')
+    tmp.write_text(json.dumps(self.manifest, indent=2))
+    os.replace(tmp, self.manifest_path)
+
+  # merge_dataset.py on every table
+  def rebuild(self, inputs: list[str]):
+    print(f'Rebuilding from {", ".join(inputs)}', flush=True)
+    df = merge_dataset.merge_datasets([Path(BASE_DIR, name) for name in inputs])
+    df.to_csv(Path(BASE_DIR, MERGED))
+    self.manifest = {
+      'archives': self.manifest.get('archives', {}),
+      'inputs': [],
+      'merged': {},
+    }
+    self.record_merged(df)
+    self.manifest['inputs'] = [self.table_info(name) for name in inputs]
+    self.state = TunnelState.empty()
+    self.state.extend(tunnel_rows(df))
+    write_tunnels(self.state)
+
+  def table_info(self, name: str) -> dict[str, Any]:
+    return {'name': name, **file_info(Path(BASE_DIR, name))}
+
+  def record_merged(self, df: pd.DataFrame):
+    merged = self.manifest['merged']
+    merged['columns'] = df.columns.tolist()
+    merged['kinds'] = [dtype.kind for dtype in df.dtypes]
+    merged['rows'] = merged.get('rows', 0) + len(df)
+    if len(df) > 0:
+      last = df.index.max().isoformat()
+      merged['last'] = max(merged.get('last', last), last)
+
+  # Append the rows of one more wide table to the merged dataset and extend the tunnel series
+  def append(self, name: str):
+    merged = self.manifest['merged']
+    df = merge_dataset.filter_merged(pd.read_csv(Path(BASE_DIR, name)))
+    if len(df) > 0 and 'last' in merged and df.index.min().isoformat() <= merged['last']:
+      raise RebuildRequired(f'{name} overlaps the merged dataset')
+    if not set(df.columns) <= set(merged['columns']):
+      raise RebuildRequired(f'{name} has new roads')
+    # The concatenated columns keep the type of the merged dataset, unless an integer column becomes float
+    df = df.reindex(columns=merged['columns'])
+    for column, kind in zip(merged['columns'], merged['kinds']):
+      if kind == 'f':
+        df[column] = df[column].astype(np.float64)
+      elif kind != 'i' or df[column].dtype.kind != 'i':
+        raise RebuildRequired(f'the type of {column} changes')
+    with open(Path(BASE_DIR, MERGED), 'a') as f:
+      df.to_csv(f, header=False, date_format=DATE_FORMAT)
+    self.state.extend(tunnel_rows(df))
+    self.record_merged(df)
+    self.manifest['inputs'].append(self.table_info(name))
+
+  def process_archive(self, archive: Path) -> str:
+    table = table_of(archive)
+    start = time.perf_counter()
+    n = process_journey_data_parallel(archive, table, self.workers, mmap=False)
+    data = pd.read_csv(table, usecols=['timestamp'])
+    self.manifest['archives'][archive.name] = {
+      **file_info(archive),
+      'files': n,
+      'first': data['timestamp'].min() if n else None,
+      'last': data['timestamp'].max() if n else None,
+      'table': table.name,
+    }
+    print(f'Pivoted {archive.name} ({n} files) to {table.name} in {time.perf_counter() - start:.1f}s', flush=True)
+    return table.name
+
+  def run(self, archives: list[Path], inputs: list[str], full: bool):
+    start = time.perf_counter()
+    if full or not self.load():
+      self.rebuild([table['name'] for table in self.manifest['inputs']] if 'inputs' in self.manifest else inputs)
+    else:
+      print(f'Loaded {MANIFEST} ({len(self.manifest["inputs"])} tables, {self.manifest["merged"]["rows"]} rows)',
+            flush=True)
+    for archive in archives:
+      processed = self.manifest['archives'].get(archive.name)
+      if processed is not None and all(processed[k] == v for k, v in file_info(archive).items()):
+        print(f'Skipped {archive.name}, processed already', flush=True)
+        continue
+      name = self.process_archive(archive)
+      appended = time.perf_counter()
+      if name in [table['name'] for table in self.manifest['inputs']]:
+        # A new version of an archive merged before
+        self.rebuild([table['name'] for table in self.manifest['inputs']])
+      else:
+        try:
+          self.append(name)
+          write_tunnels(self.state)
+          print(f'Appended {name} in {time.perf_counter() - appended:.1f}s', flush=True)
+        except RebuildRequired as err:
+          print(f'Unable to append {name}: {err}', flush=True)
+          self.rebuild([*(table['name'] for table in self.manifest['inputs']), name])
+    self.save()
+    print(f'Datasets up to date in {time.perf_counter() - start:.1f}s', flush=True)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Pivot new archives and update the merged and tunnel datasets')
+  parser.add_argument('archives', nargs='*', type=Path, help='New journey data archives (.tar.zstd)')
+  parser.add_argument('--inputs', nargs='+', default=merge_dataset.INPUTS,
+                      help=f'Wide tables in {BASE_DIR} of the first build, in time order')
+  parser.add_argument('--full', action='store_true', help='Rebuild every dataset from the tables merged')
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes parsing the archive files')
+  args = parser.parse_args()
+
+  DatasetBuilder(args.workers).run(args.archives, args.inputs, args.full)
@@ -21,6 +21,12 @@ let meta = null;
 
 let tunnel = 'cht';
 
+// Raw points by default, open the page with ?max_points=<n> (and optionally &downsample=aggregate) to let the
+// server downsample long ranges
+const page_params = new URLSearchParams(window.location.search);
+const fetch_max_points = page_params.get('max_points');
+const fetch_downsample = page_params.get('downsample') || 'lttb';
+
 function show_pop_alert(message, alert_type = 'alert-primary', add_classes = null) {
   remove_pop_alert();
   $('#alert-container').prepend(jQuery.parseHTML(
@@ -95,11 +101,16 @@ $(async function () {
     try {
       const start_time = start_time_input.val();
       const end_time = end_time_input.val();
-      const res = await fetch(`${endpoint}/fetch?` + new URLSearchParams({
+      const params = {
         tunnel,
         start_time,
         end_time,
-      }));
+      };
+      if (fetch_max_points) {
+        params.max_points = fetch_max_points;
+        params.downsample = fetch_downsample;
+      }
+      const res = await fetch(`${endpoint}/fetch?` + new URLSearchParams(params));
 
       if (!res.ok) {
         fetch_btn_icon.addClass('bi-x');
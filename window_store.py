@@ -0,0 +1,187 @@
+#  This file is part of fyp-data-time-series-forecasting.
+#  Copyright (c) 2023 Joe Ma <rikkaneko23@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import json
+import os
+import resource
+import shutil
+import time
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from series_store import N_FEATURES, calendar_features
+
+# Window store of the route features built by merge_dataset.py --format npy
+# <path>/values.npy: float32 journey time (timestamp x route), normalized with the mean and std of the train split
+# <path>/meta.json: routes, time axis, normalization and the split boundaries (rows)
+# Each series is kept once, the (n_steps -> n_horizon) windows are strided views of it
+STORE_FORMAT = 1
+SPLITS = ('train', 'val', 'test')
+N_STEPS = 12 * 6
+N_HORIZON = 12 * 3
+
+
+# Normalize the features written by merge_dataset.py and split them in time as plot_data.py
+# (splint_and_normalize_dataset), the mean and std of each route come from its train split
+def build_window_store(features_dir: str | Path, path: str | Path, *, train_ratio: float = 0.7,
+                       val_ratio: float = 0.2):
+  meta = json.loads(Path(features_dir, 'meta.json').read_text())
+  values = np.load(Path(features_dir, 'values.npy'), mmap_mode='r')
+  n = len(values)
+  train_n = int(n * train_ratio)
+  val_n = int(n * val_ratio)
+  train = values[:train_n].astype(np.float64)
+  mean = np.nanmean(train, axis=0)
+  std = np.nanstd(train, axis=0, ddof=1)
+
+  path = Path(path)
+  tmp_dir = Path(f'{path}.tmp-{os.getpid()}')
+  tmp_dir.mkdir(parents=True, exist_ok=True)
+  out = np.lib.format.open_memmap(tmp_dir / 'values.npy', mode='w+', dtype=np.float32, shape=values.shape)
+  # Normalize by blocks of rows, the features are never fully loaded
+  for first in range(0, n, 65536):
+    out[first:first + 65536] = (values[first:first + 65536] - mean) / std
+  out.flush()
+  del out
+  (tmp_dir / 'meta.json').write_text(json.dumps({
+    'format': STORE_FORMAT,
+    'names': meta['names'],
+    'routes': meta['routes'],
+    'start_ns': meta['start_ns'],
+    'step_ns': meta['step_ns'],
+    'length': n,
+    'mean': mean.tolist(),
+    'std': std.tolist(),
+    'splits': {'train': [0, train_n], 'val': [train_n, train_n + val_n], 'test': [train_n + val_n, n]},
+  }, indent=2))
+  if path.exists():
+    shutil.rmtree(path)
+  os.rename(tmp_dir, path)
+
+
+# Serve batches of model inputs (batch, n_steps, N_FEATURES) and targets (batch, n_horizon)
+# The model input is the same as SeriesStore.model_inputs: journey time, week_day, hour, minute
+# A window is identified by route * length + start, the rows [start, start + n_steps) are the input and the
+# next n_horizon rows the target, windows never cross a split boundary
+class WindowStore:
+  def __init__(self, path: str | Path, *, n_steps: int = N_STEPS, n_horizon: int = N_HORIZON, mmap: bool = True):
+    meta = json.loads(Path(path, 'meta.json').read_text())
+    if meta.get('format') != STORE_FORMAT:
+      raise ValueError(f'Unsupported window store format {meta.get("format")}')
+    self.path = Path(path)
+    self.names: list[str] = meta['names']
+    self.routes: list[str] = meta['routes']
+    self.start_ns: int = meta['start_ns']
+    self.step_ns: int = meta['step_ns']
+    self.mean = np.array(meta['mean'], dtype=np.float32)
+    self.std = np.array(meta['std'], dtype=np.float32)
+    self.splits: dict[str, tuple[int, int]] = {name: tuple(bounds) for name, bounds in meta['splits'].items()}
+    self.n_steps = n_steps
+    self.n_horizon = n_horizon
+    self.values = np.load(Path(path, 'values.npy'), mmap_mode='r' if mmap else None)
+    # (start, route, n_steps + n_horizon) view of the series, no copy
+    self.windows = sliding_window_view(self.values, n_steps + n_horizon, axis=0)
+    self._offsets = np.arange(n_steps, dtype=np.int64)
+    self._valid: np.ndarray | None = None
+
+  def __len__(self):
+    return len(self.values)
+
+  def route_ids(self, routes: list[str] | None = None) -> np.ndarray:
+    if routes is None:
+      return np.arange(len(self.names))
+    return np.array([self.names.index(name) if name in self.names else self.routes.index(name) for name in routes])
+
+  # Windows of the split, every stride rows, windows with a missing (NaN) value are skipped
+  def indices(self, split: str, routes: list[str] | None = None, *, stride: int = 1) -> np.ndarray:
+    first, last = self.splits[split]
+    starts = np.arange(first, last - (self.n_steps + self.n_horizon) + 1, stride, dtype=np.int64)
+    result = []
+    for route in self.route_ids(routes):
+      result.append(route * len(self) + starts[self.valid_windows(route)[starts]])
+    return np.concatenate(result) if result else np.empty(0, dtype=np.int64)
+
+  # Whether the window starting at each row of the route has no missing value
+  def valid_windows(self, route: int) -> np.ndarray:
+    if self._valid is None:
+      size = self.n_steps + self.n_horizon
+      valid = np.zeros((len(self.names), len(self)), dtype=bool)
+      for idx in range(len(self.names)):
+        missing = np.concatenate([[0], np.cumsum(np.isnan(self.values[:, idx]), dtype=np.int64)])
+        valid[idx, :len(self) - size + 1] = missing[size:] == missing[:-size]
+      self._valid = valid
+    return self._valid[route]
+
+  # Gather the windows, only the batch is copied out of the memory map
+  def batch(self, indices: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    routes, starts = np.divmod(np.asarray(indices, dtype=np.int64), len(self))
+    windows = self.windows[starts, routes]
+    inputs = np.empty((len(starts), self.n_steps, N_FEATURES), dtype=np.float32)
+    inputs[..., 0] = windows[:, :self.n_steps]
+    rows = starts[:, None] + self._offsets
+    for idx, feature in enumerate(calendar_features(self.start_ns + rows * self.step_ns)):
+      inputs[..., idx + 1] = feature
+    return inputs, np.ascontiguousarray(windows[:, self.n_steps:])
+
+  # Batches of the split, shuffled with the seed for training or in time order for evaluation
+  def batches(self, split: str, batch_size: int = 256, *, routes: list[str] | None = None, stride: int = 1,
+              shuffle: bool = False, seed: int | None = None) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    indices = self.indices(split, routes, stride=stride)
+    if shuffle:
+      np.random.default_rng(seed).shuffle(indices)
+    for first in range(0, len(indices), batch_size):
+      yield self.batch(indices[first:first + batch_size])
+
+  # Journey time of the normalized values (e.g. the forecasts) of the route
+  def denormalize(self, values: np.ndarray, route: int) -> np.ndarray:
+    return values * self.std[route] + self.mean[route]
+
+
+# Compare materializing every window of the train split with the window store
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Build the window store and compare it with materialized windows')
+  parser.add_argument('--features', type=Path, default=Path('data/features_all'),
+                      help='Binary dataset of merge_dataset.py --format npy')
+  parser.add_argument('--store', type=Path, default=Path('data/windows_all'))
+  parser.add_argument('--routes', nargs='+', help='Routes of the comparison (default all)')
+  parser.add_argument('--batch-size', type=int, default=256)
+  parser.add_argument('--materialize', action='store_true', help='Also stack every window in memory')
+  args = parser.parse_args()
+
+  start = time.perf_counter()
+  build_window_store(args.features, args.store)
+  print(f'Built {args.store} in {time.perf_counter() - start:.2f}s', flush=True)
+
+  store = WindowStore(args.store)
+  start = time.perf_counter()
+  n = 0
+  for inputs, targets in store.batches('train', args.batch_size, routes=args.routes, shuffle=True, seed=0):
+    n += len(inputs)
+  elapsed = time.perf_counter() - start
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  print(f'Window store: {n} shuffled train windows in {elapsed:.2f}s ({n / elapsed:.0f} windows/s), '
+        f'peak RSS {rss:.0f}MiB', flush=True)
+
+  if args.materialize:
+    start = time.perf_counter()
+    indices = store.indices('train', args.routes)
+    inputs, targets = store.batch(indices)
+    print(f'Materialized: {len(inputs)} train windows ({(inputs.nbytes + targets.nbytes) / 2 ** 20:.0f}MiB) '
+          f'in {time.perf_counter() - start:.2f}s, peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MiB',
+          flush=True)